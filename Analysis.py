@@ -0,0 +1,211 @@
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Manager
+
+from Chess import Game, moveName, squarePosition
+from Engine import Engine
+from Pgn import parseSan, playMove, readGames, sanMoves, startGame
+from Tablebase import Tablebase
+
+# Centipawns lost against the best move that make a move a blunder
+BLUNDER = 200
+
+
+def gameRecords(directory):
+    """Yields every game of the PGN files in a directory, in a fixed order so shards and resumed runs agree
+    :param directory: str
+    :return: generator of (str id, dict headers, str movetext), id is file name:game number"""
+    for path in sorted(glob.glob(os.path.join(directory, '*.pgn'))):
+        with open(path, encoding='utf-8', errors='replace') as stream:
+            for number, (headers, movetext) in enumerate(readGames(stream), 1):
+                yield os.path.basename(path) + ':' + str(number), headers, movetext
+
+
+def finishedGames(directory):
+    """Ids of the games already written to the shard outputs of a directory, cutting off lines left half written
+    by an interruption
+    :param directory: str, output directory
+    :return: set[str]"""
+    done = set()
+    for path in glob.glob(os.path.join(directory, 'shard-*.jsonl')):
+        with open(path, 'rb+') as output:
+            data = output.read()
+            end = data.rfind(b'\n') + 1
+            if end != len(data):
+                output.truncate(end)
+        for line in data[:end].splitlines():
+            done.add(json.loads(line)['id'])
+    return done
+
+
+def loadCache(directory, depth):
+    """Evaluations written by earlier runs at the same depth
+    :param directory: str, output directory
+    :param depth: int
+    :return: dict[int, (int, str)] position hash to score and best move"""
+    cache = {}
+    for path in glob.glob(os.path.join(directory, 'evals-*.txt')):
+        with open(path) as evals:
+            for line in evals:
+                fields = line.split()
+                # A line cut off by an interruption has fewer fields
+                if len(fields) == 4 and int(fields[1]) == depth:
+                    cache[int(fields[0])] = (int(fields[2]), fields[3])
+    return cache
+
+
+class Evaluator:
+    """Fixed depth evaluation of positions, looked up by position hash in a cache shared by all shards first"""
+
+    def __init__(self, depth, cache, evals, tablebase=None):
+        """:param depth: int
+        :param cache: dict or shared dict proxy, see loadCache
+        :param evals: file, new evaluations are appended to it for later runs
+        :param tablebase: Tablebase.Tablebase, or None"""
+        self.depth = depth
+        self.cache = cache
+        self.evals = evals
+        self.engine = Engine(maxTime=None, maxDepth=depth, tablebase=tablebase)
+        self.searched = 0
+        self.cached = 0
+
+    def evaluate(self, game: Game):
+        """Score and best move of a position, from the side to move's point of view
+        :param game: Game
+        :return: (int, str) score in centipawns and best move, '-' if there is none"""
+        key = game.positionHash()
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.cached += 1
+            return entry
+        self.searched += 1
+        result = self.engine.search(game)
+        entry = (result['score'], result['move'] or '-')
+        self.cache[key] = entry
+        self.evals.write(str(key) + ' ' + str(self.depth) + ' ' + str(entry[0]) + ' ' + entry[1] + '\n')
+        return entry
+
+
+def analyzeGame(evaluator: Evaluator, movetext, threshold=BLUNDER, headers=None):
+    """Replays a game, evaluating the position before and after every move
+    :param evaluator: Evaluator
+    :param movetext: str
+    :param threshold: int, centipawns lost for a blunder
+    :param headers: dict[str, str], a FEN header sets the start position
+    :return: (list[dict], str) a dict per move and the error stopping the replay or ''"""
+    try:
+        game = startGame(headers)
+    except ValueError as error:
+        return [], str(error)
+    moves = []
+    score, best = evaluator.evaluate(game)
+    for ply, san in enumerate(sanMoves(movetext)):
+        try:
+            piece, position, promotion = parseSan(game, san)
+        except ValueError as error:
+            return moves, 'ply ' + str(ply + 1) + ': ' + str(error)
+        move = moveName(squarePosition(piece.square), position, promotion)
+        color = game.turn
+        playMove(game, piece, position, promotion)
+        after, reply = evaluator.evaluate(game)
+        # The score after the move is the opponent's, it counts against the mover
+        loss = max(score - -after, 0)
+        moves.append({'ply': ply + 1, 'color': color, 'san': san, 'move': move, 'score': -after, 'best': best,
+                      'bestScore': score, 'loss': loss, 'blunder': loss >= threshold and move != best})
+        score, best = after, reply
+    return moves, ''
+
+
+def analyzeShard(shard, shards, directory, output, depth, threshold, cache, done, tablebase=None):
+    """Worker process task: analyzes the games of one shard, every shards-th game, appending a JSON line
+    per game to the shard's output
+    :param shard: int
+    :param shards: int
+    :param directory: str, PGN files
+    :param output: str, output directory
+    :param depth: int
+    :param threshold: int
+    :param cache: shared dict proxy, see loadCache
+    :param done: set[str], ids of games finished by an earlier run, skipped
+    :param tablebase: str, tablebase file, or None
+    :return: dict with shard, games, skipped, moves, blunders, searched, cached, errors and time"""
+    start = time.perf_counter()
+    path = os.path.join(output, 'shard-' + str(shard) + '.jsonl')
+    stats = {'shard': shard, 'games': 0, 'skipped': 0, 'moves': 0, 'blunders': 0, 'errors': 0}
+    with open(path, 'a') as results, open(os.path.join(output, 'evals-' + str(shard) + '.txt'), 'a') as evals:
+        evaluator = Evaluator(depth, cache, evals, Tablebase(tablebase) if tablebase else None)
+        for i, (gameId, headers, movetext) in enumerate(gameRecords(directory)):
+            if i % shards != shard:
+                continue
+            if gameId in done:
+                stats['skipped'] += 1
+                continue
+            moves, error = analyzeGame(evaluator, movetext, threshold, headers)
+            results.write(json.dumps({'id': gameId, 'headers': headers, 'depth': depth, 'moves': moves,
+                                      'error': error}) + '\n')
+            # A whole game is on disk before the next starts, so an interruption loses at most one
+            evals.flush()
+            results.flush()
+            stats['games'] += 1
+            stats['moves'] += len(moves)
+            stats['blunders'] += sum(move['blunder'] for move in moves)
+            stats['errors'] += bool(error)
+    stats.update(searched=evaluator.searched, cached=evaluator.cached, time=time.perf_counter() - start)
+    return stats
+
+
+def analyze(directory, output, workers=2, depth=3, threshold=BLUNDER, tablebase=None, out=print):
+    """Analyzes every game of a directory of PGN files, a shard per worker process.
+    Running again with the same output directory resumes where the last run stopped, with any worker count
+    :param directory: str
+    :param output: str, output directory, created if missing
+    :param workers: int
+    :param depth: int, search depth of every position
+    :param threshold: int, centipawns lost for a blunder
+    :param tablebase: str, tablebase file, or None
+    :param out: function used for output
+    :return: list of dict, see analyzeShard"""
+    os.makedirs(output, exist_ok=True)
+    start = time.perf_counter()
+    done = finishedGames(output)
+    with Manager() as manager:
+        cache = manager.dict(loadCache(output, depth))
+        if workers > 1:
+            with ProcessPoolExecutor(workers) as pool:
+                futures = [pool.submit(analyzeShard, shard, workers, directory, output, depth, threshold, cache,
+                                       done, tablebase) for shard in range(workers)]
+                stats = [future.result() for future in futures]
+        else:
+            stats = [analyzeShard(0, 1, directory, output, depth, threshold, cache, done, tablebase)]
+    elapsed = time.perf_counter() - start
+    for shard in stats:
+        out('Shard ' + str(shard['shard']) + ': ' + str(shard['games']) + ' games  ' + str(shard['skipped'])
+            + ' already done  ' + str(shard['moves']) + ' moves  ' + str(shard['blunders']) + ' blunders  '
+            + str(shard['errors']) + ' errors  searched ' + str(shard['searched']) + '  cached '
+            + str(shard['cached']))
+    games = sum(shard['games'] for shard in stats)
+    out('Games: ' + str(games) + '  Time: ' + format(elapsed, '.1f') + 's  Games/s: '
+        + format(games / elapsed if elapsed else 0.0, '.2f'))
+    return stats
+
+
+def main(argv=None):
+    """Command line entry: python -m Analysis DIRECTORY [--output DIR] [--workers N] [--depth N] [--threshold CP]"""
+    parser = argparse.ArgumentParser(description='Evaluate every move of a directory of PGN games and flag blunders')
+    parser.add_argument('directory')
+    parser.add_argument('--output', default='analysis', help='directory for shard-N.jsonl and the evaluation cache')
+    parser.add_argument('--workers', type=int, default=2, help='shards, a process each')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--threshold', type=int, default=BLUNDER, help='centipawns lost for a blunder')
+    parser.add_argument('--tablebase', default=None, help='tablebase file for exact endgame scores')
+    args = parser.parse_args(argv)
+    analyze(args.directory, args.output, args.workers, args.depth, args.threshold, args.tablebase)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
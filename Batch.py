@@ -0,0 +1,271 @@
+import argparse
+import random
+import time
+
+import numpy as np
+
+from Chess import Game, randomMoves, squareIndex
+from Bitboard import (BETWEEN, BISHOP, BLACK, KING, KING_ATTACKS, KNIGHT, KNIGHT_ATTACKS, KINDS,
+                      PAWN, PAWN_ATTACKS, QUEEN, RAYS, ROOK, ROOK_DIRECTIONS, WHITE, DIRECTIONS)
+
+# Mailbox code of an empty square, pieces are kind | color << 3 like BitboardGame.board
+NONE = -1
+
+
+def _bits(bb):
+    """Bitboard as a 64 entry bool array
+    :param bb: int
+    :return: np.ndarray"""
+    return np.array([(bb >> sq) & 1 for sq in range(64)], dtype=bool)
+
+
+# [from][to] tables of single step moves, PAWN_TABLE is [color][from][to] of pawn captures
+KNIGHT_TABLE = np.array([_bits(bb) for bb in KNIGHT_ATTACKS])
+KING_TABLE = np.array([_bits(bb) for bb in KING_ATTACKS])
+PAWN_TABLE = np.array([[_bits(bb) for bb in PAWN_ATTACKS[color]] for color in (WHITE, BLACK)])
+# [a][b] squares strictly between a and b, and whether a rook or bishop on a reaches b on an empty board
+BETWEEN_TABLE = np.array([[_bits(BETWEEN[a][b]) for b in range(64)] for a in range(64)])
+ROOK_LINES = np.array([_bits(RAYS[0][a] | RAYS[1][a] | RAYS[4][a] | RAYS[5][a]) for a in range(64)])
+BISHOP_LINES = np.array([_bits(RAYS[2][a] | RAYS[3][a] | RAYS[6][a] | RAYS[7][a]) for a in range(64)])
+
+# RAY_SQUARES[square][direction]: squares walked outwards from square, padded with the always empty column 64
+RAY_SQUARES = np.full((64, 8, 7), 64, dtype=np.int64)
+for _sq in range(64):
+    for _d, (_dx, _dy) in enumerate(DIRECTIONS):
+        _x = _sq % 8 + _dx
+        _y = _sq // 8 + _dy
+        _i = 0
+        while 0 <= _x <= 7 and 0 <= _y <= 7:
+            RAY_SQUARES[_sq, _d, _i] = _x + 8 * _y
+            _x += _dx
+            _y += _dy
+            _i += 1
+# Slider besides the queen attacking along each direction
+RAY_KINDS = np.array([ROOK if d in ROOK_DIRECTIONS else BISHOP for d in range(8)], dtype=np.int8)
+
+
+class BoardBatch:
+    """N positions held as arrays, for checking one candidate move in each at once.
+    board is (N, 65) int8 of piece codes kind | color << 3, NONE for empty, with column 64 always empty.
+    turn is the side to move (WHITE or BLACK), castling the rights bits of Bitboard and ep the en passant square or -1.
+    Moves follow Chess.Game: a pawn reaching the last row is a plain move, promotion comes after"""
+
+    def __init__(self, board, turn, castling, ep):
+        """:param board: np.ndarray (N, 65) int8
+        :param turn: np.ndarray (N,)
+        :param castling: np.ndarray (N,)
+        :param ep: np.ndarray (N,)"""
+        self.board = board
+        self.turn = turn
+        self.castling = castling
+        self.ep = ep
+
+    def __len__(self):
+        return len(self.board)
+
+    @classmethod
+    def fromGames(cls, games):
+        """Encodes Game positions. Castling rights come from movesDone of kings and rooks, and en passant
+        from epSquare when the pawn that made the double step is there, as Game hands it to pawnAttackMoves
+        :param games: list[Game]
+        :return: BoardBatch"""
+        board = np.full((len(games), 65), NONE, dtype=np.int8)
+        turn = np.zeros(len(games), dtype=np.int8)
+        castling = np.zeros(len(games), dtype=np.int8)
+        ep = np.full(len(games), -1, dtype=np.int8)
+        for row, game in enumerate(games):
+            for index, piece in enumerate(game.squares):
+                if piece is not None:
+                    board[row, index] = KINDS.index(piece.piece[0]) | (piece.color == 'black') << 3
+            color = BLACK if game.turn == 'black' else WHITE
+            turn[row] = color
+            castling[row] = sum(1 << i for i, right in enumerate(game.castlingRights()) if right)
+            if game.epSquare is not None:
+                target = squareIndex(game.epSquare)
+                behind = target - 8 if color == WHITE else target + 8
+                if board[row, behind] == PAWN | (color ^ 1) << 3:
+                    ep[row] = target
+        return cls(board, turn, castling, ep)
+
+    def take(self, rows):
+        """Batch of the passed rows, rows may repeat to check several moves in one position
+        :param rows: np.ndarray of int
+        :return: BoardBatch"""
+        return BoardBatch(self.board[rows], self.turn[rows], self.castling[rows], self.ep[rows])
+
+    def legalMask(self, frm, to):
+        """Checks one move per position, returns True where it is legal.
+        Move patterns, occupancy and whether the king is attacked afterwards are worked out for the whole batch
+        :param frm: array of N from squares
+        :param to: array of N to squares
+        :return: np.ndarray (N,) bool"""
+        board = self.board
+        n = len(board)
+        rows = np.arange(n)
+        frm = np.asarray(frm, dtype=np.int64)
+        to = np.asarray(to, dtype=np.int64)
+        valid = (frm >= 0) & (frm < 64) & (to >= 0) & (to < 64) & (frm != to)
+        frm = np.where(valid, frm, 0)
+        to = np.where(valid, to, 0)
+        color = self.turn.astype(np.int64)
+        enemy = color ^ 1
+
+        piece = board[rows, frm].astype(np.int64)
+        target = board[rows, to].astype(np.int64)
+        kind = piece & 7
+        empty = target == NONE
+        mine = (piece != NONE) & (piece >> 3 == color)
+        capture = ~empty & (target >> 3 == enemy)
+        occupied = board[:, :64] != NONE
+        clear = ~(BETWEEN_TABLE[frm, to] & occupied).any(axis=1)
+
+        # Pawns push onto empty squares, two from their starting row, and take diagonally or en passant
+        forward = np.where(color == WHITE, 8, -8)
+        startRow = np.where(color == WHITE, 1, 6)
+        middle = np.clip(frm + forward, 0, 63)
+        enPassant = empty & (to == self.ep)
+        pawn = ((to == frm + forward) & empty) \
+            | ((to == frm + 2 * forward) & empty & (board[rows, middle] == NONE) & (frm // 8 == startRow)) \
+            | (PAWN_TABLE[color, frm, to] & (capture | enPassant))
+
+        # Castling: rights left, nothing between king and rook, not out of, through or into check
+        home = np.where(color == WHITE, 0, 56)
+        short = to == home + 6
+        rookFrom = np.where(short, home + 7, home)
+        rookTo = np.where(short, home + 5, home + 3)
+        right = np.where(short, np.where(color == WHITE, 1, 4), np.where(color == WHITE, 2, 8))
+        castle = (frm == home + 4) & ((to == home + 2) | short) & (self.castling & right != 0) \
+            & (board[rows, rookFrom] == ROOK | color << 3) & ~(BETWEEN_TABLE[frm, rookFrom] & occupied).any(axis=1)
+        castle &= ~attacked(board, frm, enemy)
+        castle &= ~attacked(board, rookTo, enemy)
+
+        pattern = np.select(
+            [kind == PAWN, kind == KNIGHT, kind == BISHOP, kind == ROOK, kind == QUEEN, kind == KING],
+            [pawn, KNIGHT_TABLE[frm, to], BISHOP_LINES[frm, to] & clear, ROOK_LINES[frm, to] & clear,
+             (BISHOP_LINES[frm, to] | ROOK_LINES[frm, to]) & clear, KING_TABLE[frm, to] | castle], False)
+        legal = valid & mine & (empty | capture) & pattern
+
+        # Play every move on a copy and look for attacks on the own king
+        after = board.copy()
+        after[rows, to] = piece
+        after[rows, frm] = NONE
+        taken = legal & (kind == PAWN) & enPassant
+        after[rows[taken], (to - forward)[taken]] = NONE
+        castled = legal & (kind == KING) & castle & ~KING_TABLE[frm, to]
+        after[rows[castled], rookTo[castled]] = after[rows[castled], rookFrom[castled]]
+        after[rows[castled], rookFrom[castled]] = NONE
+        king = np.where(kind == KING, to, np.argmax(board[:, :64] == (KING | color << 3)[:, None], axis=1))
+        return legal & ~attacked(after, king, enemy)
+
+
+def attacked(board, squares, color):
+    """Whether pieces of a color attack a square, one square and color per position of the batch
+    :param board: np.ndarray (N, 65) int8
+    :param squares: np.ndarray (N,)
+    :param color: np.ndarray (N,)
+    :return: np.ndarray (N,) bool"""
+    rows = np.arange(len(board))
+    squares = np.asarray(squares, dtype=np.int64)
+    color = np.asarray(color, dtype=np.int64)
+    pieces = board[:, :64]
+    shift = (color << 3)[:, None]
+    hit = ((pieces == KNIGHT | shift) & KNIGHT_TABLE[squares]).any(axis=1)
+    hit |= ((pieces == KING | shift) & KING_TABLE[squares]).any(axis=1)
+    # A pawn attacks the square from where a pawn of the other color standing on it would attack
+    hit |= ((pieces == PAWN | shift) & PAWN_TABLE[color ^ 1, squares]).any(axis=1)
+
+    # First piece along each of the 8 rays, a hit if it is an enemy queen or the slider of that direction
+    rays = board[rows[:, None, None], RAY_SQUARES[squares]].astype(np.int64)
+    blocked = rays != NONE
+    first = np.take_along_axis(rays, np.argmax(blocked, axis=2)[:, :, None], axis=2)[:, :, 0]
+    slider = blocked.any(axis=2) & (first >> 3 == color[:, None]) \
+        & (((first & 7) == QUEEN) | ((first & 7) == RAY_KINDS[None, :]))
+    return hit | slider.any(axis=1)
+
+
+def randomGames(games, plies, generator='pins', seed=0):
+    """Games played some random legal moves in, for checking and timing
+    :param games: int
+    :param plies: int, most random moves per game
+    :param generator: str
+    :param seed: int
+    :return: list[Game]"""
+    rnd = random.Random(seed)
+    played = []
+    for _ in range(games):
+        game = Game(generator)
+        randomMoves(game, rnd.randrange(plies + 1), rnd)
+        played.append(game)
+    return played
+
+
+def candidates(games):
+    """Every move from a square of the side to move to any square, legal or not, with the Game's answer
+    :param games: list[Game]
+    :return: (np.ndarray rows, np.ndarray from, np.ndarray to, np.ndarray expected)"""
+    rows = []
+    frm = []
+    to = []
+    expected = []
+    for row, game in enumerate(games):
+        side = game.white if game.turn == 'white' else game.black
+        for piece in side.values():
+            if piece.square < 0:
+                continue
+            for square in range(64):
+                rows.append(row)
+                frm.append(piece.square)
+                to.append(square)
+                expected.append(square in piece.moves)
+    return np.array(rows), np.array(frm), np.array(to), np.array(expected)
+
+
+def crossCheck(games=200, plies=60, generator='pins', seed=0, out=print):
+    """Compares legalMask with the moves Game.moveChecker leaves, for every from/to pair on random positions
+    :param games: int
+    :param plies: int
+    :param generator: str, legal move filter of the Games
+    :param seed: int
+    :param out: function used for output
+    :return: int mismatches"""
+    played = randomGames(games, plies, generator, seed)
+    rows, frm, to, expected = candidates(played)
+    batch = BoardBatch.fromGames(played).take(rows)
+    start = time.perf_counter()
+    mask = batch.legalMask(frm, to)
+    elapsed = time.perf_counter() - start
+    wrong = np.nonzero(mask != expected)[0]
+    for i in wrong[:10]:
+        out('MISMATCH ' + played[rows[i]].to_fen() + ' ' + str(frm[i]) + '-' + str(to[i])
+            + ' game: ' + str(bool(expected[i])) + ' batch: ' + str(bool(mask[i])))
+    out('Positions: ' + str(games) + '  Moves: ' + str(len(mask)) + '  Legal: ' + str(int(expected.sum()))
+        + '  Mismatches: ' + str(len(wrong)) + '  Moves/s: ' + str(int(len(mask) / elapsed) if elapsed else 0))
+    return len(wrong)
+
+
+def main(argv=None):
+    """Command line entry: python -m Batch [--cross-check] [--games N] [--plies N]"""
+    parser = argparse.ArgumentParser(description='Batched move validation for many positions at once')
+    parser.add_argument('--cross-check', action='store_true',
+                        help='compare every from/to pair on random positions with Game.moveChecker')
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--plies', type=int, default=60, help='most random moves played into each position')
+    parser.add_argument('--generator', choices=('trial', 'pins'), default='pins')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.cross_check:
+        return 1 if crossCheck(args.games, args.plies, args.generator, args.seed) else 0
+    played = randomGames(args.games, args.plies, args.generator, args.seed)
+    rows, frm, to, expected = candidates(played)
+    batch = BoardBatch.fromGames(played).take(rows)
+    start = time.perf_counter()
+    batch.legalMask(frm, to)
+    elapsed = time.perf_counter() - start
+    print('Positions: ' + str(args.games) + '  Moves: ' + str(len(rows)) + '  Time: ' + format(elapsed, '.3f')
+          + 's  Moves/s: ' + str(int(len(rows) / elapsed) if elapsed else 0))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
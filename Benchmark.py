@@ -0,0 +1,219 @@
+import argparse
+import random
+import threading
+import time
+import tracemalloc
+
+from Chess import Game, randomMoves
+from Bitboard import BitboardGame
+from Engine import Engine, ParallelEngine
+from Perft import POSITIONS
+from Server import Matchmaker
+
+# Positions searched by the parallel benchmark
+SEARCH_POSITIONS = ('start', 'kiwipete', 'middlegame')
+
+
+def memory(games=1000, plies=20, backend='game', generator='trial', seed=0, out=print):
+    """Measures bytes held per live game, with every game played some random moves in
+    :param games: int, games kept alive at once
+    :param plies: int, random moves played in each game
+    :param backend: str, 'game' or 'bitboard'
+    :param generator: str, legal move filter of the game backend
+    :param seed: int
+    :param out: function used for output
+    :return: float bytes per game"""
+    rnd = random.Random(seed)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    live = []
+    for _ in range(games):
+        game = BitboardGame() if backend == 'bitboard' else Game(generator)
+        randomMoves(game, plies, rnd)
+        live.append(game)
+    elapsed = time.perf_counter() - start
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    perGame = held / games
+    out('Games: ' + str(games) + '  Plies: ' + str(plies) + '  Bytes/game: ' + str(int(perGame))
+        + '  Total: ' + format(held / 2 ** 20, '.1f') + 'MiB  Time: ' + format(elapsed, '.3f') + 's')
+    return perGame
+
+
+def lazy(games=200, plies=60, generator='trial', seed=0, out=print):
+    """Times random games on the eager Game against lazy, side to move only generation
+    :param games: int
+    :param plies: int, most random moves played in each game
+    :param generator: str, legal move filter
+    :param seed: int
+    :param out: function used for output
+    :return: float speedup of lazy over eager"""
+    rates = {}
+    for mode in ('eager', 'lazy'):
+        rnd = random.Random(seed)
+        played = 0
+        start = time.perf_counter()
+        for _ in range(games):
+            played += randomMoves(Game(generator, lazy=mode == 'lazy'), plies, rnd)
+        elapsed = time.perf_counter() - start
+        rates[mode] = played / elapsed if elapsed else 0.0
+        out(mode.capitalize() + ': ' + str(played) + ' moves  Time: ' + format(elapsed, '.3f') + 's  Moves/s: '
+            + str(int(rates[mode])))
+    speedup = rates['lazy'] / rates['eager'] if rates['eager'] else 0.0
+    out('Speedup: ' + format(speedup, '.2f') + 'x')
+    return speedup
+
+
+def parallel(workers=(1, 2, 4), depth=4, out=print):
+    """Times fixed depth searches of the same positions with each number of worker processes
+    :param workers: tuple of int
+    :param depth: int
+    :param out: function used for output
+    :return: dict[int, float] speedup over the first worker count"""
+    times = {}
+    for count in workers:
+        engine = ParallelEngine(count, maxTime=None, maxDepth=depth) if count > 1 else Engine(None, None, depth)
+        # Starts the worker processes before timing
+        engine.maxDepth = 1
+        engine.search(Game())
+        engine.maxDepth = depth
+        nodes = 0
+        scores = []
+        start = time.perf_counter()
+        for name in SEARCH_POSITIONS:
+            result = engine.search(Game.from_fen(POSITIONS[name][0], 'pins'))
+            nodes += result['nodes']
+            scores.append(str(result['score']))
+        times[count] = time.perf_counter() - start
+        if count > 1:
+            engine.close()
+        out('Workers: ' + str(count) + '  Nodes: ' + str(nodes) + '  Time: ' + format(times[count], '.3f')
+            + 's  NPS: ' + str(int(nodes / times[count]) if times[count] else 0) + '  Speedup: '
+            + format(times[workers[0]] / times[count], '.2f') + 'x  Scores: ' + ' '.join(scores))
+    return {count: times[workers[0]] / times[count] for count in workers}
+
+
+def matchRequests(requests, directed, rnd, ratings=False):
+    """Simulated Start requests of players who each arrive once. A directed request names an earlier player,
+    who has mostly found a game already, so challenges pile up like those to players gone offline
+    :param requests: int
+    :param directed: float, share of requests naming an opponent
+    :param rnd: random.Random
+    :param ratings: bool, give players a rating
+    :return: list of (str cookie, str user, str desired, int rating or None)"""
+    made = []
+    for i in range(requests):
+        desired = 'u' + str(rnd.randrange(i)) if i and rnd.random() < directed else 'None'
+        rating = int(rnd.gauss(1500, 300)) if ratings else None
+        made.append((str(i), 'u' + str(i), desired, rating))
+    return made
+
+
+def scanMatch(waiting, cookie, user, desired):
+    """Matchmaking as the server did before Matchmaker, looking through everyone waiting
+    :param waiting: dict {cookie: (user, desired)}
+    :param cookie: str
+    :param user: str
+    :param desired: str
+    :return: str cookie of the opponent or None"""
+    for other, (otherUser, otherDesired) in waiting.items():
+        if desired == 'None' and otherDesired in ('None', user) or \
+                desired == otherUser and otherDesired in ('None', user):
+            del waiting[other]
+            return other
+    waiting[cookie] = (user, desired)
+    return None
+
+
+def matchmaking(requests=100000, directed=0.2, threads=4, bucket=None, scan=10000, seed=0, out=print):
+    """Pushes simulated Start requests through Matchmaker from several threads and checks every player ends up
+    either waiting or in exactly one game, then times the old scan of everyone waiting for comparison
+    :param requests: int
+    :param directed: float, share of requests naming an opponent
+    :param threads: int
+    :param bucket: int, rating points per bucket, None for no ratings
+    :param scan: int, requests given to the scan, 0 skips it
+    :param seed: int
+    :param out: function used for output
+    :return: float requests per second"""
+    made = matchRequests(requests, directed, random.Random(seed), bucket is not None)
+    matchmaker = Matchmaker(bucket)
+    games = {}
+
+    def run(part):
+        for cookie, user, desired, rating in part:
+            opponent = matchmaker.match(cookie, user, desired, rating)
+            if opponent is not None:
+                games[cookie] = opponent
+
+    workers = [threading.Thread(target=run, args=(made[i::threads],)) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    players = list(games) + list(games.values())
+    consistent = len(players) == len(set(players)) and len(players) + len(matchmaker) == requests and \
+        not any(cookie in matchmaker for cookie in players)
+    rate = requests / elapsed if elapsed else 0.0
+    out('Requests: ' + str(requests) + '  Threads: ' + str(threads) + '  Games: ' + str(len(games)) + '  Waiting: '
+        + str(len(matchmaker)) + '  Time: ' + format(elapsed, '.3f') + 's  Requests/s: ' + str(int(rate))
+        + '  Lock waits: ' + str(matchmaker.lock.counters()['contended']) + '  Consistent: '
+        + ('yes' if consistent else 'NO'))
+    if scan:
+        waiting = {}
+        start = time.perf_counter()
+        for cookie, user, desired, rating in made[:scan]:
+            scanMatch(waiting, cookie, user, desired)
+        elapsed = time.perf_counter() - start
+        out('Scan: ' + str(min(scan, requests)) + ' requests  Waiting: ' + str(len(waiting)) + '  Time: '
+            + format(elapsed, '.3f') + 's  Requests/s: ' + str(int(min(scan, requests) / elapsed) if elapsed else 0))
+    return rate
+
+
+def main(argv=None):
+    """Command line entry: python -m Benchmark memory|lazy|parallel|matchmaking [options]"""
+    parser = argparse.ArgumentParser(description='Benchmarks of the chess backends')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    memoryParser = commands.add_parser('memory', help='bytes held per live game')
+    memoryParser.add_argument('--games', type=int, default=1000)
+    memoryParser.add_argument('--plies', type=int, default=20)
+    memoryParser.add_argument('--backend', choices=('game', 'bitboard'), default='game')
+    memoryParser.add_argument('--generator', choices=('trial', 'pins'), default='trial')
+    memoryParser.add_argument('--seed', type=int, default=0)
+
+    lazyParser = commands.add_parser('lazy', help='eager against lazy, side to move only move generation')
+    lazyParser.add_argument('--games', type=int, default=200)
+    lazyParser.add_argument('--plies', type=int, default=60)
+    lazyParser.add_argument('--generator', choices=('trial', 'pins'), default='trial')
+    lazyParser.add_argument('--seed', type=int, default=0)
+
+    parallelParser = commands.add_parser('parallel', help='fixed depth search speedup per worker process count')
+    parallelParser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parallelParser.add_argument('--depth', type=int, default=4)
+
+    matchParser = commands.add_parser('matchmaking', help='simulated match requests through Server.Matchmaker')
+    matchParser.add_argument('--requests', type=int, default=100000)
+    matchParser.add_argument('--directed', type=float, default=0.2, help='share of requests naming an opponent')
+    matchParser.add_argument('--threads', type=int, default=4)
+    matchParser.add_argument('--bucket', type=int, default=None, help='rating points per bucket, no ratings if left out')
+    matchParser.add_argument('--scan', type=int, default=10000, help='requests timed with the old scan, 0 skips it')
+    matchParser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.command == 'memory':
+        memory(args.games, args.plies, args.backend, args.generator, args.seed)
+    elif args.command == 'lazy':
+        lazy(args.games, args.plies, args.generator, args.seed)
+    elif args.command == 'parallel':
+        parallel(tuple(args.workers), args.depth)
+    elif args.command == 'matchmaking':
+        matchmaking(args.requests, args.directed, args.threads, args.bucket, args.scan, args.seed)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
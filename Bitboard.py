@@ -0,0 +1,602 @@
+from array import array
+
+from Chess import BANISHED, EMPTY, KINDS, Piece, decodeMove, encodeMove, fenPieces, squareIndex
+
+# Bitboards are python ints, bit x + 8 * y is the square [x, y]
+FULL = (1 << 64) - 1
+FILE_A = 0x0101010101010101
+FILE_H = FILE_A << 7
+RANK_1 = 0xFF
+RANK_8 = RANK_1 << 56
+
+WHITE = 0
+BLACK = 1
+COLORS = ('white', 'black')
+
+# Piece kinds, index into the bitboards of a side and into KINDS
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+
+# Castling rights, one bit per king/rook pair
+WHITE_SHORT = 1
+WHITE_LONG = 2
+BLACK_SHORT = 4
+BLACK_LONG = 8
+
+# Directions as (dx, dy). The first four increase the square index, the last four decrease it
+DIRECTIONS = ((0, 1), (1, 0), (1, 1), (-1, 1), (0, -1), (-1, 0), (-1, -1), (1, -1))
+ROOK_DIRECTIONS = (0, 1, 4, 5)
+BISHOP_DIRECTIONS = (2, 3, 6, 7)
+
+
+def lsb(bb):
+    """Index of the lowest set bit
+    :param bb: int
+    :return: int"""
+    return (bb & -bb).bit_length() - 1
+
+
+def popcount(bb):
+    """Number of set bits
+    :param bb: int
+    :return: int"""
+    return bin(bb).count('1')
+
+
+def squares(bb):
+    """Yields the index of every set bit, lowest first
+    :param bb: int"""
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+
+def _steps(offsets):
+    """Builds a 64 entry attack table for a piece moving by the passed offsets
+    :param offsets: list of (dx, dy)
+    :return: list[int]"""
+    table = []
+    for sq in range(64):
+        x = sq % 8
+        y = sq // 8
+        bb = 0
+        for dx, dy in offsets:
+            if 0 <= x + dx <= 7 and 0 <= y + dy <= 7:
+                bb |= 1 << (x + dx + 8 * (y + dy))
+        table.append(bb)
+    return table
+
+
+KNIGHT_ATTACKS = _steps(((2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (1, -2), (-1, 2), (-1, -2)))
+KING_ATTACKS = _steps(((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)))
+PAWN_ATTACKS = (_steps(((1, 1), (-1, 1))), _steps(((1, -1), (-1, -1))))
+
+# RAYS[direction][square]: every square from square outwards in that direction, on an empty board
+RAYS = [[0] * 64 for _ in DIRECTIONS]
+# BETWEEN[a][b]: squares strictly between a and b if they share a line, LINE[a][b]: the whole line through both
+BETWEEN = [[0] * 64 for _ in range(64)]
+LINE = [[0] * 64 for _ in range(64)]
+for _d, (_dx, _dy) in enumerate(DIRECTIONS):
+    for _sq in range(64):
+        _x = _sq % 8 + _dx
+        _y = _sq // 8 + _dy
+        _between = 0
+        while 0 <= _x <= 7 and 0 <= _y <= 7:
+            _to = _x + 8 * _y
+            RAYS[_d][_sq] |= 1 << _to
+            BETWEEN[_sq][_to] = _between
+            _between |= 1 << _to
+            _x += _dx
+            _y += _dy
+for _d in range(4):
+    for _sq in range(64):
+        _line = RAYS[_d][_sq] | RAYS[_d + 4][_sq] | 1 << _sq
+        for _to in squares(_line):
+            LINE[_sq][_to] = _line
+
+
+def rayAttacks(direction, sq, occupied):
+    """Squares a slider on sq reaches in one direction, up to and including the first blocker
+    :param direction: int
+    :param sq: int
+    :param occupied: int
+    :return: int"""
+    ray = RAYS[direction][sq]
+    blockers = ray & occupied
+    if blockers:
+        if direction < 4:
+            ray ^= RAYS[direction][(blockers & -blockers).bit_length() - 1]
+        else:
+            ray ^= RAYS[direction][blockers.bit_length() - 1]
+    return ray
+
+
+def bishopAttacks(sq, occupied):
+    """Diagonal slider attacks from sq
+    :param sq: int
+    :param occupied: int
+    :return: int"""
+    return (rayAttacks(2, sq, occupied) | rayAttacks(3, sq, occupied)
+            | rayAttacks(6, sq, occupied) | rayAttacks(7, sq, occupied))
+
+
+def rookAttacks(sq, occupied):
+    """Orthogonal slider attacks from sq
+    :param sq: int
+    :param occupied: int
+    :return: int"""
+    return (rayAttacks(0, sq, occupied) | rayAttacks(1, sq, occupied)
+            | rayAttacks(4, sq, occupied) | rayAttacks(5, sq, occupied))
+
+
+class BitboardGame:
+    """Chess Game backed by one bitboard per color and piece kind.
+    Exposes the same white/black Piece dicts, getPiece, move, promote, applyMove, played and winner as Chess.Game,
+    plus push/pop/legalMoves working on int encoded moves for fast search and validation."""
+
+    def __init__(self):
+        """Create both sides with the same Piece names as Chess.Game, then build the bitboards"""
+        self.black = {}
+        self.white = {}
+        self.winner = ''
+        self.halfmoveClock = 0
+        self.fullmoveNumber = 1
+        for side, color, back, front in ((self.black, 'black', 7, 6), (self.white, 'white', 0, 1)):
+            for name, x in (('R1', 0), ('N1', 1), ('B1', 2), ('Q0', 3), ('K0', 4), ('B2', 5), ('N2', 6), ('R2', 7)):
+                side[name] = Piece(color, name[0], [x, back])
+            for i in range(1, 9):
+                side['P' + str(i)] = Piece(color, 'P', [i - 1, front])
+        self.loadPieces(WHITE)
+
+    def loadPieces(self, turn, ep=-1):
+        """Builds the bitboards from the Piece dicts. Castling rights follow movesDone like in Chess.Game
+        :param turn: int, WHITE or BLACK to move
+        :param ep: int, square a pawn can be taken on en passant, -1 for none"""
+        self.bb = [[0] * 6, [0] * 6]
+        self.occ = [0, 0]
+        # Mailbox of piece codes, kind | color << 3, -1 for empty
+        self.board = [-1] * 64
+        # Piece objects standing on each square, only kept up to date by move and promote
+        self.squares = [None] * 64
+        for color, side in ((WHITE, self.white), (BLACK, self.black)):
+            for piece in side.values():
+                sq = piece.square
+                if sq < 0:
+                    continue
+                kind = KINDS.index(piece.piece[0])
+                self.bb[color][kind] |= 1 << sq
+                self.occ[color] |= 1 << sq
+                self.board[sq] = kind | color << 3
+                self.squares[sq] = piece
+        self.castling = 0
+        for color, side, short, long in ((WHITE, self.white, WHITE_SHORT, WHITE_LONG),
+                                         (BLACK, self.black, BLACK_SHORT, BLACK_LONG)):
+            row = 0 if color == WHITE else 56
+            if side['K0'].movesDone == 0 and side['K0'].square == row + 4:
+                if side['R2'].movesDone == 0 and side['R2'].square == row + 7:
+                    self.castling |= short
+                if side['R1'].movesDone == 0 and side['R1'].square == row:
+                    self.castling |= long
+        self.turn = turn
+        self.ep = ep
+        self.history = []
+        # Moves played through move and promote, encoded by encodeMove, as in Chess.Game
+        self.played = array('H')
+        self.winner = ''
+        self.updateMoves()
+
+    @classmethod
+    def from_fen(cls, fen):
+        """Creates a game set up at a FEN position
+        :param fen: str
+        :return: BitboardGame"""
+        game = cls()
+        game.setFen(fen)
+        return game
+
+    def setFen(self, fen):
+        """Replaces the position with a FEN position, naming pieces like Chess.Game.setFen
+        :param fen: str"""
+        fields = fen.split()
+        self.white, self.black = fenPieces(fields[0], fields[2] if len(fields) > 2 else '-')
+        ep = fields[3] if len(fields) > 3 else '-'
+        self.halfmoveClock = int(fields[4]) if len(fields) > 4 else 0
+        self.fullmoveNumber = int(fields[5]) if len(fields) > 5 else 1
+        self.loadPieces(BLACK if len(fields) > 1 and fields[1] == 'b' else WHITE,
+                        -1 if ep == '-' else ord(ep[0]) - ord('a') + 8 * (int(ep[1]) - 1))
+
+    def to_fen(self):
+        """Returns the position as FEN
+        :return: str"""
+        rows = []
+        for y in range(7, -1, -1):
+            row = ''
+            empty = 0
+            for x in range(8):
+                code = self.board[x + 8 * y]
+                if code < 0:
+                    empty += 1
+                    continue
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                row += KINDS[code & 7] if code >> 3 == WHITE else KINDS[code & 7].lower()
+            if empty:
+                row += str(empty)
+            rows.append(row)
+        castling = ''.join(char for char, right in (('K', WHITE_SHORT), ('Q', WHITE_LONG),
+                                                    ('k', BLACK_SHORT), ('q', BLACK_LONG)) if self.castling & right)
+        ep = '-' if self.ep < 0 else chr(ord('a') + self.ep % 8) + str(self.ep // 8 + 1)
+        return ' '.join(('/'.join(rows), 'w' if self.turn == WHITE else 'b', castling or '-', ep,
+                         str(self.halfmoveClock), str(self.fullmoveNumber)))
+
+    def otherSide(self, piece: Piece):
+        """Returns dictionary of other team as passed piece
+        :param piece: Piece object
+        :return: dict[str, Piece] of the opposite side"""
+        return self.white if piece.color == 'black' else self.black
+
+    def ownSide(self, piece: Piece):
+        """Returns dictionary of same team as passed piece
+        :param piece: Piece object
+        :return: dict[str, Piece] of the same side"""
+        return self.black if piece.color == 'black' else self.white
+
+    def getPiece(self, position):
+        """Gets piece at a board position
+        :param position: list
+        :return: Piece or None"""
+        sq = squareIndex(position)
+        if sq is None:
+            return None
+        return self.squares[sq]
+
+    def attacked(self, sq, color, occupied):
+        """Returns whether the passed color attacks a square, given an occupancy
+        :param sq: int
+        :param color: int
+        :param occupied: int
+        :return: bool"""
+        bb = self.bb[color]
+        if KNIGHT_ATTACKS[sq] & bb[KNIGHT] or KING_ATTACKS[sq] & bb[KING]:
+            return True
+        # A pawn of the other color on sq would attack exactly the squares our pawns attack it from
+        if PAWN_ATTACKS[color ^ 1][sq] & bb[PAWN]:
+            return True
+        if bishopAttacks(sq, occupied) & (bb[BISHOP] | bb[QUEEN]):
+            return True
+        return rookAttacks(sq, occupied) & (bb[ROOK] | bb[QUEEN]) != 0
+
+    def attackersTo(self, sq, color, occupied):
+        """Bitboard of pieces of the passed color attacking a square
+        :param sq: int
+        :param color: int
+        :param occupied: int
+        :return: int"""
+        bb = self.bb[color]
+        return ((KNIGHT_ATTACKS[sq] & bb[KNIGHT]) | (KING_ATTACKS[sq] & bb[KING])
+                | (PAWN_ATTACKS[color ^ 1][sq] & bb[PAWN])
+                | (bishopAttacks(sq, occupied) & (bb[BISHOP] | bb[QUEEN]))
+                | (rookAttacks(sq, occupied) & (bb[ROOK] | bb[QUEEN])))
+
+    def inCheck(self, color=None):
+        """Returns whether a side, by default the side to move, is in check
+        :param color: int
+        :return: bool"""
+        if color is None:
+            color = self.turn
+        king = self.bb[color][KING]
+        if not king:
+            return False
+        return self.attacked(lsb(king), color ^ 1, self.occ[0] | self.occ[1])
+
+    def pinned(self, ksq, us, occupied):
+        """Bitboard of our pieces pinned to our king on ksq
+        :param ksq: int
+        :param us: int
+        :param occupied: int
+        :return: int"""
+        them = self.bb[us ^ 1]
+        snipers = ((rookAttacks(ksq, 0) & (them[ROOK] | them[QUEEN]))
+                   | (bishopAttacks(ksq, 0) & (them[BISHOP] | them[QUEEN])))
+        pinned = 0
+        for sniper in squares(snipers):
+            between = BETWEEN[ksq][sniper] & occupied
+            if between and between & (between - 1) == 0 and between & self.occ[us]:
+                pinned |= between
+        return pinned
+
+    def legalMoves(self):
+        """Generates all legal moves for the side to move, promotions once per promotion kind
+        :return: list[int] of moves made by encodeMove"""
+        us = self.turn
+        them = us ^ 1
+        bb = self.bb[us]
+        own = self.occ[us]
+        enemy = self.occ[them]
+        occupied = own | enemy
+        moves = []
+        if not bb[KING]:
+            return moves
+        ksq = lsb(bb[KING])
+
+        # King steps, checked with the king lifted so sliders see through its square
+        withoutKing = occupied ^ (1 << ksq)
+        for to in squares(KING_ATTACKS[ksq] & ~own):
+            if not self.attacked(to, them, withoutKing):
+                moves.append(ksq | to << 6)
+
+        checkers = self.attackersTo(ksq, them, occupied)
+        if checkers & (checkers - 1):
+            # Double check, only the king can move
+            return moves
+        if checkers:
+            target = checkers | BETWEEN[ksq][lsb(checkers)]
+        else:
+            target = FULL
+            self.castlingMoves(moves, us, ksq, occupied)
+        target &= ~own
+        pinned = self.pinned(ksq, us, occupied)
+
+        for frm in squares(bb[KNIGHT] & ~pinned):
+            for to in squares(KNIGHT_ATTACKS[frm] & target):
+                moves.append(frm | to << 6)
+        for frm in squares(bb[BISHOP] | bb[QUEEN]):
+            attacks = bishopAttacks(frm, occupied) & target
+            if pinned >> frm & 1:
+                attacks &= LINE[ksq][frm]
+            for to in squares(attacks):
+                moves.append(frm | to << 6)
+        for frm in squares(bb[ROOK] | bb[QUEEN]):
+            attacks = rookAttacks(frm, occupied) & target
+            if pinned >> frm & 1:
+                attacks &= LINE[ksq][frm]
+            for to in squares(attacks):
+                moves.append(frm | to << 6)
+
+        self.pawnMoves(moves, us, ksq, occupied, enemy, target, pinned)
+        return moves
+
+    def castlingMoves(self, moves, us, ksq, occupied):
+        """Adds castling moves. King and rook unmoved, squares between them empty,
+        and the king does not pass through or land on an attacked square
+        :param moves: list
+        :param us: int
+        :param ksq: int
+        :param occupied: int"""
+        them = us ^ 1
+        row = 0 if us == WHITE else 56
+        short = WHITE_SHORT if us == WHITE else BLACK_SHORT
+        long = WHITE_LONG if us == WHITE else BLACK_LONG
+        if self.castling & short and not occupied & (0b01100000 << row):
+            if not self.attacked(row + 5, them, occupied) and not self.attacked(row + 6, them, occupied):
+                moves.append(ksq | (row + 6) << 6)
+        if self.castling & long and not occupied & (0b00001110 << row):
+            if not self.attacked(row + 3, them, occupied) and not self.attacked(row + 2, them, occupied):
+                moves.append(ksq | (row + 2) << 6)
+
+    def pawnMoves(self, moves, us, ksq, occupied, enemy, target, pinned):
+        """Adds pawn pushes, captures, promotions and en passant, whole sets of pawns at a time
+        :param moves: list
+        :param us: int
+        :param ksq: int
+        :param occupied: int
+        :param enemy: int
+        :param target: int, squares that resolve a check (everything if not in check)
+        :param pinned: int"""
+        pawns = self.bb[us][PAWN]
+        empty = ~occupied & FULL
+        if us == WHITE:
+            single = (pawns << 8) & empty
+            double = ((single & (RANK_1 << 16)) << 8) & empty
+            left = ((pawns & ~FILE_A) << 7) & FULL
+            right = ((pawns & ~FILE_H) << 9) & FULL
+            forward = 8
+            lastRank = RANK_8
+        else:
+            single = (pawns >> 8) & empty
+            double = ((single & (RANK_1 << 40)) >> 8) & empty
+            left = (pawns & ~FILE_A) >> 9
+            right = (pawns & ~FILE_H) >> 7
+            forward = -8
+            lastRank = RANK_1
+        for targets, shift in ((single & target, forward), (double & target, 2 * forward),
+                               (left & enemy & target, forward - 1), (right & enemy & target, forward + 1)):
+            for to in squares(targets):
+                frm = to - shift
+                if pinned >> frm & 1 and not LINE[ksq][frm] >> to & 1:
+                    continue
+                if 1 << to & lastRank:
+                    for promotion in (QUEEN, ROOK, BISHOP, KNIGHT):
+                        moves.append(frm | to << 6 | promotion << 12)
+                else:
+                    moves.append(frm | to << 6)
+        if self.ep >= 0:
+            # En passant takes two pieces off one row at once, so it is tried rather than filtered
+            for frm in squares(PAWN_ATTACKS[us ^ 1][self.ep] & pawns):
+                move = frm | self.ep << 6
+                self.push(move)
+                if not self.inCheck(us):
+                    moves.append(move)
+                self.pop()
+
+    def push(self, move):
+        """Plays an int encoded move for the side to move. Nothing is checked
+        :param move: int"""
+        frm = move & 63
+        to = (move >> 6) & 63
+        promotion = move >> 12
+        us = self.turn
+        them = us ^ 1
+        code = self.board[frm]
+        kind = code & 7
+        captured = self.board[to]
+        self.history.append((move, captured, self.castling, self.ep, self.halfmoveClock))
+        if kind == PAWN or captured >= 0:
+            self.halfmoveClock = 0
+        else:
+            self.halfmoveClock += 1
+        if us == BLACK:
+            self.fullmoveNumber += 1
+        bb = self.bb[us]
+        fromTo = 1 << frm | 1 << to
+
+        if captured >= 0:
+            self.bb[them][captured & 7] ^= 1 << to
+            self.occ[them] ^= 1 << to
+        elif kind == PAWN and to == self.ep:
+            victim = to - 8 if us == WHITE else to + 8
+            self.bb[them][PAWN] ^= 1 << victim
+            self.occ[them] ^= 1 << victim
+            self.board[victim] = -1
+        bb[kind] ^= fromTo
+        self.occ[us] ^= fromTo
+        self.board[frm] = -1
+        self.board[to] = code
+        if promotion:
+            bb[PAWN] ^= 1 << to
+            bb[promotion] ^= 1 << to
+            self.board[to] = promotion | us << 3
+
+        self.ep = -1
+        if kind == PAWN and (to - frm == 16 or frm - to == 16):
+            self.ep = (frm + to) // 2
+        elif kind == KING:
+            if to - frm == 2 or frm - to == 2:
+                rookFrom, rookTo = (frm + 3, frm + 1) if to > frm else (frm - 4, frm - 1)
+                bb[ROOK] ^= 1 << rookFrom | 1 << rookTo
+                self.occ[us] ^= 1 << rookFrom | 1 << rookTo
+                self.board[rookTo] = self.board[rookFrom]
+                self.board[rookFrom] = -1
+            self.castling &= ~(WHITE_SHORT | WHITE_LONG) if us == WHITE else ~(BLACK_SHORT | BLACK_LONG)
+        if self.castling:
+            for sq, right in ((7, WHITE_SHORT), (0, WHITE_LONG), (63, BLACK_SHORT), (56, BLACK_LONG)):
+                if sq == frm or sq == to:
+                    self.castling &= ~right
+        self.turn = them
+
+    def pop(self):
+        """Takes back the last move played by push"""
+        move, captured, castling, ep, self.halfmoveClock = self.history.pop()
+        frm = move & 63
+        to = (move >> 6) & 63
+        promotion = move >> 12
+        them = self.turn
+        us = them ^ 1
+        self.turn = us
+        if us == BLACK:
+            self.fullmoveNumber -= 1
+        self.castling = castling
+        self.ep = ep
+        bb = self.bb[us]
+        if promotion:
+            bb[promotion] ^= 1 << to
+            bb[PAWN] ^= 1 << to
+            self.board[to] = PAWN | us << 3
+        code = self.board[to]
+        kind = code & 7
+        fromTo = 1 << frm | 1 << to
+        bb[kind] ^= fromTo
+        self.occ[us] ^= fromTo
+        self.board[frm] = code
+        self.board[to] = captured
+        if captured >= 0:
+            self.bb[them][captured & 7] ^= 1 << to
+            self.occ[them] ^= 1 << to
+        elif kind == PAWN and to == ep:
+            victim = to - 8 if us == WHITE else to + 8
+            self.bb[them][PAWN] ^= 1 << victim
+            self.occ[them] ^= 1 << victim
+            self.board[victim] = PAWN | them << 3
+        elif kind == KING and (to - frm == 2 or frm - to == 2):
+            rookFrom, rookTo = (frm + 3, frm + 1) if to > frm else (frm - 4, frm - 1)
+            bb[ROOK] ^= 1 << rookFrom | 1 << rookTo
+            self.occ[us] ^= 1 << rookFrom | 1 << rookTo
+            self.board[rookFrom] = self.board[rookTo]
+            self.board[rookTo] = -1
+
+    def updateMoves(self):
+        """Sets simpleMoves of the side to move from the legal moves, clears the other side,
+        and checks for checkmate or stalemate"""
+        for side in (self.white, self.black):
+            for piece in side.values():
+                piece.moves = EMPTY
+        moves = self.legalMoves()
+        targets = {}
+        for move in moves:
+            piece = self.squares[move & 63]
+            to = (move >> 6) & 63
+            if piece is not None:
+                found = targets.setdefault(piece, bytearray())
+                # Promotions come once per piece, the Piece keeps the square once
+                if to not in found:
+                    found.append(to)
+        for piece, found in targets.items():
+            piece.moves = bytes(found)
+        if not moves:
+            if self.inCheck():
+                self.winner = COLORS[self.turn ^ 1]
+            else:
+                self.winner = 'stalemate'
+
+    def move(self, piece: Piece, move):
+        """Moves a piece and updates board for next move. checks for checkmate or stalemate.
+        A pawn reaching the last row stays a pawn until promote is called, as in Chess.Game
+        :param piece: Piece
+        :param move: list or int"""
+        frm = piece.square
+        to = move if isinstance(move, int) else squareIndex(move)
+        color = COLORS.index(piece.color)
+        captured = self.squares[to]
+        if captured is None and piece.piece[0] == 'P' and to == self.ep:
+            captured = self.squares[to - 8 if color == WHITE else to + 8]
+        if captured is not None:
+            self.squares[captured.square] = None
+            captured.square = BANISHED
+        if piece.piece[0] == 'K' and abs(to - frm) == 2:
+            rook = self.ownSide(piece)['R2' if to > frm else 'R1']
+            self.squares[rook.square] = None
+            rook.square = (frm + to) // 2
+            self.squares[rook.square] = rook
+            rook.movesDone += 1
+        self.squares[frm] = None
+        self.squares[to] = piece
+        piece.square = to
+        piece.movesDone += 1
+
+        self.turn = color
+        self.played.append(encodeMove(frm, to))
+        self.push(frm | to << 6)
+        self.updateMoves()
+
+    def promote(self, piece: Piece, value):
+        """Promote a piece based on passed value, then regenerates moves since the new piece may give check
+        :param piece: Piece
+        :param value: str"""
+        sq = piece.square
+        color = COLORS.index(piece.color)
+        old = KINDS.index(piece.piece[0])
+        new = KINDS.index(value[0])
+        piece.piece = value
+        self.bb[color][old] ^= 1 << sq
+        self.bb[color][new] ^= 1 << sq
+        self.board[sq] = new | color << 3
+        if self.played and (self.played[-1] >> 6) & 63 == sq:
+            self.played[-1] = self.played[-1] & 0xFFF | new << 12
+        self.updateMoves()
+
+    def applyMove(self, code):
+        """Plays a move encoded by encodeMove, promotion included, if it is legal for the side to move
+        :param code: int
+        :return: Piece that moved"""
+        frm, to, promotion = decodeMove(code)
+        piece = self.squares[frm]
+        if piece is None or piece.color != COLORS[self.turn] or to not in piece.moves:
+            raise ValueError('Illegal move ' + format(code, '04x'))
+        lastRow = piece.piece[0] == 'P' and (to < 8 or to >= 56)
+        if lastRow != (0 < promotion < 5):
+            raise ValueError('Bad promotion in move ' + format(code, '04x'))
+        self.move(piece, to)
+        if promotion:
+            self.promote(piece, KINDS[promotion])
+        return piece
@@ -0,0 +1,166 @@
+import argparse
+import mmap
+import random
+import struct
+
+from Chess import KINDS, Game, decodeMove, encodeMove, moveName, squareIndex, squarePosition
+from Pgn import legalMoves, parseSan, playMove, readGames, sanMoves, startGame
+
+# File layout: MAGIC, then records sorted by position hash, best weighted move first within a position
+MAGIC = b'CHBOOK01'
+# Record: Zobrist position hash from Game.positionHash, move from Chess.encodeMove, weight
+RECORD = struct.Struct('>QHH')
+# Weight of a move for the side that played it, by game result
+RESULT_WEIGHTS = {'1-0': (2, 0), '0-1': (0, 2), '1/2-1/2': (1, 1), '*': (1, 1)}
+
+
+class OpeningBook:
+    """Opening book file read through mmap, so it opens instantly and worker processes share its pages.
+    Positions are found by binary search over the fixed width records"""
+
+    def __init__(self, path):
+        """:param path: str, book written by buildBook"""
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('Not an opening book: ' + path)
+        self.count = (len(self.data) - len(MAGIC)) // RECORD.size
+
+    def __len__(self):
+        return self.count
+
+    def record(self, i):
+        """Reads one record
+        :param i: int
+        :return: (int, int, int) key, move and weight"""
+        return RECORD.unpack_from(self.data, len(MAGIC) + i * RECORD.size)
+
+    def lookup(self, key):
+        """Moves stored for a position hash
+        :param key: int
+        :return: list of (int move, int weight)"""
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        moves = []
+        while low < self.count:
+            found, move, weight = self.record(low)
+            if found != key:
+                break
+            moves.append((move, weight))
+            low += 1
+        return moves
+
+    def probe(self, game: Game):
+        """Book moves of a game position
+        :param game: Game
+        :return: list of (int frm, int to, str promotion, int weight), best weighted first"""
+        legal = {piece.square: moves for piece, moves in legalMoves(game)}
+        moves = []
+        for move, weight in self.lookup(game.positionHash()):
+            frm, to, promotion = decodeMove(move)
+            # A hash collision must not play an illegal move
+            if to not in legal.get(frm, b''):
+                continue
+            moves.append((frm, to, KINDS[promotion] if promotion else '', weight))
+        return moves
+
+    def choose(self, game: Game, rnd=random):
+        """Picks a book move at random, in proportion to its weight
+        :param game: Game
+        :param rnd: random.Random
+        :return: (int frm, int to, str promotion) or None when out of book"""
+        moves = self.probe(game)
+        total = sum(move[3] for move in moves)
+        if not total:
+            return None
+        pick = rnd.randrange(total)
+        for frm, to, promotion, weight in moves:
+            if pick < weight:
+                return frm, to, promotion
+            pick -= weight
+
+    def close(self):
+        """Unmaps and closes the file"""
+        self.data.close()
+        self.file.close()
+
+
+def buildBook(paths, path, maxPly=20, minWeight=1, out=print):
+    """Compiles an opening book from PGN files, replaying every game through Game.move.
+    A move is weighted 2 for a win of the side playing it, 1 for a draw or unknown result and 0 for a loss,
+    summed over all games reaching the position
+    :param paths: list[str], PGN files
+    :param path: str, book file to write
+    :param maxPly: int, moves of each game taken into the book
+    :param minWeight: int, moves weighted less are left out
+    :param out: function used for output
+    :return: dict with games, errors, positions and records counts"""
+    weights = {}
+    games = 0
+    errors = 0
+    for pgn in paths:
+        with open(pgn, encoding='utf-8', errors='replace') as stream:
+            for headers, movetext in readGames(stream):
+                games += 1
+                white, black = RESULT_WEIGHTS.get(headers.get('Result', '*'), (1, 1))
+                try:
+                    game = startGame(headers)
+                    for san in sanMoves(movetext)[:maxPly]:
+                        key = game.positionHash()
+                        piece, position, promotion = parseSan(game, san)
+                        move = encodeMove(piece.square, squareIndex(position),
+                                          KINDS.index(promotion) if promotion else 0)
+                        entry = (key, move)
+                        weights[entry] = weights.get(entry, 0) + (white if game.turn == 'white' else black)
+                        playMove(game, piece, position, promotion)
+                except ValueError as error:
+                    errors += 1
+                    out('Game ' + str(games) + ': ' + str(error))
+
+    records = sorted(((key, move, min(weight, 0xFFFF)) for (key, move), weight in weights.items()
+                      if weight >= minWeight), key=lambda record: (record[0], -record[2], record[1]))
+    with open(path, 'wb') as book:
+        book.write(MAGIC)
+        for record in records:
+            book.write(RECORD.pack(*record))
+    stats = {'games': games, 'errors': errors, 'positions': len({record[0] for record in records}),
+             'records': len(records)}
+    out('Games: ' + str(games) + '  Errors: ' + str(errors) + '  Positions: ' + str(stats['positions'])
+        + '  Records: ' + str(len(records)) + '  Bytes: ' + str(len(MAGIC) + len(records) * RECORD.size))
+    return stats
+
+
+def main(argv=None):
+    """Command line entry: python -m Book build PGN... --book FILE | python -m Book probe --book FILE [--fen FEN]"""
+    parser = argparse.ArgumentParser(description='Build or probe an opening book')
+    commands = parser.add_subparsers(dest='command', required=True)
+    buildParser = commands.add_parser('build', help='compile a book from PGN files')
+    buildParser.add_argument('pgn', nargs='+')
+    buildParser.add_argument('--book', default='book.bin')
+    buildParser.add_argument('--max-ply', type=int, default=20)
+    buildParser.add_argument('--min-weight', type=int, default=1)
+    probeParser = commands.add_parser('probe', help='list the book moves of a position')
+    probeParser.add_argument('--book', default='book.bin')
+    probeParser.add_argument('--fen', default=None, help='position, defaults to the start position')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        buildBook(args.pgn, args.book, args.max_ply, args.min_weight)
+        return 0
+    book = OpeningBook(args.book)
+    game = Game.from_fen(args.fen, lazy=True) if args.fen else Game(lazy=True)
+    for frm, to, promotion, weight in book.probe(game):
+        print(moveName(squarePosition(frm), squarePosition(to), promotion) + ' ' + str(weight))
+    book.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,8 +1,236 @@
-import copy
+import random
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+
+
+def squareIndex(position):
+    """Converts a board position to its index in the square map, None if off the board
+    :param position: list
+    :return: int or None"""
+    x = position[0]
+    y = position[1]
+    if x < 0 or x > 7 or y < 0 or y > 7:
+        return None
+    return x + 8 * y
+
+
+# Piece kinds in the order of the promotion field of an encoded move, 0 (pawn) for no promotion
+KINDS = 'PNBRQK'
+
+
+def encodeMove(frm, to, promotion=0):
+    """Packs a move into 16 bits: from square, to square and promotion kind (0 for none)
+    :param frm: int
+    :param to: int
+    :param promotion: int, index into KINDS
+    :return: int"""
+    return frm | to << 6 | promotion << 12
+
+
+def decodeMove(move):
+    """Unpacks a move made by encodeMove
+    :param move: int
+    :return: (int, int, int)"""
+    return move & 63, (move >> 6) & 63, move >> 12
+
+
+def moveName(frm, to, promotion=''):
+    """Coordinate notation of a move, like e2e4 or a7a8q
+    :param frm: list
+    :param to: list
+    :param promotion: str
+    :return: str"""
+    return (chr(ord('a') + frm[0]) + str(frm[1] + 1) + chr(ord('a') + to[0]) + str(to[1] + 1)
+            + promotion.lower())
+
+
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+# Single step attackers: (dx, dy, pieces attacking along it)
+STEP_ATTACKS = ((2, 1, 'N'), (2, -1, 'N'), (-2, 1, 'N'), (-2, -1, 'N'),
+                (1, 2, 'N'), (1, -2, 'N'), (-1, 2, 'N'), (-1, -2, 'N'),
+                (1, 0, 'K'), (-1, 0, 'K'), (0, 1, 'K'), (0, -1, 'K'),
+                (1, 1, 'K'), (1, -1, 'K'), (-1, 1, 'K'), (-1, -1, 'K'))
+# Sliding attackers: (dx, dy, pieces attacking along it)
+RAY_ATTACKS = ((1, 0, 'RQ'), (-1, 0, 'RQ'), (0, 1, 'RQ'), (0, -1, 'RQ'),
+               (1, 1, 'BQ'), (1, -1, 'BQ'), (-1, 1, 'BQ'), (-1, -1, 'BQ'))
+
+# Zobrist keys, fixed seed so hashes agree between processes and runs
+_zobrist = random.Random(20221203)
+# ZOBRIST_PIECES[color][kind][square], color 0 is white
+ZOBRIST_PIECES = [{kind: [_zobrist.getrandbits(64) for _ in range(64)] for kind in 'PNBRQK'} for _ in range(2)]
+ZOBRIST_BLACK = _zobrist.getrandbits(64)
+# One key per castling right, in KQkq order
+ZOBRIST_CASTLING = [_zobrist.getrandbits(64) for _ in range(4)]
+ZOBRIST_EP = [_zobrist.getrandbits(64) for _ in range(8)]
+
+
+def zobristKey(piece, index):
+    """Zobrist key of a piece standing on a square index
+    :param piece: Piece
+    :param index: int
+    :return: int"""
+    return ZOBRIST_PIECES[piece.color == 'black'][piece.piece[0]][index]
+
+
+class MoveCache:
+    """Size bounded, least recently used cache from position hash to generated moves.
+    One cache can be shared by many Game objects, hits and misses are counted to tune its size"""
+
+    def __init__(self, size=4096):
+        """:param size: int, most positions kept"""
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the entry for a position hash, or None
+        :param key: int
+        :return: tuple or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        """Stores an entry, dropping the least recently used one if full
+        :param key: int
+        :param entry: tuple"""
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        """Returns hit/miss counters and fill
+        :return: dict"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'size': self.size,
+                    'hitRate': self.hits / lookups if lookups else 0.0}
+
+
+# Square of pieces that are off the board
+BANISHED = -1
+# Empty move list, shared by all pieces
+EMPTY = b''
+# Values of Game.winner for a drawn game
+DRAWS = ('stalemate', 'repetition', 'fifty')
+# Values of Game.winner by their result code in a game record
+RESULTS = ('', 'white', 'black') + DRAWS
+# Game record: RECORD header, the start FEN if not the standard start, then the moves, 16 bits each big endian
+RECORD_MAGIC = b'CHGR'
+# Header: magic, result code, number of moves, bytes of the start FEN
+RECORD = struct.Struct('>4sBHH')
+
+
+def squarePosition(index):
+    """Converts a square index back to a board position, [20, 20] if off the board
+    :param index: int
+    :return: list"""
+    if index < 0:
+        return [20, 20]
+    return [index % 8, index // 8]
+
+
+def squareBytes(moves):
+    """Packs positions or square indexes into a bytes move list, dropping those off the board
+    :param moves: iterable of list or int
+    :return: bytes"""
+    if isinstance(moves, bytes):
+        return moves
+    packed = bytearray()
+    for move in moves:
+        index = move if isinstance(move, int) else squareIndex(move)
+        if index is not None and 0 <= index < 64:
+            packed.append(index)
+    return bytes(packed)
+
+
+def directionTable(directions, distance):
+    """Per square tuple of move directions, each the squares walked in order until the board edge
+    :param directions: tuple of (dx, dy)
+    :param distance: int, most squares along a direction
+    :return: list[tuple[tuple[int]]]"""
+    table = []
+    for index in range(64):
+        rays = []
+        for dx, dy in directions:
+            x = index % 8 + dx
+            y = index // 8 + dy
+            ray = []
+            while 0 <= x <= 7 and 0 <= y <= 7 and len(ray) < distance:
+                ray.append(x + 8 * y)
+                x += dx
+                y += dy
+            rays.append(tuple(ray))
+        table.append(tuple(rays))
+    return table
+
+
+# Directions of each piece in the order moves were always listed: up, down, left, right, then diagonals
+MOVE_DIRECTIONS = {
+    'K': directionTable(((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)), 1),
+    'N': directionTable(((2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (1, -2), (-1, 2), (-1, -2)), 1),
+    'Q': directionTable(((0, 1), (0, -1), (-1, 0), (1, 0), (1, 1), (-1, 1), (1, -1), (-1, -1)), 7),
+    'B': directionTable(((1, 1), (-1, 1), (1, -1), (-1, -1)), 7),
+    'R': directionTable(((0, 1), (0, -1), (-1, 0), (1, 0)), 7),
+}
+
+
+class SquareList:
+    """List of [x, y] positions view of a bytes move list on a Piece, for code written against the list API
+    like Graphics.showMoves. Appending stores the new move back on the piece"""
+    __slots__ = ('owner', 'attr')
+
+    def __init__(self, owner, attr):
+        """:param owner: Piece
+        :param attr: str, 'moves' or 'attacks'"""
+        self.owner = owner
+        self.attr = attr
+
+    def __contains__(self, position):
+        index = position if isinstance(position, int) else squareIndex(position)
+        return index is not None and index in getattr(self.owner, self.attr)
+
+    def __iter__(self):
+        for index in getattr(self.owner, self.attr):
+            yield [index % 8, index // 8]
+
+    def __len__(self):
+        return len(getattr(self.owner, self.attr))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [[index % 8, index // 8] for index in getattr(self.owner, self.attr)[i]]
+        index = getattr(self.owner, self.attr)[i]
+        return [index % 8, index // 8]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def append(self, position):
+        """Adds a move
+        :param position: list or int"""
+        setattr(self.owner, self.attr, getattr(self.owner, self.attr) + squareBytes((position,)))
 
 
 class Piece:
-    """Represents a Chess Piece"""
+    """Represents a Chess Piece. Its square is kept as an index 0..63, BANISHED off the board,
+    and its moves as bytes of square indexes. position, simpleMoves and pawnAttackMoves give the [x, y] view"""
+    __slots__ = ('color', 'piece', 'square', 'movesDone', 'possibleMoves', 'moves', 'attacks', 'game')
 
     def __init__(self, color, piece, pos):
         """Chess piece contains color, type of piece(pawn, king, etc.), Position on board,
@@ -12,30 +240,143 @@ class Piece:
         self.piece = piece
         self.position = pos
         self.movesDone = 0
-        # 2D array, containing a direction and all moves in that direction
+        # 2D array, containing a direction and all squares in that direction, only kept while generating
         self.possibleMoves = []
-        # 1D array, containing all moves possible
-        self.simpleMoves = []
-        # 1D array, containing places where pawn can attack
-        self.pawnAttackMoves = []
+        # Squares of all moves possible
+        self.moves = EMPTY
+        # Squares where pawn can attack
+        self.attacks = EMPTY
+        # Lazy Game generating moves on first access to simpleMoves, None otherwise
+        self.game = None
+
+    @property
+    def position(self):
+        """:return: list, [x, y] of the square, [20, 20] if off the board"""
+        return squarePosition(self.square)
+
+    @position.setter
+    def position(self, pos):
+        index = pos if isinstance(pos, int) else squareIndex(pos)
+        self.square = BANISHED if index is None else index
+
+    @property
+    def simpleMoves(self):
+        """:return: SquareList, all moves possible as [x, y]"""
+        game = self.game
+        if game is not None and game.stale:
+            game.generate()
+        return SquareList(self, 'moves')
+
+    @simpleMoves.setter
+    def simpleMoves(self, moves):
+        self.moves = squareBytes(moves)
+
+    @property
+    def pawnAttackMoves(self):
+        """:return: SquareList, places where pawn can attack as [x, y]"""
+        game = self.game
+        if game is not None and game.stale:
+            game.generate()
+        return SquareList(self, 'attacks')
+
+    @pawnAttackMoves.setter
+    def pawnAttackMoves(self, moves):
+        self.attacks = squareBytes(moves)
 
     def simpleMoveMaker(self):
-        """Takes all possible moves and turns them into a 1D array called simpleMoves"""
-        moves = []
-        for arr in self.possibleMoves:
-            for direction in arr:
-                if direction:
-                    moves.append(direction)
-        self.simpleMoves = moves
+        """Takes all possible moves and turns them into the flat moves list, then drops the directions"""
+        self.moves = bytes(index for direction in self.possibleMoves for index in direction)
+        self.possibleMoves = []
         return self
 
 
+# Piece names of one side, in the order promoted or extra pieces fall back to pawn names
+NAMES = {'K': ['K0'], 'Q': ['Q0'], 'R': ['R1', 'R2'], 'B': ['B1', 'B2'], 'N': ['N1', 'N2'],
+         'P': ['P' + str(i) for i in range(1, 9)]}
+
+
+def fenPieces(placement, castling):
+    """Builds white and black Piece dicts, named like Chess.Game, from the first two FEN fields.
+    Rooks on their home corners get R1/R2 so castling keeps working, promoted pieces take free pawn names,
+    and names not on the board are banished to [20, 20]
+    :param placement: str
+    :param castling: str
+    :return: (dict[str, Piece], dict[str, Piece])"""
+    found = []
+    for row, rank in enumerate(placement.split('/')):
+        y = 7 - row
+        x = 0
+        for char in rank:
+            if char.isdigit():
+                x += int(char)
+                continue
+            found.append(('white' if char.isupper() else 'black', char.upper(), [x, y]))
+            x += 1
+
+    sides = {'white': {}, 'black': {}}
+    # Kings, corner rooks, other rooks and pawns first, so they get their usual names.
+    # A rook off its corner must not take R1/R2 from the castling rook
+    def rank(entry):
+        color, kind, position = entry
+        if kind == 'R':
+            return 1 if position in ([0, 0 if color == 'white' else 7], [7, 0 if color == 'white' else 7]) else 2
+        return {'K': 0, 'P': 3}.get(kind, 4)
+    order = sorted(found, key=rank)
+    for color, kind, position in order:
+        side = sides[color]
+        home = 0 if color == 'white' else 7
+        names = NAMES[kind]
+        if kind == 'R' and position == [0, home]:
+            names = ['R1', 'R2']
+        elif kind == 'R' and position == [7, home]:
+            names = ['R2', 'R1']
+        elif kind == 'P':
+            names = ['P' + str(position[0] + 1)] + names
+        name = next((n for n in names + NAMES['P'] if n not in side), None)
+        if name is None:
+            raise ValueError('Too many ' + color + ' pieces in FEN: ' + placement)
+        piece = Piece(color, kind, position)
+        # Pawns off their starting row and pieces off their home square count as moved
+        if kind == 'P':
+            piece.movesDone = 0 if position[1] == (1 if color == 'white' else 6) else 1
+        elif kind in 'KR':
+            piece.movesDone = 1
+        side[name] = piece
+
+    for color, side in sides.items():
+        home = 0 if color == 'white' else 7
+        short, long = ('K', 'Q') if color == 'white' else ('k', 'q')
+        for kind, names in NAMES.items():
+            for name in names:
+                if name not in side:
+                    side[name] = Piece(color, kind, [20, 20])
+                    side[name].movesDone = 1
+        if 'K0' not in [n for n in side if side[n].position != [20, 20]]:
+            raise ValueError('No ' + color + ' king in FEN: ' + placement)
+        if side['K0'].position == [4, home] and (short in castling or long in castling):
+            side['K0'].movesDone = 0
+            if short in castling and side['R2'].position == [7, home]:
+                side['R2'].movesDone = 0
+            if long in castling and side['R1'].position == [0, home]:
+                side['R1'].movesDone = 0
+    return sides['white'], sides['black']
+
+
 class Game:
     """Chess Game object. Contains two sides, and a winner. Instead of a Board with pieces on it,
         has all pieces from both sides and their positions"""
 
-    def __init__(self):
-        """Create both sides and all the Piece objects for each side"""
+    def __init__(self, generator='trial', cache=None, lazy=False):
+        """Create both sides and all the Piece objects for each side
+        :param generator: str, 'trial' tries every move to filter out checks,
+            'pins' filters moves using checkers and pinned pieces
+        :param cache: MoveCache, reuses moves generated for a position seen before, None to always generate
+        :param lazy: bool, only generate moves of the side to move, on first access to simpleMoves or winner"""
+        self.generator = generator
+        self.cache = cache
+        self.lazy = lazy
+        # Lazy mode: moves of the position have not been generated yet
+        self.stale = False
         self.black = {'R1': 0, 'N1': 0, 'B1': 0, 'Q0': 0, 'K0': 0, 'B2': 0, 'N2': 0, 'R2': 0,
                       'P1': 0, 'P2': 0, 'P3': 0, 'P4': 0, 'P5': 0, 'P6': 0, 'P7': 0, 'P8': 0}
 
@@ -43,6 +384,14 @@ class Game:
                       'P1': 0, 'P2': 0, 'P3': 0, 'P4': 0, 'P5': 0, 'P6': 0, 'P7': 0, 'P8': 0}
 
         self.winner = ''
+        # Side to move, square a pawn can be taken on en passant, and FEN move counters
+        self.turn = 'white'
+        self.epSquare = None
+        self.halfmoveClock = 0
+        self.fullmoveNumber = 1
+        # Moves played with move, encoded by encodeMove, and the FEN they start from, None for the start position
+        self.played = array('H')
+        self.startFen = None
 
         self.black['R1'] = Piece('black', 'R', [0, 7])
         self.black['N1'] = Piece('black', 'N', [1, 7])
@@ -66,7 +415,173 @@ class Game:
         for i in range(1, 9):
             self.white['P' + str(i)] = Piece('white', 'P', [i - 1, 1])
 
+        # 64 entry square index, maps x + 8 * y to the Piece standing there
+        self.squares = [None] * 64
+        self.indexBoard()
+        # Times each position hash occurred since the last pawn move or capture, earlier ones cannot come back
+        self.history = {self.positionHash(): 1}
+
+        if lazy:
+            self.stale = True
+        else:
+            self.possibleMoves()
+
+    def indexBoard(self):
+        """Rebuilds the square index and the Zobrist hash of piece placement from the positions of all pieces"""
+        self.squares = [None] * 64
+        self.hash = 0
+        for side in (self.white, self.black):
+            for piece in side.values():
+                if self.lazy:
+                    piece.game = self
+                index = piece.square
+                if index >= 0:
+                    self.squares[index] = piece
+                    self.hash ^= zobristKey(piece, index)
+
+    def setPosition(self, piece: Piece, position):
+        """Places a piece on a position, keeping the square index and Zobrist hash up to date
+        :param piece: Piece
+        :param position: list"""
+        index = squareIndex(position)
+        self.setSquare(piece, BANISHED if index is None else index)
+
+    def setSquare(self, piece: Piece, index):
+        """Places a piece on a square index, BANISHED to take it off the board
+        :param piece: Piece
+        :param index: int"""
+        old = piece.square
+        if old >= 0:
+            if self.squares[old] is piece:
+                self.squares[old] = None
+            self.hash ^= zobristKey(piece, old)
+        if index >= 0:
+            self.squares[index] = piece
+            self.hash ^= zobristKey(piece, index)
+        piece.square = index
+
+    def castlingRights(self):
+        """Castling rights as 4 flags in KQkq order, from movesDone of kings and rooks
+        :return: list[bool]"""
+        rights = []
+        for side, home in ((self.white, 0), (self.black, 56)):
+            king = side['K0'].movesDone == 0 and side['K0'].square == home + 4
+            rights.append(king and side['R2'].movesDone == 0 and side['R2'].square == home + 7)
+            rights.append(king and side['R1'].movesDone == 0 and side['R1'].square == home)
+        return rights
+
+    def positionHash(self):
+        """Zobrist hash of the position: placement, side to move, castling rights and en passant file. As in
+        Polyglot, the en passant file only counts when a pawn of the side to move stands next to the pawn to take,
+        so positions that only differ by a capture nobody can make are the same for repetitions
+        :return: int"""
+        key = self.hash
+        if self.turn == 'black':
+            key ^= ZOBRIST_BLACK
+        for right, rightKey in zip(self.castlingRights(), ZOBRIST_CASTLING):
+            if right:
+                key ^= rightKey
+        if self.epSquare is not None and self.canTakeEnPassant():
+            key ^= ZOBRIST_EP[self.epSquare[0]]
+        return key
+
+    def canTakeEnPassant(self):
+        """A pawn of the side to move stands beside the pawn that just made a double step
+        :return: bool"""
+        file = self.epSquare[0]
+        # The pawn that made the double step is one row behind its en passant square
+        row = self.epSquare[1] + (-1 if self.turn == 'white' else 1)
+        for beside in (file - 1, file + 1):
+            if 0 <= beside < 8:
+                piece = self.squares[beside + 8 * row]
+                if piece is not None and piece.piece[0] == 'P' and piece.color == self.turn:
+                    return True
+        return False
+
+    @property
+    def winner(self):
+        """'white' or 'black' after checkmate, one of DRAWS, or '' while the game goes on
+        :return: str"""
+        if self.stale:
+            self.generate()
+        return self.result
+
+    @winner.setter
+    def winner(self, value):
+        self.result = value
+
+    @classmethod
+    def from_fen(cls, fen, generator='trial', lazy=False):
+        """Creates a Game set up at a FEN position, legal moves ready for the side to move
+        :param fen: str
+        :param generator: str, legal move filter, see __init__
+        :param lazy: bool, see __init__
+        :return: Game"""
+        game = cls(generator, lazy=lazy)
+        game.setFen(fen)
+        return game
+
+    def setFen(self, fen):
+        """Replaces the position with a FEN position. Castling rights become movesDone of kings and rooks,
+        promoted pieces take free pawn names
+        :param fen: str"""
+        fields = fen.split()
+        castling = fields[2] if len(fields) > 2 else '-'
+        self.white, self.black = fenPieces(fields[0], castling)
+        self.turn = 'black' if len(fields) > 1 and fields[1] == 'b' else 'white'
+        ep = fields[3] if len(fields) > 3 else '-'
+        self.epSquare = None if ep == '-' else [ord(ep[0]) - ord('a'), int(ep[1]) - 1]
+        self.halfmoveClock = int(fields[4]) if len(fields) > 4 else 0
+        self.fullmoveNumber = int(fields[5]) if len(fields) > 5 else 1
+        self.winner = ''
+        self.played = array('H')
+        self.startFen = fen
+        self.indexBoard()
+        self.history = {self.positionHash(): 1}
+        if self.lazy:
+            self.stale = True
+            return
         self.possibleMoves()
+        if self.epSquare is not None:
+            # Replay the double step onto the pawn that made it
+            step = -1 if self.turn == 'white' else 1
+            pawn = self.getPiece([self.epSquare[0], self.epSquare[1] + step])
+            if pawn is not None:
+                self.enPassant(pawn, [self.epSquare[0], self.epSquare[1] - step])
+        if not self.moveChecker(self.turn):
+            king = self.white['K0'] if self.turn == 'white' else self.black['K0']
+            if self.isCheck(king):
+                self.winner = 'black' if self.turn == 'white' else 'white'
+            else:
+                self.winner = 'stalemate'
+        else:
+            self.winner = self.draw()
+
+    def to_fen(self):
+        """Returns the position as FEN
+        :return: str"""
+        rows = []
+        for y in range(7, -1, -1):
+            row = ''
+            empty = 0
+            for x in range(8):
+                piece = self.squares[x + 8 * y]
+                if piece is None:
+                    empty += 1
+                    continue
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                row += piece.piece[0] if piece.color == 'white' else piece.piece[0].lower()
+            if empty:
+                row += str(empty)
+            rows.append(row)
+        castling = ''.join(flag for flag, right in zip('KQkq', self.castlingRights()) if right)
+        ep = '-'
+        if self.epSquare is not None:
+            ep = chr(ord('a') + self.epSquare[0]) + str(self.epSquare[1] + 1)
+        return ' '.join(('/'.join(rows), 'w' if self.turn == 'white' else 'b', castling or '-', ep,
+                         str(self.halfmoveClock), str(self.fullmoveNumber)))
 
     def otherSide(self, piece: Piece):
         """Returns dictionary of other team as passed piece
@@ -93,102 +608,47 @@ class Game:
         """Places moves in all directions possible based on given piece
         :param piece: Piece object
         :return: Piece object"""
-
-        # King moves in 8D, only 1 square
-        if piece.piece[0] == 'K':
-            x = piece.position[0]
-            y = piece.position[1]
-            piece.possibleMoves = [[[x + 1, y]], [[x - 1, y]], [[x, y + 1]], [[x, y - 1]],
-                                   [[x + 1, y + 1]], [[x + 1, y - 1]], [[x - 1, y + 1]], [[x - 1, y - 1]]]
-
-        # Knight moves in 8D, 2 squares along an axis and 1 along another
-        if piece.piece[0] == 'N':
-            x = piece.position[0]
-            y = piece.position[1]
-            piece.possibleMoves = [[[x + 2, y + 1]], [[x + 2, y - 1]], [[x - 2, y + 1]], [[x - 2, y - 1]],
-                                   [[x + 1, y + 2]], [[x + 1, y - 2]], [[x - 1, y + 2]], [[x - 1, y - 2]]]
-
-        # Queen moves in 8D, Diagonal, Horizontal, or Vertical
-        if piece.piece[0] == 'Q':
-            tr = []
-            tl = []
-            br = []
-            bl = []
-            up = []
-            down = []
-            left = []
-            right = []
-            for i in range(1, 8):
-                tr.append([piece.position[0] + i, piece.position[1] + i])
-                br.append([piece.position[0] + i, piece.position[1] - i])
-                tl.append([piece.position[0] - i, piece.position[1] + i])
-                bl.append([piece.position[0] - i, piece.position[1] - i])
-                up.append([piece.position[0], i + piece.position[1]])
-                down.append([piece.position[0], piece.position[1] - i])
-                left.append([piece.position[0] - i, piece.position[1]])
-                right.append([piece.position[0] + i, piece.position[1]])
-            piece.possibleMoves = [up, down, left, right, tr, tl, br, bl]
+        index = piece.square
+        if index < 0:
+            piece.possibleMoves = []
+            piece.attacks = EMPTY
+            return piece
 
         # Pawns can move up to 2 squares on first move, and can move diagonally 1 square if enemy piece is there
         if piece.piece[0] == 'P':
-            x = piece.position[0]
-            y = piece.position[1]
-
-            moves = []
-            captures = []
+            x = index % 8
+            y = index // 8
+            squares = self.squares
             if piece.color == 'white':
-                if self.getPiece([x, y + 1]) is None:
-                    moves.append([x, y + 1])
-
-                if piece.movesDone == 0 and self.getPiece([x, y + 2]) is None and self.getPiece([x, y + 1]) is None:
-                    moves.append([x, y + 2])
-
-                for take in self.black.values():
-                    if take.position == [x + 1, y + 1] or take.position == [x - 1, y + 1]:
-                        captures.append(take.position)
-                piece.pawnAttackMoves = [[x + 1, y + 1], [x - 1, y + 1]]
-
-            if piece.color == 'black':
-                if self.getPiece([x, y - 1]) is None:
-                    moves.append([x, y - 1])
-
-                if piece.movesDone == 0 and self.getPiece([x, y - 2]) is None and self.getPiece([x, y - 1]) is None:
-                    moves.append([x, y - 2])
-
-                for take in self.white.values():
-                    if take.position == [x + 1, y - 1] or take.position == [x - 1, y - 1]:
-                        captures.append(take.position)
-                piece.pawnAttackMoves = [[x + 1, y - 1], [x - 1, y - 1]]
-            piece.possibleMoves = []
+                step = 8
+                enemy = 'black'
+                row = y + 1
+            else:
+                step = -8
+                enemy = 'white'
+                row = y - 1
+            moves = []
+            attacks = []
+            if 0 <= row <= 7:
+                if squares[index + step] is None:
+                    moves.append(index + step)
+                    home = index + 2 * step
+                    if piece.movesDone == 0 and 0 <= home < 64 and squares[home] is None:
+                        moves.append(home)
+                for i in (x + 1, x - 1):
+                    if 0 <= i <= 7:
+                        attacks.append(i + 8 * row)
             # Append normal moves and captures
-            for move in moves:
-                piece.possibleMoves.append([move])
-            for move in captures:
-                piece.possibleMoves.append([move])
-        # Bishops move in 4D, diagonally
-        if piece.piece[0] == 'B':
-            tr = []
-            tl = []
-            br = []
-            bl = []
-            for i in range(1, 8):
-                tr.append([piece.position[0] + i, piece.position[1] + i])
-                br.append([piece.position[0] + i, piece.position[1] - i])
-                tl.append([piece.position[0] - i, piece.position[1] + i])
-                bl.append([piece.position[0] - i, piece.position[1] - i])
-            piece.possibleMoves = [tr, tl, br, bl]
-        # Rooks move in 4D, Horizontal or Vertical
-        if piece.piece[0] == 'R':
-            up = []
-            down = []
-            right = []
-            left = []
-            for i in range(1, 8):
-                up.append([piece.position[0], i + piece.position[1]])
-                down.append([piece.position[0], piece.position[1] - i])
-                left.append([piece.position[0] - i, piece.position[1]])
-                right.append([piece.position[0] + i, piece.position[1]])
-            piece.possibleMoves = [up, down, left, right]
+            piece.possibleMoves = [(move,) for move in moves]
+            for take in attacks:
+                target = squares[take]
+                if target is not None and target.color == enemy:
+                    piece.possibleMoves.append((take,))
+            piece.attacks = bytes(attacks)
+            return piece
+
+        # Other pieces move along their directions from the table, already cut at the board edge
+        piece.possibleMoves = list(MOVE_DIRECTIONS[piece.piece[0]][index])
         return piece
 
     def clean(self, piece: Piece):
@@ -196,63 +656,56 @@ class Game:
         :param piece: Piece object
         :return: Piece object"""
         for i in range(len(piece.possibleMoves)):
-            direction = []
-            for point in piece.possibleMoves[i]:
-                if not (point[0] < 0 or point[0] > 7 or point[1] < 0 or point[1] > 7):
-                    direction.append(point)
-            piece.possibleMoves[i] = direction
+            direction = piece.possibleMoves[i]
+            if direction and not all(0 <= point < 64 for point in direction):
+                piece.possibleMoves[i] = tuple(point for point in direction if 0 <= point < 64)
         return piece
 
     def ownPiece(self, piece: Piece):
         """Removes moves where own pieces are standing
         :param piece: Piece object
         :return: Piece object"""
+        squares = self.squares
         for direction in range(len(piece.possibleMoves)):
-            moves = piece.possibleMoves[direction][:]
-            if piece.color == 'black':
-                for point in self.black.values():
-                    if point.position in moves:
-                        # If own piece in path, remove moves past the own piece, inclusive
-                        moves = moves[0:moves.index(point.position)]
-            if piece.color == 'white':
-                for point in self.white.values():
-                    if point.position in moves:
-                        moves = moves[0:moves.index(point.position)]
-            piece.possibleMoves[direction] = moves
+            moves = piece.possibleMoves[direction]
+            for i in range(len(moves)):
+                point = squares[moves[i]]
+                if point is not None and point.color == piece.color:
+                    # If own piece in path, remove moves past the own piece, inclusive
+                    piece.possibleMoves[direction] = moves[0:i]
+                    break
         return piece
 
     def otherPiece(self, piece: Piece):
         """Removes moves past opponent pieces
         :param piece: Piece object
         :return: Piece object"""
+        squares = self.squares
         for direction in range(len(piece.possibleMoves)):
-            moves = piece.possibleMoves[direction][:]
-            if piece.color == 'black':
-                for point in self.white.values():
-                    if point.position in moves:
-                        # If enemy piece in path, remove moves past the enemy piece
-                        moves = moves[0:moves.index(point.position) + 1]
-            if piece.color == 'white':
-                for point in self.black.values():
-                    if point.position in moves:
-                        moves = moves[0:moves.index(point.position) + 1]
-            piece.possibleMoves[direction] = moves
+            moves = piece.possibleMoves[direction]
+            for i in range(len(moves)):
+                point = squares[moves[i]]
+                if point is not None and point.color != piece.color:
+                    # If enemy piece in path, remove moves past the enemy piece
+                    piece.possibleMoves[direction] = moves[0:i + 1]
+                    break
         return piece
 
     def isCheck(self, king: Piece, pos=False):
         """Returns whether king passed as param is in check.
         True if in check. Can also pass in a position to compare against, instead of king's position
         :param king: Piece
-        :param pos: list
+        :param pos: list or int
         :return: bool"""
-        if pos:
-            square = pos
+        if pos is not False:
+            square = pos if isinstance(pos, int) else squareIndex(pos)
         else:
-            square = king.position
+            square = king.square
+        if square is None or square < 0:
+            return False
         for piece in self.otherSide(king).values():
-            for move in piece.simpleMoves:
-                if move == square:
-                    return True
+            if square in piece.moves:
+                return True
         return False
 
     def possibleMoves(self):
@@ -266,128 +719,525 @@ class Game:
             self.black[piece].simpleMoveMaker()
 
         # Setup Castling
+        self.castling('white')
+        self.castling('black')
+
+    def castling(self, color):
+        """Adds castling moves to the king of a side, once its rooks have their moves.
+        If neither rook nor king have moved, the rook can reach the square next to the king without capturing,
+        and king would not pass through check, and king not in check
+        :param color: str"""
+        if color == 'white':
+            side = self.white
+            enemy = 'black'
+            home = 0
+        else:
+            side = self.black
+            enemy = 'white'
+            home = 56
+        king = side['K0']
+        if king.movesDone != 0 or king.square < 0 or self.isAttacked(king.square, enemy):
+            return
+        for rook, transit, target in (('R1', home + 3, home + 2), ('R2', home + 5, home + 6)):
+            if side[rook].movesDone == 0 and transit in side[rook].moves and self.squares[transit] is None \
+                    and not self.isAttacked(transit, enemy):
+                king.moves += bytes((target,))
+
+    def sideMoves(self, color):
+        """Generates legal moves of one side only. The other side is left without moves, its attacks are
+        looked up from the square index when needed, and pieces off the board are skipped.
+        Returns False if the side has no legal move
+        :param color: str
+        :return: bool"""
+        side, other = (self.white, self.black) if color == 'white' else (self.black, self.white)
+        for piece in other.values():
+            piece.moves = EMPTY
+        for piece in side.values():
+            if piece.square < 0:
+                piece.moves = EMPTY
+                piece.attacks = EMPTY
+                continue
+            self.otherPiece(self.ownPiece(self.allMoves(piece))).simpleMoveMaker()
+        self.castling(color)
+        if self.epSquare is not None:
+            target = squareIndex(self.epSquare)
+            # Only if the pawn that made the double step is there to be taken
+            pawn = self.squares[target - 8 if color == 'white' else target + 8]
+            if pawn is not None and pawn.piece[0] == 'P' and pawn.color != color:
+                for piece in side.values():
+                    if piece.piece[0] == 'P' and target in piece.attacks:
+                        piece.moves += bytes((target,))
+        return self.moveChecker(color)
 
-        piece = 'R1'
-        # If neither rook nor king have moved, and king would not pass through check, and king not in check
-        if self.white[piece].movesDone == 0 and self.white['K0'].movesDone == 0 and not self.isCheck(self.white['K0']):
-            if [3, 0] in self.white[piece].simpleMoves and not self.isCheck(self.white['K0'], pos=[3, 0]):
-                self.white['K0'].simpleMoves.append([2, 0])
-        if self.black[piece].movesDone == 0 and self.black['K0'].movesDone == 0 and not self.isCheck(self.black['K0']):
-            if [3, 7] in self.black[piece].simpleMoves and not self.isCheck(self.black['K0'], pos=[3, 7]):
-                self.black['K0'].simpleMoves.append([2, 7])
-
-        piece = "R2"
-        if self.white[piece].movesDone == 0 and self.white['K0'].movesDone == 0 and not self.isCheck(self.white['K0']):
-            if [5, 0] in self.white[piece].simpleMoves and not self.isCheck(self.white['K0'], pos=[5, 0]):
-                self.white['K0'].simpleMoves.append([6, 0])
-        if self.black[piece].movesDone == 0 and self.black['K0'].movesDone == 0 and not self.isCheck(self.black['K0']):
-            if [5, 7] in self.black[piece].simpleMoves and not self.isCheck(self.black['K0'], pos=[5, 7]):
-                self.black['K0'].simpleMoves.append([6, 7])
+    def generate(self):
+        """Lazy mode: generates the legal moves of the side to move and the winner, called on first access
+        to simpleMoves or winner after a move"""
+        self.stale = False
+        key = self.positionHash() if self.cache is not None else None
+        entry = self.cache.get(key) if key is not None else None
+        if entry is not None:
+            possible, check = self.loadMoves(entry)
+        else:
+            possible = self.sideMoves(self.turn)
+            king = self.white['K0'] if self.turn == 'white' else self.black['K0']
+            check = not possible and self.isAttacked(king.square, 'black' if self.turn == 'white' else 'white')
+            if key is not None:
+                self.cache.put(key, self.saveMoves(possible, check))
+        self.result = ''
+        if not possible:
+            if check:
+                self.result = 'black' if self.turn == 'white' else 'white'
+            else:
+                self.result = 'stalemate'
+        else:
+            self.result = self.draw()
+
+    def draw(self):
+        """Draw by the position occurring a third time or by 50 moves of each side without a pawn move or capture.
+        Both are lookups, the history and halfmove clock are kept up to date by move
+        :return: str, 'repetition', 'fifty' or ''"""
+        if self.history.get(self.positionHash(), 0) >= 3:
+            return 'repetition'
+        if self.halfmoveClock >= 100:
+            return 'fifty'
+        return ''
 
     def getPiece(self, position):
         """Gets piece at a board position
         :param position: list
         :return: Piece or None"""
-        for piece in self.black.values():
-            if piece.position == position:
-                return piece
-        for piece in self.white.values():
-            if piece.position == position:
-                return piece
-        return None
+        index = squareIndex(position)
+        if index is None:
+            return None
+        return self.squares[index]
+
+    def isAttacked(self, position, color):
+        """Returns whether any piece of the passed color attacks a position, using the square index
+        :param position: list or int
+        :param color: str
+        :return: bool"""
+        return len(self.attackers(position, color, first=True)) > 0
+
+    def attackers(self, position, color, first=False):
+        """Returns the pieces of the passed color attacking a position.
+        Stops at the first attacker found if first is set
+        :param position: list or int
+        :param color: str
+        :param first: bool
+        :return: list[Piece]"""
+        if isinstance(position, int):
+            x = position % 8
+            y = position // 8
+        else:
+            x = position[0]
+            y = position[1]
+        squares = self.squares
+        found = []
+        # Pawns attack diagonally forward, so look for them one row behind the square
+        j = y - 1 if color == 'white' else y + 1
+        if 0 <= j <= 7:
+            for i in (x - 1, x + 1):
+                if 0 <= i <= 7:
+                    piece = squares[i + 8 * j]
+                    if piece is not None and piece.color == color and piece.piece[0] == 'P':
+                        found.append(piece)
+                        if first:
+                            return found
+        for dx, dy, kinds in STEP_ATTACKS:
+            i = x + dx
+            j = y + dy
+            if 0 <= i <= 7 and 0 <= j <= 7:
+                piece = squares[i + 8 * j]
+                if piece is not None and piece.color == color and piece.piece[0] in kinds:
+                    found.append(piece)
+                    if first:
+                        return found
+        for dx, dy, kinds in RAY_ATTACKS:
+            i = x + dx
+            j = y + dy
+            while 0 <= i <= 7 and 0 <= j <= 7:
+                piece = squares[i + 8 * j]
+                if piece is not None:
+                    if piece.color == color and piece.piece[0] in kinds:
+                        found.append(piece)
+                        if first:
+                            return found
+                    break
+                i += dx
+                j += dy
+        return found
+
+    def pins(self, king: Piece):
+        """Finds pieces pinned to the passed king
+        :param king: Piece
+        :return: dict[Piece, list[int]] of pinned piece to the squares it may still move to"""
+        x = king.square % 8
+        y = king.square // 8
+        squares = self.squares
+        pinned = {}
+        for dx, dy, kinds in RAY_ATTACKS:
+            i = x + dx
+            j = y + dy
+            line = []
+            own = None
+            while 0 <= i <= 7 and 0 <= j <= 7:
+                line.append(i + 8 * j)
+                piece = squares[i + 8 * j]
+                if piece is not None:
+                    if piece.color == king.color:
+                        if own is not None:
+                            break
+                        own = piece
+                    else:
+                        # Enemy slider behind exactly one own piece pins it to this line
+                        if own is not None and piece.piece[0] in kinds:
+                            pinned[own] = line
+                        break
+                i += dx
+                j += dy
+        return pinned
 
     def moveChecker(self, color):
-        """Removes moves that lead to own check of from options. Returns False if there are no possible moves for provided side
+        """Removes moves that lead to own check of from options. Returns False if there are no possible moves for provided side.
+        Each move is tried in place with make_move and taken back with unmake_move.
         :param color: str
         :return: bool"""
-        original = copy.deepcopy(self)
+        if self.generator == 'pins':
+            return self.pinChecker(color)
         possible = False
         if color == 'white':
-            for piece in original.white:
-                moves = []
-                for move in original.white[piece].simpleMoves:
-                    new = copy.deepcopy(original)
-                    new.capture(new.white[piece], move)
-                    new.possibleMoves()
-                    if not new.isCheck(new.white['K0']):
-                        moves.append(move)
-                if moves:
-                    possible = True
-                self.white[piece].simpleMoves = moves
+            side = self.white
+            enemy = 'black'
         else:
-            for piece in original.black:
-                moves = []
-                for move in original.black[piece].simpleMoves:
-                    new = copy.deepcopy(original)
-                    new.capture(new.black[piece], move)
-                    new.possibleMoves()
-                    if not new.isCheck(new.black['K0']):
-                        moves.append(move)
-                    if moves:
-                        possible = True
-                self.black[piece].simpleMoves = moves
+            side = self.black
+            enemy = 'white'
+        king = side['K0']
+        for piece in side.values():
+            if not piece.moves:
+                continue
+            moves = bytes(move for move in piece.moves if self.tryMove(piece, move, king, enemy))
+            if moves:
+                possible = True
+            piece.moves = moves
         return possible
 
-    def capture(self, piece: Piece, move):
-        """Moves Pieces and Captures if necessary
+    def pinChecker(self, color):
+        """Same result as moveChecker, but works out checkers, pinned pieces and king danger squares
+        once for the position and filters moves against them instead of trying every move.
+        :param color: str
+        :return: bool"""
+        if color == 'white':
+            side = self.white
+            enemy = 'black'
+        else:
+            side = self.black
+            enemy = 'white'
+        king = side['K0']
+        kingIndex = king.square
+        checkers = self.attackers(kingIndex, enemy)
+        pinned = self.pins(king)
+
+        # Squares a non king move has to land on to get out of check
+        blocks = None
+        if len(checkers) == 1:
+            checker = checkers[0].square
+            blocks = [checker]
+            if checkers[0].piece[0] in 'RBQ':
+                dx = (checker % 8 > kingIndex % 8) - (checker % 8 < kingIndex % 8)
+                dy = (checker // 8 > kingIndex // 8) - (checker // 8 < kingIndex // 8)
+                square = kingIndex + dx + 8 * dy
+                while square != checker:
+                    blocks.append(square)
+                    square += dx + 8 * dy
+
+        possible = False
+        for piece in side.values():
+            if not piece.moves:
+                continue
+            moves = bytearray()
+            for move in piece.moves:
+                if piece is king:
+                    if king.movesDone == 0 and abs(move % 8 - kingIndex % 8) == 2:
+                        legal = self.tryMove(king, move, king, enemy)
+                    else:
+                        # King danger squares are looked up with the king lifted off the board,
+                        # so sliders attacking through the king's square are seen
+                        self.squares[kingIndex] = None
+                        legal = not self.isAttacked(move, enemy)
+                        self.squares[kingIndex] = king
+                elif len(checkers) > 1:
+                    legal = False
+                elif piece.piece[0] == 'P' and self.squares[move] is None and move in piece.attacks:
+                    # En passant removes two pieces from a line at once, try it out instead
+                    legal = self.tryMove(piece, move, king, enemy)
+                else:
+                    legal = (blocks is None or move in blocks) and (piece not in pinned or move in pinned[piece])
+                if legal:
+                    moves.append(move)
+            if moves:
+                possible = True
+            piece.moves = bytes(moves)
+        return possible
+
+    def tryMove(self, piece: Piece, move, king: Piece, enemy):
+        """Plays a move in place and returns whether it leaves the king safe
         :param piece: Piece
-        :param move: list"""
-        banish = [20, 20]
-        if self.getPiece(move) is not None:
-            self.getPiece(move).position = banish
+        :param move: list or int
+        :param king: Piece
+        :param enemy: str
+        :return: bool"""
+        undo = self.make_move(piece, move)
+        legal = not self.isAttacked(king.square, enemy)
+        self.unmake_move(undo)
+        return legal
+
+    def make_move(self, piece: Piece, move):
+        """Plays a move in place, capturing, castling and taking en passant as needed.
+        Only pieces and positions are touched, generated moves are left as they were.
+        :param piece: Piece
+        :param move: list or int
+        :return: tuple to pass to unmake_move"""
+        to = move if isinstance(move, int) else squareIndex(move)
+        captured = self.squares[to]
+        rook = None
         # En Passant
-        elif piece.piece[0] == 'P':
-            if move in piece.pawnAttackMoves and move in piece.simpleMoves:
+        if captured is None and piece.piece[0] == 'P':
+            if to in piece.attacks and to in piece.moves:
                 if piece.color == 'white':
-                    self.getPiece([move[0], move[1] - 1]).position = banish
+                    captured = self.squares[to - 8]
                 else:
-                    self.getPiece([move[0], move[1] + 1]).position = banish
+                    captured = self.squares[to + 8]
         # Castling
-        elif piece.piece[0] == 'K' and piece.movesDone == 0:
-            if move == [2, 0]:
-                self.ownSide(piece)['R1'].position = [3, 0]
-                self.ownSide(piece)['R1'].movesDone += 1
-            if move == [6, 0]:
-                self.ownSide(piece)['R2'].position = [5, 0]
-                self.ownSide(piece)['R2'].movesDone += 1
-            if move == [2, 7]:
-                self.ownSide(piece)['R1'].position = [3, 7]
-                self.ownSide(piece)['R1'].movesDone += 1
-            if move == [6, 7]:
-                self.ownSide(piece)['R2'].position = [5, 7]
-                self.ownSide(piece)['R2'].movesDone += 1
-        piece.position = move
+        elif captured is None and piece.piece[0] == 'K' and piece.movesDone == 0:
+            if to == 2 or to == 58:
+                rook = self.ownSide(piece)['R1']
+                rookMove = to + 1
+            if to == 6 or to == 62:
+                rook = self.ownSide(piece)['R2']
+                rookMove = to - 1
+        undo = (piece, piece.square, piece.movesDone, captured,
+                captured.square if captured is not None else None,
+                rook, rook.square if rook is not None else None)
+        if captured is not None:
+            self.setSquare(captured, BANISHED)
+        if rook is not None:
+            self.setSquare(rook, rookMove)
+            rook.movesDone += 1
+        self.setSquare(piece, to)
         piece.movesDone += 1
+        return undo
+
+    def unmake_move(self, undo):
+        """Takes back a move played by make_move
+        :param undo: tuple returned by make_move"""
+        piece, square, movesDone, captured, capturedSquare, rook, rookSquare = undo
+        self.setSquare(piece, square)
+        piece.movesDone = movesDone
+        if rook is not None:
+            self.setSquare(rook, rookSquare)
+            rook.movesDone -= 1
+        if captured is not None:
+            self.setSquare(captured, capturedSquare)
 
-    def move(self, piece: Piece, move):
-        """Moves a piece and updates board for next move. checks for checkmate or stalemate.
+    def capture(self, piece: Piece, move):
+        """Moves Pieces and Captures if necessary. The halfmove clock restarts on a pawn move or capture
         :param piece: Piece
-        :param move: list"""
-        previousPos = piece.position
-        self.capture(piece, move)
-        self.possibleMoves()
-        # add en passant moves
-        if piece.piece[0] == 'P' and piece.movesDone == 1:
-            if piece.color == 'black':
-                for i in range(1, 9):
-                    # For every pawn on enemy side,
-                    # if moving 1 square would place moved pawn in capture position, add that position to the enemy pawn
-                    if [previousPos[0], previousPos[1] - 1] in self.otherSide(piece)['P' + str(i)].pawnAttackMoves and [
-                        previousPos[0], previousPos[1] - 1]:
-                        self.otherSide(piece)['P' + str(i)].simpleMoves.append([previousPos[0], previousPos[1] - 1])
-            if piece.color == 'white':
-                for i in range(1, 9):
-                    if [previousPos[0], previousPos[1] + 1] in self.otherSide(piece)['P' + str(i)].pawnAttackMoves and [previousPos[0], previousPos[1] + 1]:
-                        self.otherSide(piece)['P' + str(i)].simpleMoves.append([previousPos[0], previousPos[1] + 1])
+        :param move: list or int"""
+        to = move if isinstance(move, int) else squareIndex(move)
+        if piece.piece[0] == 'P' or self.squares[to] is not None:
+            self.halfmoveClock = 0
+        else:
+            self.halfmoveClock += 1
+        self.make_move(piece, to)
+
+    def move(self, piece: Piece, move, promotion=''):
+        """Moves a piece and updates board for next move. checks for checkmate, stalemate, threefold repetition
+        and the fifty move rule.
+        :param piece: Piece
+        :param move: list or int
+        :param promotion: str, piece a pawn reaching the last row becomes before moves are generated,
+            '' to promote later with promote"""
+        to = move if isinstance(move, int) else squareIndex(move)
+        previous = piece.square
+        self.played.append(encodeMove(previous, to, KINDS.index(promotion) if promotion else 0))
+        self.capture(piece, to)
+        if promotion:
+            self.promote(piece, promotion)
+        self.epSquare = None
+        if piece.piece[0] == 'P' and abs(to - previous) == 16:
+            self.epSquare = squarePosition((to + previous) // 2)
+        if piece.color == 'black':
+            self.fullmoveNumber += 1
+        self.turn = 'black' if piece.color == 'white' else 'white'
+        key = self.positionHash()
+        if self.halfmoveClock == 0:
+            self.history.clear()
+        self.history[key] = self.history.get(key, 0) + 1
+        if self.lazy:
+            self.stale = True
+            return
+
+        entry = self.cache.get(key) if self.cache is not None else None
+        # An entry of a lazy game lacks the moves of the side that just moved
+        if entry is not None and entry[3]:
+            possible, check = self.loadMoves(entry)
+        else:
+            self.possibleMoves()
+            self.enPassant(piece, previous)
+            possible = self.moveChecker(self.turn)
+            check = not possible and self.isCheck(self.otherSide(piece)['K0'])
+            if self.cache is not None:
+                self.cache.put(key, self.saveMoves(possible, check))
         # Checks for end
-        if not self.moveChecker(self.otherSide(piece)['K0'].color):
-            if self.isCheck(self.otherSide(piece)['K0']):
+        if not possible:
+            if check:
                 self.winner = piece.color
             else:
                 self.winner = 'stalemate'
+        else:
+            self.winner = self.draw()
+
+    def saveMoves(self, possible, check):
+        """Packs the generated moves of every piece on the board by square, for the move cache.
+        Stored by square rather than name, since the same position can be reached with pieces swapped
+        :param possible: bool, side to move has a legal move
+        :param check: bool, side to move is in check
+        :return: tuple, moves, possible, check and whether both sides' moves are in it"""
+        moves = tuple((index, piece.moves, piece.attacks)
+                      for index, piece in enumerate(self.squares) if piece is not None)
+        return moves, possible, check, not self.lazy
+
+    def loadMoves(self, entry):
+        """Sets moves of every piece from a move cache entry
+        :param entry: tuple made by saveMoves
+        :return: (bool, bool) possible and check, as passed to saveMoves"""
+        moves, possible, check, complete = entry
+        for side in (self.white, self.black):
+            for piece in side.values():
+                piece.possibleMoves = []
+                piece.moves = EMPTY
+        for index, squares, attacks in moves:
+            piece = self.squares[index]
+            piece.moves = squares
+            piece.attacks = attacks
+        return possible, check
+
+    def enPassant(self, piece: Piece, previousPos):
+        """Adds en passant moves to enemy pawns, only after a pawn's two square first move
+        :param piece: Piece that just moved
+        :param previousPos: list or int, where it moved from"""
+        previous = previousPos if isinstance(previousPos, int) else squareIndex(previousPos)
+        if piece.piece[0] == 'P' and piece.movesDone == 1 and abs(piece.square - previous) == 16:
+            # For every pawn on enemy side,
+            # if moving 1 square would place moved pawn in capture position, add that position to the enemy pawn
+            target = (piece.square + previous) // 2
+            for i in range(1, 9):
+                pawn = self.otherSide(piece)['P' + str(i)]
+                if pawn.piece[0] == 'P' and target in pawn.attacks:
+                    pawn.moves += bytes((target,))
 
     def promote(self, piece: Piece, value):
         """Promote a piece based on passed value
         :param piece: Piece
         :param value: str"""
+        index = piece.square
+        if index >= 0:
+            self.hash ^= zobristKey(piece, index)
         piece.piece = value
+        if index >= 0:
+            self.hash ^= zobristKey(piece, index)
+            if self.halfmoveClock == 0:
+                # Promoting right after the pawn move, the position it replaces is the only one in the history
+                self.history = {self.positionHash(): 1}
+                if self.played and (self.played[-1] >> 6) & 63 == index:
+                    self.played[-1] = self.played[-1] & 0xFFF | KINDS.index(value[0]) << 12
+        if self.lazy:
+            # The new piece changes the moves of the side to move
+            self.stale = True
+
+    def moveCode(self, piece: Piece, move, promotion=''):
+        """Encodes a move of a piece in 16 bits, see encodeMove
+        :param piece: Piece
+        :param move: list or int
+        :param promotion: str
+        :return: int"""
+        to = move if isinstance(move, int) else squareIndex(move)
+        return encodeMove(piece.square, to, KINDS.index(promotion) if promotion else 0)
+
+    def applyMove(self, code):
+        """Plays a move encoded by moveCode, promotion included, if it is legal for the side to move
+        :param code: int
+        :return: Piece that moved"""
+        frm, to, promotion = decodeMove(code)
+        if self.stale:
+            self.generate()
+        piece = self.squares[frm]
+        if piece is None or piece.color != self.turn or to not in piece.moves:
+            raise ValueError('Illegal move ' + format(code, '04x'))
+        lastRow = piece.piece[0] == 'P' and (to < 8 or to >= 56)
+        if lastRow != (0 < promotion < 5):
+            raise ValueError('Bad promotion in move ' + format(code, '04x'))
+        self.move(piece, to, KINDS[promotion] if promotion else '')
+        return piece
+
+    def toRecord(self):
+        """Binary record of the game: a header, the start FEN unless it is the start position, then the moves
+        :return: bytes"""
+        fen = self.startFen.encode() if self.startFen is not None else b''
+        return (RECORD.pack(RECORD_MAGIC, RESULTS.index(self.winner), len(self.played), len(fen)) + fen
+                + struct.pack('>' + str(len(self.played)) + 'H', *self.played))
+
+    @classmethod
+    def fromRecord(cls, data, generator='trial', lazy=False):
+        """Replays a game record made by toRecord, checking every move
+        :param data: bytes
+        :param generator: str, legal move filter, see __init__
+        :param lazy: bool, see __init__
+        :return: Game"""
+        magic, result, count, length = RECORD.unpack_from(data)
+        if magic != RECORD_MAGIC or len(data) != RECORD.size + length + 2 * count:
+            raise ValueError('Not a game record')
+        fen = data[RECORD.size:RECORD.size + length].decode()
+        game = cls.from_fen(fen, generator, lazy) if fen else cls(generator, lazy=lazy)
+        for code in struct.unpack_from('>' + str(count) + 'H', data, RECORD.size + length):
+            game.applyMove(code)
+        return game
+
+
+def readRecords(stream):
+    """Yields the game records of a binary stream one at a time, as written one after another by toRecord
+    :param stream: binary file
+    :return: generator of bytes"""
+    while True:
+        header = stream.read(RECORD.size)
+        if not header:
+            return
+        if len(header) < RECORD.size:
+            raise ValueError('Truncated game record')
+        magic, result, count, length = RECORD.unpack(header)
+        body = stream.read(length + 2 * count)
+        if magic != RECORD_MAGIC or len(body) != length + 2 * count:
+            raise ValueError('Truncated game record')
+        yield header + body
+
+
+def randomMoves(game, plies, rnd, color='white'):
+    """Plays random legal moves on a game, leaving out pawn moves to the last row since those need a promotion
+    :param game: Game or BitboardGame
+    :param plies: int, most moves to play
+    :param rnd: random.Random
+    :param color: str, side to move
+    :return: int, moves played"""
+    for ply in range(plies):
+        if game.winner:
+            return ply
+        side = game.white if color == 'white' else game.black
+        lastRow = 7 if color == 'white' else 0
+        moves = [(piece, move) for piece in side.values() for move in piece.simpleMoves
+                 if not (piece.piece[0] == 'P' and move[1] == lastRow)]
+        if not moves:
+            return ply
+        piece, move = rnd.choice(moves)
+        game.move(piece, move)
+        color = 'black' if color == 'white' else 'white'
+    return plies
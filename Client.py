@@ -1,6 +1,15 @@
 from socket import *
 import threading
 
+from Chess import KINDS, decodeMove
+import Protocol
+
+# Seconds to wait for the server to connect or reply
+TIMEOUT = 1
+# Commands a multiplexed client sends without waiting for the server's OK, SetRecv gets no reply at all.
+# Moves wait for theirs, the server refuses illegal ones
+UNANSWERED = ('SetRecv', 'Chat')
+
 
 class Client:
     """Handles communicating with server and passing messages to the GUI"""
@@ -22,8 +31,21 @@ class Client:
         self.ready = False
         self.setReceiver = False
         self.running = True
+        # Offer the framed protocol when connecting, the text protocol is kept for older servers
+        self.useFrames = True
+        self.framed = False
+        # Offer to carry replies and pushes over client_socket alone, recv_socket is then left unused
+        self.useMultiplex = True
+        self.multiplexed = False
+        # Replies awaited on a multiplexed connection    {message id: reply, None until it arrives}
+        self.replies = {}
+        self.replied = threading.Condition()
+        self.messageId = Protocol.PUSH
+        # Frames received but not read yet, per socket
+        self.sendDecoder = Protocol.FrameDecoder()
+        self.recvDecoder = Protocol.FrameDecoder()
 
-        self.queue = {'Start': '', 'Chat': '', 'Move': '', 'Prom': '', 'End': ''}
+        self.queue = {'Start': '', 'Chat': '', 'Move': '', 'Prom': '', 'Code': '', 'End': ''}
 
     def comm(self, user='', cook='None', command='Cookie', data='None'):
         """Sends messages to server in expected format
@@ -33,10 +55,24 @@ class Client:
         :param data: str
         :return reply: str"""
         if not self.connected:
-            self.client_socket.settimeout(1)
+            self.client_socket.settimeout(TIMEOUT)
             try:
                 self.client_socket.connect(self.server_identifier)
-                self.recv_socket.connect(self.server_identifier)
+                if self.useFrames and self.useMultiplex and self.greet(self.client_socket,
+                                                                       Protocol.HELLO_MULTIPLEXED):
+                    self.multiplexed = self.framed = True
+                    # The reader thread waits for pushes as long as the game goes, replies have their own timeout
+                    self.client_socket.settimeout(None)
+                    threading.Thread(target=self.readMultiplexed, daemon=True).start()
+                else:
+                    if self.useFrames and self.useMultiplex:
+                        # The server took the greeting for a broken message, start over on a clean connection
+                        self.client_socket.close()
+                        self.client_socket = socket(AF_INET, SOCK_STREAM)
+                        self.client_socket.settimeout(TIMEOUT)
+                        self.client_socket.connect(self.server_identifier)
+                    self.recv_socket.connect(self.server_identifier)
+                    self.framed = self.useFrames and self.negotiate()
                 self.connected = True
             # Handled by window prompting the user
             except TimeoutError:
@@ -47,7 +83,10 @@ class Client:
 
         if self.cookie != 0 and not self.setReceiver:
             # Links Receiving socket to Cookie
-            self.recv_socket.send((self.username + ": " + str(self.cookie) + ': ' + 'SetRecv' + ': ' + "None").encode())
+            if self.multiplexed:
+                self.request(self.username, str(self.cookie), 'SetRecv', 'None')
+            else:
+                self.recv_socket.sendall(self.encode(self.username, str(self.cookie), 'SetRecv', 'None'))
             self.setReceiver = True
 
         # Send commands
@@ -56,14 +95,112 @@ class Client:
                 user = self.username
             if cook == 'None':
                 cook = self.cookie
-            message = user + ": " + str(cook) + ': ' + command + ': ' + data
-            message = message.encode()
-            self.client_socket.send(message)
-            reply = self.client_socket.recv(2048)
-            reply = reply.decode()
+            if self.multiplexed:
+                return self.request(user, str(cook), command, data)
+            self.client_socket.sendall(self.encode(user, str(cook), command, data))
+            if not self.framed:
+                reply = self.client_socket.recv(2048)
+                reply = reply.decode()
+                return reply
+            reply = self.receive(self.client_socket, self.sendDecoder).decode()
+            # Start is answered twice, before and after looking for an opponent
+            if command == 'Start' and not reply.startswith('ERR'):
+                reply = self.receive(self.client_socket, self.sendDecoder).decode()
             return reply
         return ''
 
+    def request(self, user, cook, command, data):
+        """Sends a request on a multiplexed connection and waits for the reply with its message id, unless
+        the command is one of UNANSWERED
+        :param user: str
+        :param cook: str
+        :param command: str
+        :param data: str
+        :return: str reply, '' for UNANSWERED commands"""
+        with self.replied:
+            self.messageId += 1
+            messageId = self.messageId
+            if command not in UNANSWERED:
+                self.replies[messageId] = None
+        self.client_socket.sendall(Protocol.encodeMultiplexedRequest(messageId, user, cook, command, data))
+        if command in UNANSWERED:
+            return ''
+        with self.replied:
+            if not self.replied.wait_for(lambda: self.replies[messageId] is not None, TIMEOUT):
+                del self.replies[messageId]
+                raise TimeoutError('No reply to ' + command)
+            return self.replies.pop(messageId)
+
+    def readMultiplexed(self):
+        """Reads a multiplexed connection until it closes, handing replies to the requests waiting for them
+        and adding pushes to the queues"""
+        while self.running:
+            try:
+                messageId, reply = Protocol.decodeMultiplexedReply(self.receive(self.client_socket,
+                                                                                self.recvDecoder))
+            except (ConnectionError, OSError):
+                return
+            if messageId == Protocol.PUSH:
+                self.dispatch(reply)
+                continue
+            with self.replied:
+                # Later replies to a request already answered, like the second one to Start, are dropped
+                if self.replies.get(messageId, '') is None:
+                    self.replies[messageId] = reply
+                    self.replied.notify_all()
+
+    def negotiate(self):
+        """Offers the framed protocol on both sockets. A server that does not greet back within the timeout
+        takes the greeting for a broken message and keeps to the text protocol
+        :return: bool, True if the server speaks frames"""
+        self.recv_socket.settimeout(TIMEOUT)
+        try:
+            return self.greet(self.client_socket, Protocol.HELLO) and self.greet(self.recv_socket, Protocol.HELLO)
+        finally:
+            self.recv_socket.settimeout(None)
+
+    def greet(self, connection, greeting):
+        """Sends a protocol greeting and checks the server answers with the same
+        :param connection: socket, with a timeout
+        :param greeting: bytes
+        :return: bool"""
+        try:
+            connection.sendall(greeting)
+            answer = b''
+            while len(answer) < len(greeting):
+                data = connection.recv(len(greeting) - len(answer))
+                if not data:
+                    return False
+                answer += data
+            return answer == greeting
+        except (TimeoutError, OSError):
+            return False
+
+    def encode(self, user, cook, command, data):
+        """Formats a message to the server in the negotiated protocol
+        :param user: str
+        :param cook: str
+        :param command: str
+        :param data: str
+        :return: bytes"""
+        if self.framed:
+            return Protocol.encodeRequest(user, cook, command, data)
+        return (user + ": " + cook + ': ' + command + ': ' + data).encode()
+
+    def receive(self, connection, decoder):
+        """Reads the next framed message from a socket, however the network split or joined the frames
+        :param connection: socket
+        :param decoder: Protocol.FrameDecoder of the socket
+        :return: bytes frame body"""
+        frame = decoder.next()
+        while frame is None:
+            data = connection.recv(4096)
+            if not data:
+                raise ConnectionError('Server closed the connection')
+            decoder.feed(data)
+            frame = decoder.next()
+        return frame
+
     def setUName(self):
         """Set username, returns server reply
         :return reply: str"""
@@ -82,31 +219,67 @@ class Client:
 
     def sendMove(self, move):
         """Sends move message to server
-        :param move: str"""
-        self.comm(command='Move', data=move)
+        :param move: str
+        :return: str, reply of the server"""
+        return self.comm(command='Move', data=move)
 
     def sendProm(self, prom):
         """Sends promotion message to server
-        :param prom: str"""
-        self.comm(command='Prom', data=prom)
+        :param prom: str
+        :return: str, reply of the server"""
+        return self.comm(command='Prom', data=prom)
+
+    def sendCode(self, code):
+        """Sends a move encoded by Game.moveCode, promotion included, as 4 hex digits
+        :param code: int
+        :return: str, reply of the server"""
+        return self.comm(command='Code', data=format(code, '04x'))
+
+    def sendPlayed(self, code, pieceName):
+        """Sends a move just played on the board. A server that negotiated frames knows Code messages, older
+        servers get the Move message, after a Prom message for a promotion
+        :param code: int, see Chess.encodeMove
+        :param pieceName: str, name of the piece moved, like P5
+        :return: str, reply of the server, starting with ERR if it refused the move"""
+        if self.framed:
+            return self.sendCode(code)
+        frm, to, promotion = decodeMove(code)
+        if promotion:
+            reply = self.sendProm(pieceName + KINDS[promotion])
+            if reply.startswith('ERR'):
+                return reply
+        return self.sendMove(pieceName + str(to % 8) + str(to // 8))
 
     def loop(self):
         """Listens to incoming messages until the game ends, adds them to corresponding queue"""
         while self.running:
             while self.ready and not self.endGame:
-                reply = self.recv_socket.recv(2048)
-                reply = reply.decode()
-                print(reply)
-                if reply.find('Start') == 0:
-                    self.queue['Start'] = reply[reply.index("Start") + 5:]
-                elif reply.find('Chat') == 0:
-                    self.queue['Chat'] = reply[reply.index("Chat") + 4:]
-                elif reply.find('Prom') == 0:
-                    self.queue['Prom'] = reply[reply.index("Prom") + 4:]
-                elif reply.find('Move') == 0:
-                    self.queue['Move'] = reply[reply.index("Move") + 4:]
-                elif reply.find('End') == 0:
-                    self.queue['End'] = reply[reply.index("End") + 3:]
+                # Pushes come with the replies on a multiplexed connection, readMultiplexed takes them
+                if self.multiplexed:
+                    return
+                if self.framed:
+                    reply = self.receive(self.recv_socket, self.recvDecoder).decode()
+                else:
+                    reply = self.recv_socket.recv(2048)
+                    reply = reply.decode()
+                self.dispatch(reply)
+
+    def dispatch(self, reply):
+        """Adds a message pushed by the server to its queue
+        :param reply: str"""
+        print(reply)
+        if reply.find('Start') == 0:
+            self.queue['Start'] = reply[reply.index("Start") + 5:]
+        elif reply.find('Chat') == 0:
+            self.queue['Chat'] = reply[reply.index("Chat") + 4:]
+        elif reply.find('Prom') == 0:
+            self.queue['Prom'] = reply[reply.index("Prom") + 4:]
+        elif reply.find('Move') == 0:
+            self.queue['Move'] = reply[reply.index("Move") + 4:]
+        elif reply.find('Code') == 0:
+            self.queue['Code'] = reply[reply.index("Code") + 4:]
+        elif reply.find('End') == 0:
+            self.queue['End'] = reply[reply.index("End") + 3:]
 
     def checkQueue(self):
         """Checks Queues and calls observer methods correspondingly"""
@@ -158,6 +331,12 @@ class Client:
                 self.observer.nextMove = 'black'
             self.queue['Prom'] = ''
 
+        if self.queue['Code'] != '':
+            self.observer.board.applyMove(int(self.queue['Code'], 16))
+            self.observer.setBoard()
+            self.observer.nextMove = self.observer.side
+            self.queue['Code'] = ''
+
         if self.queue['End'] != '':
             info = self.queue['End']
             self.observer.endScreen(info)
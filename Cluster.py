@@ -0,0 +1,372 @@
+from socket import *
+import argparse
+import asyncio
+import json
+import multiprocessing
+import zlib
+
+from Engine import Bot
+import Protocol
+from Server import Server, raise_file_limit
+
+# Largest control message, a game handed to a shard with its connections, or a user name given back
+CONTROL_SIZE = 1 << 16
+# Connections a game is handed over with, main and receiver of each player
+MAX_FDS = 4
+
+
+def run_shard(control, others, bot_latency, book_path, tablebase_path, referee_workers):
+    """Process entry of a shard
+    :param control: socket, the shard's end of its control channel
+    :param others: list of socket, lobby ends of the control channels so far, copied into this process
+    :param bot_latency: float
+    :param book_path: str or None
+    :param tablebase_path: str or None
+    :param referee_workers: int"""
+    # The lobby going away must close every control channel, so only the lobby keeps their ends
+    for other in others:
+        other.close()
+    try:
+        Shard(control, bot_latency, book_path, tablebase_path, referee_workers)
+    except KeyboardInterrupt:
+        pass
+
+
+class Lobby(Server):
+    """Front process of the sharded server. It accepts every connection, hands out cookies and names and matches
+    players. Once a game starts the connections of its players are passed to the shard process the game hashes to,
+    which plays it out, so moves are checked and forwarded within one process and games spread over the cores"""
+
+    def __init__(self, address='0.0.0.0', port_number=4000, connections=10, workers=2, bot_latency=1.0,
+                 book_path=None, tablebase_path=None, referee_workers=1):
+        """Starts the shards, then binds to address:port and serves incoming connections on an event loop
+        :param address: str
+        :param port_number: int
+        :param connections: int, backlog of connections waiting to be accepted
+        :param workers: int, shard processes
+        :param bot_latency: float, seconds a computer opponent may take per move
+        :param book_path: str, opening book of the computer opponents, or None
+        :param tablebase_path: str, endgame tablebase of the computer opponents, or None
+        :param referee_workers: int, threads checking moves in each shard, 0 forwards moves unchecked"""
+        # Shards are started before binding, so they do not hold the listening socket
+        self.shards = []
+        for _ in range(workers):
+            control, child = socketpair(AF_UNIX, SOCK_SEQPACKET)
+            self.shards.append(control)
+            process = multiprocessing.Process(target=run_shard, daemon=True, args=(
+                child, list(self.shards), bot_latency, book_path, tablebase_path, referee_workers))
+            process.start()
+            child.close()
+        # Games are played in the shards, the lobby never checks a move
+        self.setup(bot_latency, referee_workers=0)
+        # Connection each player sent Start on    {cookie: socket}
+        self.mains = {}
+        # Decoder of each negotiated connection, None for the text protocol    {socket: FrameDecoder}
+        self.decoders = {}
+        # First bytes of connections that have not sent a whole greeting yet    {socket: bytes}
+        self.greetings = {}
+        # Bytes not yet taken by the network, sent when the socket is writable    {socket: bytearray}
+        self.outgoing = {}
+        asyncio.run(self.serve((address, port_number), connections))
+
+    async def serve(self, identifier, connections):
+        """Accepts and reads every connection on the running event loop, forever
+        :param identifier: (str, int) address and port
+        :param connections: int, backlog"""
+        self.loop = asyncio.get_running_loop()
+        raise_file_limit()
+        listener = socket(AF_INET, SOCK_STREAM)
+        listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        listener.bind(identifier)
+        listener.listen(connections)
+        listener.setblocking(False)
+        self.loop.add_reader(listener, self.accept, listener)
+        for control in self.shards:
+            control.setblocking(False)
+            self.loop.add_reader(control, self.shard_message, control)
+        print('Serving on', identifier, 'with', len(self.shards), 'shards')
+        await self.loop.create_future()
+
+    def accept(self, listener):
+        """Takes every connection waiting on the listening socket
+        :param listener: socket"""
+        while True:
+            try:
+                connection, client_address = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Out of file descriptors, the rest wait in the backlog
+                print(e)
+                return
+            connection.setblocking(False)
+            self.greetings[connection] = b''
+            self.loop.add_reader(connection, self.readable, connection)
+
+    def readable(self, connection):
+        """Reads what a connection sent and acts on it, the socket stays with the lobby until its game starts
+        :param connection: socket"""
+        try:
+            data = connection.recv(2048)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.drop(connection)
+            return
+        if connection in self.greetings:
+            data = self.greetings.pop(connection) + data
+            # A greeting cut short by the network is read to the end
+            if Protocol.HELLO.startswith(data) and len(data) < len(Protocol.HELLO):
+                self.greetings[connection] = data
+                return
+            self.decoders[connection], data = self.negotiate(connection, data)
+            if not data:
+                return
+        decoder = self.decoders[connection]
+        try:
+            running = self.handle_data(connection, decoder, data)
+        except Exception as e:
+            print('Bad message:', repr(e))
+            # A broken frame leaves the rest of the stream unreadable
+            running = decoder is None
+        if not running:
+            self.drop(connection)
+
+    def write(self, socket, data):
+        """Sends bytes without blocking the loop, what the network does not take now is sent once the socket
+        is writable, or passed to the shard with the socket
+        :param socket: socket
+        :param data: bytes"""
+        pending = self.outgoing.get(socket)
+        if pending is not None:
+            pending += data
+            return
+        try:
+            sent = socket.send(data)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            # Closed by the client, the read side drops it
+            return
+        if sent < len(data):
+            self.outgoing[socket] = bytearray(data[sent:])
+            self.loop.add_writer(socket, self.flush, socket)
+
+    def flush(self, socket):
+        """Sends what write left over once the socket is writable
+        :param socket: socket"""
+        pending = self.outgoing[socket]
+        try:
+            sent = socket.send(pending)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            sent = len(pending)
+        del pending[:sent]
+        if not pending:
+            del self.outgoing[socket]
+            self.loop.remove_writer(socket)
+
+    def drop(self, connection):
+        """Closes a connection the lobby reads
+        :param connection: socket"""
+        self.loop.remove_reader(connection)
+        if self.outgoing.pop(connection, None) is not None:
+            self.loop.remove_writer(connection)
+        self.greetings.pop(connection, None)
+        self.decoders.pop(connection, None)
+        self.forget(connection)
+        connection.close()
+
+    def handle_command(self, connection, user, cookie, command, data):
+        """Remembers the connection a player looks for a game on, so it goes to the shard with the game,
+        see Server.handle_command"""
+        if command == 'Start':
+            self.mains[cookie] = connection
+        return super().handle_command(connection, user, cookie, command, data)
+
+    def start_game(self, white, black, bot=None):
+        """Stops reading the connections of a new game's players, and passes them to the game's shard once
+        the replies to the command that started the game are sent
+        :param white: str, cookie
+        :param black: str, cookie
+        :param bot: Bot playing black, or None. The shard makes its own"""
+        connections = []
+        for cookie in (white, black):
+            for connection in (self.mains.get(cookie), self.q.cookieReceiver.get(cookie)):
+                if connection is not None and connection not in connections and connection.fileno() >= 0:
+                    connections.append(connection)
+        for connection in connections:
+            self.moving.add(connection)
+            self.loop.remove_reader(connection)
+        self.loop.call_soon(self.hand_off, white, black, bot is not None, connections)
+
+    def hand_off(self, white, black, bot, connections):
+        """Sends a game and its connections to the shard it hashes to, and forgets them
+        :param white: str, cookie
+        :param black: str, cookie
+        :param bot: bool, black is a computer opponent
+        :param connections: list of socket"""
+        entries = []
+        for connection in connections:
+            decoder = self.decoders.pop(connection, None)
+            # Frames that came in with the one starting the game
+            leftover = bytes(decoder.buffer[decoder.position:]) if decoder is not None else b''
+            # Replies the network has not taken yet, like the last one to the Start that began the game
+            pending = self.outgoing.pop(connection, b'')
+            if pending:
+                self.loop.remove_writer(connection)
+            entries.append({'receiver': self.receiver_cookies.get(connection),
+                            'framed': connection in self.framed,
+                            'multiplexed': connection in self.multiplexed,
+                            'leftover': leftover.hex(),
+                            'pending': bytes(pending).hex()})
+        game = {'white': [white, self.q.cookieMap.get(white)], 'black': [black, self.q.cookieMap.get(black)],
+                'bot': bot, 'connections': entries}
+        control = self.shards[zlib.crc32(white.encode()) % len(self.shards)]
+        send_fds(control, [json.dumps(game).encode()], [connection.fileno() for connection in connections])
+        # The shard has its own copies of the sockets now
+        for connection in connections:
+            self.moving.discard(connection)
+            # The players go on in the shard, forget must not end their game
+            cookie = self.receiver_cookies.pop(connection, None)
+            if cookie is not None:
+                self.q.drop_receiver(cookie, connection)
+            self.forget(connection)
+            connection.close()
+        for cookie in (white, black):
+            self.mains.pop(cookie, None)
+            self.q.cookieMap.pop(cookie, None)
+
+    def shard_message(self, control):
+        """Frees the user names a shard gives back when their games end
+        :param control: socket"""
+        try:
+            data = control.recv(CONTROL_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.loop.remove_reader(control)
+            print('A shard stopped')
+            return
+        try:
+            user, cookie = json.loads(data)['release']
+            if not isinstance(user, str) or not isinstance(cookie, str):
+                raise TypeError('Release of ' + repr(user))
+        except (ValueError, KeyError, TypeError) as e:
+            print('Bad control message:', repr(e))
+            return
+        # The name may have been taken again meanwhile
+        self.q.release_user(user, cookie)
+
+
+class Shard(Server):
+    """Worker process of the sharded server, playing out the games the lobby hands it on its own event loop"""
+
+    def __init__(self, control, bot_latency=1.0, book_path=None, tablebase_path=None, referee_workers=1):
+        """:param control: socket, channel to the lobby
+        :param bot_latency: float
+        :param book_path: str or None
+        :param tablebase_path: str or None
+        :param referee_workers: int, threads checking moves"""
+        self.setup(bot_latency, book_path, tablebase_path, referee_workers, referee_processes=False)
+        self.control = control
+        asyncio.run(self.serve_games())
+
+    async def serve_games(self):
+        """Takes games from the lobby until it goes away"""
+        self.loop = asyncio.get_running_loop()
+        raise_file_limit()
+        self.control.setblocking(False)
+        self.stopped = self.loop.create_future()
+        self.loop.add_reader(self.control, self.receive_game)
+        await self.stopped
+
+    def receive_game(self):
+        """Registers a game handed over by the lobby and serves the connections of its players"""
+        try:
+            data, fds, flags, address = recv_fds(self.control, CONTROL_SIZE, MAX_FDS)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data, fds = b'', []
+        if not data:
+            self.loop.remove_reader(self.control)
+            self.stopped.set_result(None)
+            return
+        try:
+            game = json.loads(data)
+            white, white_user = game['white']
+            black, black_user = game['black']
+            if len(game['connections']) != len(fds):
+                raise ValueError(str(len(fds)) + ' sockets for ' + str(len(game['connections'])) + ' connections')
+        except (ValueError, KeyError, TypeError) as e:
+            print('Bad control message:', repr(e))
+            for fd in fds:
+                socket(fileno=fd).close()
+            return
+        self.q.set_name(white, white_user)
+        self.q.set_name(black, black_user)
+        self.q.claim_user(white_user, white)
+        bot = None
+        if game['bot']:
+            bot = Bot('black', self.bot_latency, book=self.book, tablebase=self.tablebase)
+        else:
+            self.q.claim_user(black_user, black)
+        self.start_game(white, black, bot)
+        for entry, fd in zip(game['connections'], fds):
+            self.loop.create_task(self.serve_connection(entry, socket(fileno=fd)))
+
+    async def serve_connection(self, entry, connection):
+        """Serves a connection handed over by the lobby, in the protocol it negotiated there
+        :param entry: dict with the receiver cookie or None, framed, multiplexed, and the bytes received but not
+            read and written but not sent by the lobby, in hex
+        :param connection: socket"""
+        connection.setblocking(False)
+        reader, writer = await asyncio.open_connection(sock=connection)
+        # Goes out before anything the game sends
+        writer.write(bytes.fromhex(entry['pending']))
+        if entry['framed']:
+            self.framed.add(writer)
+        if entry['multiplexed']:
+            self.multiplexed.add(writer)
+        if entry['receiver'] is not None:
+            self.q.set_receiver(entry['receiver'], writer)
+            self.receiver_cookies[writer] = entry['receiver']
+        decoder = Protocol.FrameDecoder() if entry['framed'] else None
+        await self.read_stream(reader, writer, decoder, bytes.fromhex(entry['leftover']))
+        self.forget(writer)
+        writer.close()
+
+    def release_user(self, user, cookie=None):
+        """Frees a user name here and in the lobby, which hands out names, see Server.release_user"""
+        owner = super().release_user(user, cookie)
+        if owner is not None:
+            self.control.send(json.dumps({'release': [user, owner]}).encode())
+        return owner
+
+
+def main(argv=None):
+    """Command line entry: python3 -m Cluster [--workers N] [--address A] [--port N] [--backlog N]"""
+    parser = argparse.ArgumentParser(description='Chess game server over several processes')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='shard processes')
+    parser.add_argument('--address', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=4000)
+    parser.add_argument('--backlog', type=int, default=10, help='connections waiting to be accepted')
+    parser.add_argument('--bot-latency', type=float, default=1.0, help='seconds the computer opponent thinks')
+    parser.add_argument('--book', default=None, help='opening book for the computer opponent')
+    parser.add_argument('--tablebase', default=None, help='endgame tablebase for the computer opponent')
+    parser.add_argument('--referee-workers', type=int, default=1,
+                        help='threads checking moves in each shard, 0 to not check')
+    args = parser.parse_args(argv)
+    Lobby(args.address, args.port, args.backlog, args.workers, args.bot_latency, args.book, args.tablebase,
+          args.referee_workers)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,539 @@
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from Chess import Game, START_FEN, moveName, squarePosition
+from Bitboard import KINDS, decodeMove, encodeMove
+from Tablebase import Tablebase
+
+# Piece values in centipawns, the king only counts for MVV-LVA ordering
+VALUES = {'P': 100, 'N': 320, 'B': 330, 'R': 500, 'Q': 900, 'K': 2000}
+MATE = 100000
+INFINITY = MATE + 1000
+# Promotions searched, rook and bishop are never better than the queen
+PROMOTIONS = 'QN'
+
+# Piece square bonuses from white's point of view, row 8 first as a board is drawn
+_TABLES = {
+    'P': (0, 0, 0, 0, 0, 0, 0, 0,
+          50, 50, 50, 50, 50, 50, 50, 50,
+          10, 10, 20, 30, 30, 20, 10, 10,
+          5, 5, 10, 25, 25, 10, 5, 5,
+          0, 0, 0, 20, 20, 0, 0, 0,
+          5, -5, -10, 0, 0, -10, -5, 5,
+          5, 10, 10, -20, -20, 10, 10, 5,
+          0, 0, 0, 0, 0, 0, 0, 0),
+    'N': (-50, -40, -30, -30, -30, -30, -40, -50,
+          -40, -20, 0, 0, 0, 0, -20, -40,
+          -30, 0, 10, 15, 15, 10, 0, -30,
+          -30, 5, 15, 20, 20, 15, 5, -30,
+          -30, 0, 15, 20, 20, 15, 0, -30,
+          -30, 5, 10, 15, 15, 10, 5, -30,
+          -40, -20, 0, 5, 5, 0, -20, -40,
+          -50, -40, -30, -30, -30, -30, -40, -50),
+    'B': (-20, -10, -10, -10, -10, -10, -10, -20,
+          -10, 0, 0, 0, 0, 0, 0, -10,
+          -10, 0, 5, 10, 10, 5, 0, -10,
+          -10, 5, 5, 10, 10, 5, 5, -10,
+          -10, 0, 10, 10, 10, 10, 0, -10,
+          -10, 10, 10, 10, 10, 10, 10, -10,
+          -10, 5, 0, 0, 0, 0, 5, -10,
+          -20, -10, -10, -10, -10, -10, -10, -20),
+    'R': (0, 0, 0, 0, 0, 0, 0, 0,
+          5, 10, 10, 10, 10, 10, 10, 5,
+          -5, 0, 0, 0, 0, 0, 0, -5,
+          -5, 0, 0, 0, 0, 0, 0, -5,
+          -5, 0, 0, 0, 0, 0, 0, -5,
+          -5, 0, 0, 0, 0, 0, 0, -5,
+          -5, 0, 0, 0, 0, 0, 0, -5,
+          0, 0, 0, 5, 5, 0, 0, 0),
+    'Q': (-20, -10, -10, -5, -5, -10, -10, -20,
+          -10, 0, 0, 0, 0, 0, 0, -10,
+          -10, 0, 5, 5, 5, 5, 0, -10,
+          -5, 0, 5, 5, 5, 5, 0, -5,
+          0, 0, 5, 5, 5, 5, 0, -5,
+          -10, 5, 5, 5, 5, 5, 0, -10,
+          -10, 0, 5, 0, 0, 0, 0, -10,
+          -20, -10, -10, -5, -5, -10, -10, -20),
+    'K': (-30, -40, -40, -50, -50, -40, -40, -30,
+          -30, -40, -40, -50, -50, -40, -40, -30,
+          -30, -40, -40, -50, -50, -40, -40, -30,
+          -30, -40, -40, -50, -50, -40, -40, -30,
+          -20, -30, -30, -40, -40, -30, -30, -20,
+          -10, -20, -20, -20, -20, -20, -20, -10,
+          20, 20, 0, 0, 0, 0, 20, 20,
+          20, 30, 10, 0, 0, 10, 30, 20),
+}
+# SQUARE_SCORES[color][kind][square]: piece value plus square bonus, color 0 is white
+SQUARE_SCORES = [{kind: [(VALUES[kind] if kind != 'K' else 0) + table[(7 - sq // 8 if color == 0 else sq // 8) * 8
+                                                                         + sq % 8] for sq in range(64)]
+                  for kind, table in _TABLES.items()} for color in range(2)]
+
+
+class SearchTimeout(Exception):
+    """Raised inside the search when the time or node budget runs out"""
+
+
+def evaluate(game: Game):
+    """Material and piece square score of a position, from the side to move's point of view
+    :param game: Game
+    :return: int"""
+    score = 0
+    for index, piece in enumerate(game.squares):
+        if piece is not None:
+            if piece.color == 'white':
+                score += SQUARE_SCORES[0][piece.piece[0]][index]
+            else:
+                score -= SQUARE_SCORES[1][piece.piece[0]][index]
+    return score if game.turn == 'white' else -score
+
+
+class Engine:
+    """Negamax alpha-beta search on Chess.Game with iterative deepening, MVV-LVA and killer move ordering,
+    quiescence search on captures, and a hard time and node budget"""
+
+    def __init__(self, maxTime=1.0, maxNodes=None, maxDepth=32, out=None, tablebase=None):
+        """:param maxTime: float, seconds per move, None for no limit
+        :param maxNodes: int, nodes per move, None for no limit
+        :param maxDepth: int, deepest iteration
+        :param out: function called with a report line after every finished iteration, None for quiet
+        :param tablebase: Tablebase.Tablebase, exact scores of the endgames it has, or None"""
+        self.maxTime = maxTime
+        self.maxNodes = maxNodes
+        self.maxDepth = maxDepth
+        self.out = out
+        self.tablebase = tablebase
+        self.nodes = 0
+        self.deadline = None
+        # Two quiet moves per ply that caused a cutoff, and the best move found for each position hash
+        self.killers = []
+        self.bestMoves = {}
+
+    def search(self, game: Game):
+        """Searches the position of a game, which is left untouched, and returns the best move found
+        in the deepest iteration that finished within the budget
+        :param game: Game
+        :return: dict with move (e2e7 style name), frm and to squares, promotion, score, depth, nodes, time, nps"""
+        start = time.perf_counter()
+        self.reset(start)
+        # Searched on a copy, since a timeout leaves moves played on the board
+        board = Game.from_fen(game.to_fen(), 'pins')
+        result = {'move': None, 'frm': None, 'to': None, 'promotion': '', 'score': 0, 'depth': 0}
+
+        rootMoves = self.moves(board, 0)
+        if rootMoves:
+            piece, to, promotion = rootMoves[0][:3]
+            result.update(frm=piece.square, to=to, promotion=promotion)
+        else:
+            # Checkmate or stalemate, nothing to search
+            result['score'] = -MATE if self.inCheck(board) else 0
+        for depth in range(1, self.maxDepth + 1 if rootMoves else 1):
+            try:
+                score, best = self.root(board, rootMoves, depth)
+            except SearchTimeout:
+                break
+            # Best move first in the next iteration
+            rootMoves.remove(best)
+            rootMoves.insert(0, best)
+            result.update(frm=best[0].square, to=best[1], promotion=best[2], score=score, depth=depth)
+            elapsed = time.perf_counter() - start
+            if self.out is not None:
+                self.out('depth ' + str(depth) + '  score ' + str(score) + '  nodes ' + str(self.nodes) + '  nps '
+                         + str(int(self.nodes / elapsed) if elapsed else 0) + '  move '
+                         + moveName(squarePosition(result['frm']), squarePosition(result['to']), result['promotion']))
+            if abs(score) >= MATE - 1000:
+                break
+            # The next iteration takes several times longer, do not start what cannot finish
+            if self.deadline is not None and elapsed > (self.deadline - start) / 2:
+                break
+
+        elapsed = time.perf_counter() - start
+        if result['frm'] is not None:
+            result['move'] = moveName(squarePosition(result['frm']), squarePosition(result['to']),
+                                      result['promotion'])
+        result.update(nodes=self.nodes, time=elapsed, nps=int(self.nodes / elapsed) if elapsed else 0)
+        return result
+
+    def reset(self, start, keepTables=False):
+        """Starts the clock and node count of a search, and clears the move ordering tables
+        :param start: float, time.perf_counter() at the start
+        :param keepTables: bool, keep killers and best moves from the last search"""
+        self.deadline = start + self.maxTime if self.maxTime is not None else None
+        self.nodes = 0
+        if not keepTables or not self.killers:
+            self.killers = [[None, None] for _ in range(self.maxDepth + 64)]
+            self.bestMoves = {}
+
+    def root(self, game: Game, rootMoves, depth):
+        """Searches every root move to a depth
+        :param game: Game
+        :param rootMoves: list of moves from moves()
+        :param depth: int
+        :return: (int, tuple) score and best move"""
+        alpha = -INFINITY
+        best = rootMoves[0]
+        for move in rootMoves:
+            played = self.play(game, move)
+            score = -self.negamax(game, depth - 1, -INFINITY, -alpha, 1)
+            self.takeBack(game, played)
+            if score > alpha:
+                alpha = score
+                best = move
+        return alpha, best
+
+    def negamax(self, game: Game, depth, alpha, beta, ply):
+        """Alpha-beta search of the side to move
+        :param game: Game
+        :param depth: int, plies left before quiescence
+        :param alpha: int
+        :param beta: int
+        :param ply: int, plies from the root
+        :return: int score"""
+        self.count()
+        if self.tablebase is not None:
+            known = self.tablebase.probe(game)
+            if known is not None:
+                winner, plies = known
+                if winner == 'draw':
+                    return 0
+                return MATE - ply - plies if winner == game.turn else -MATE + ply + plies
+        if depth <= 0:
+            return self.quiescence(game, alpha, beta, ply)
+        moves = self.moves(game, ply)
+        if not moves:
+            return -MATE + ply if self.inCheck(game) else 0
+        key = game.positionHash()
+        best = -INFINITY
+        bestMove = None
+        for move in moves:
+            played = self.play(game, move)
+            score = -self.negamax(game, depth - 1, -beta, -alpha, ply + 1)
+            self.takeBack(game, played)
+            if score > best:
+                best = score
+                bestMove = move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                if move[3]:
+                    killers = self.killers[ply]
+                    if killers[0] != move[:3]:
+                        killers[1] = killers[0]
+                        killers[0] = move[:3]
+                break
+        self.bestMoves[key] = bestMove[:3]
+        return best
+
+    def quiescence(self, game: Game, alpha, beta, ply):
+        """Searches captures and promotions only, until the position is quiet
+        :param game: Game
+        :param alpha: int
+        :param beta: int
+        :param ply: int
+        :return: int score"""
+        self.count()
+        moves = self.moves(game, ply, captures=True)
+        if moves is None:
+            return -MATE + ply if self.inCheck(game) else 0
+        standPat = evaluate(game)
+        if standPat >= beta:
+            return standPat
+        if standPat > alpha:
+            alpha = standPat
+        for move in moves:
+            played = self.play(game, move)
+            score = -self.quiescence(game, -beta, -alpha, ply + 1)
+            self.takeBack(game, played)
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        return alpha
+
+    def count(self):
+        """Counts a node and stops the search once over budget"""
+        self.nodes += 1
+        if self.maxNodes is not None and self.nodes > self.maxNodes:
+            raise SearchTimeout()
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+
+    def moves(self, game: Game, ply, captures=False):
+        """Legal moves of the side to move, ordered: best move found before, captures by MVV-LVA, promotions,
+        killer moves, then the rest. With captures set only captures and promotions are returned,
+        or None when there are no legal moves at all
+        :param game: Game
+        :param ply: int
+        :param captures: bool
+        :return: list of (Piece, int to, str promotion, bool quiet)"""
+        if not game.sideMoves(game.turn):
+            return None if captures else []
+        side = game.white if game.turn == 'white' else game.black
+        squares = game.squares
+        hashMove = self.bestMoves.get(game.positionHash())
+        killers = self.killers[ply] if ply < len(self.killers) else (None, None)
+        ordered = []
+        for piece in side.values():
+            kind = piece.piece[0]
+            for to in piece.moves:
+                target = squares[to]
+                if target is not None:
+                    victim = target.piece[0]
+                elif kind == 'P' and to % 8 != piece.square % 8:
+                    # En passant
+                    victim = 'P'
+                else:
+                    victim = None
+                if kind == 'P' and (to < 8 or to >= 56):
+                    for promotion in PROMOTIONS:
+                        move = (piece, to, promotion, False)
+                        ordered.append((2 * MATE + VALUES[promotion] + (VALUES[victim] if victim else 0), move))
+                elif victim is not None:
+                    # Most valuable victim first, least valuable attacker among equal victims
+                    ordered.append((MATE + 10 * VALUES[victim] - VALUES[kind], (piece, to, '', False)))
+                elif not captures:
+                    move = (piece, to, '', True)
+                    ordered.append((2 if move[:3] == killers[0] else 1 if move[:3] == killers[1] else 0, move))
+        ordered.sort(key=lambda entry: entry[0], reverse=True)
+        moves = [move for _, move in ordered]
+        if hashMove is not None:
+            for i, move in enumerate(moves):
+                if move[:3] == hashMove:
+                    moves.insert(0, moves.pop(i))
+                    break
+        return moves
+
+    def inCheck(self, game: Game):
+        """Whether the side to move is in check
+        :param game: Game
+        :return: bool"""
+        side, enemy = (game.white, 'black') if game.turn == 'white' else (game.black, 'white')
+        return game.isAttacked(side['K0'].square, enemy)
+
+    def play(self, game: Game, move):
+        """Plays a searched move, keeping side to move and en passant square up to date
+        :param game: Game
+        :param move: tuple from moves()
+        :return: tuple to pass to takeBack"""
+        piece, to, promotion = move[:3]
+        state = (game.turn, game.epSquare)
+        previous = piece.square
+        undo = game.make_move(piece, to)
+        if promotion:
+            game.promote(piece, promotion)
+        game.epSquare = None
+        if piece.piece[0] == 'P' and abs(to - previous) == 16:
+            game.epSquare = squarePosition((to + previous) // 2)
+        game.turn = 'black' if game.turn == 'white' else 'white'
+        return state, undo, piece, promotion
+
+    def takeBack(self, game: Game, played):
+        """Takes back a move played by play
+        :param game: Game
+        :param played: tuple"""
+        state, undo, piece, promotion = played
+        if promotion:
+            game.promote(piece, 'P')
+        game.unmake_move(undo)
+        game.turn, game.epSquare = state
+
+
+def encodeSearchMove(move):
+    """Packs a searched move into an int like Bitboard.encodeMove, to send it to a worker process
+    :param move: tuple from Engine.moves()
+    :return: int"""
+    return encodeMove(move[0].square, move[1], KINDS.index(move[2]) if move[2] else 0)
+
+
+# Engine of a worker process, kept between tasks so best moves of earlier iterations order later ones
+_worker = {'search': None, 'engine': None}
+
+
+def searchRootMove(fen, move, depth, alpha, deadline, maxNodes, searchId, tablebase=None):
+    """Worker process task: searches one root move of a position to a depth, knowing the root already has alpha
+    :param fen: str, position before the move
+    :param move: int, from encodeSearchMove
+    :param depth: int
+    :param alpha: int, best root score so far
+    :param deadline: float, time.time() to stop at, wall clock since tasks can wait in the queue, None for no limit
+    :param maxNodes: int, nodes left, None for no limit
+    :param searchId: int, tables are cleared when a new search starts
+    :param tablebase: str, path of a tablebase file, opened once per worker, None for none
+    :return: (int or None, int) score from the root's point of view, None if out of budget, and nodes searched"""
+    engine = _worker['engine']
+    if engine is None or engine.maxDepth < depth:
+        engine = _worker['engine'] = Engine(maxDepth=max(depth, 32))
+    if tablebase is not None and (engine.tablebase is None or engine.tablebase.path != tablebase):
+        engine.tablebase = Tablebase(tablebase)
+    engine.maxTime = deadline - time.time() if deadline is not None else None
+    engine.maxNodes = maxNodes
+    engine.reset(time.perf_counter(), keepTables=_worker['search'] == searchId)
+    _worker['search'] = searchId
+    game = Game.from_fen(fen, 'pins')
+    frm, to, promotion = decodeMove(move)
+    engine.play(game, (game.squares[frm], to, KINDS[promotion] if promotion else ''))
+    try:
+        score = -engine.negamax(game, depth - 1, -INFINITY, -alpha, 1)
+    except SearchTimeout:
+        score = None
+    return score, engine.nodes
+
+
+class ParallelEngine(Engine):
+    """Engine splitting root moves over worker processes. The first root move is searched here for a bound,
+    then the others go to the workers as a FEN and an encoded move each"""
+
+    def __init__(self, workers=2, maxTime=1.0, maxNodes=None, maxDepth=32, out=None, tablebase=None):
+        """:param workers: int, worker processes, 1 searches in this process only
+        :param maxTime: float, see Engine
+        :param maxNodes: int, see Engine
+        :param maxDepth: int, see Engine
+        :param out: function, see Engine
+        :param tablebase: Tablebase.Tablebase, see Engine, workers open its file themselves"""
+        super().__init__(maxTime, maxNodes, maxDepth, out, tablebase)
+        self.workers = workers
+        self.pool = ProcessPoolExecutor(workers) if workers > 1 else None
+        self.searches = 0
+
+    def search(self, game: Game):
+        """Same as Engine.search, with the root moves of every iteration split over the workers
+        :param game: Game
+        :return: dict, see Engine.search"""
+        self.searches += 1
+        return super().search(game)
+
+    def root(self, game: Game, rootMoves, depth):
+        """Searches the first root move here, then the rest in the worker processes
+        :param game: Game
+        :param rootMoves: list of moves from moves()
+        :param depth: int
+        :return: (int, tuple) score and best move"""
+        if self.pool is None or len(rootMoves) < 2:
+            return super().root(game, rootMoves, depth)
+        best = rootMoves[0]
+        played = self.play(game, best)
+        alpha = -self.negamax(game, depth - 1, -INFINITY, INFINITY, 1)
+        self.takeBack(game, played)
+
+        fen = game.to_fen()
+        deadline = time.time() + self.deadline - time.perf_counter() if self.deadline is not None else None
+        maxNodes = self.maxNodes - self.nodes if self.maxNodes is not None else None
+        path = self.tablebase.path if self.tablebase is not None else None
+        futures = [self.pool.submit(searchRootMove, fen, encodeSearchMove(move), depth, alpha, deadline, maxNodes,
+                                    self.searches, path) for move in rootMoves[1:]]
+        timedOut = False
+        for future, move in zip(futures, rootMoves[1:]):
+            score, nodes = future.result()
+            self.nodes += nodes
+            if score is None:
+                timedOut = True
+            elif score > alpha:
+                alpha = score
+                best = move
+        if timedOut or (self.maxNodes is not None and self.nodes > self.maxNodes):
+            raise SearchTimeout()
+        return alpha, best
+
+    def close(self):
+        """Stops the worker processes"""
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+
+class Bot:
+    """Computer opponent speaking the server's move format, playing one side of its own Game"""
+
+    def __init__(self, color='black', latency=1.0, workers=1, book=None, tablebase=None):
+        """:param color: str, side the bot plays
+        :param latency: float, seconds the bot may take to answer a move
+        :param workers: int, processes to search with
+        :param book: Book.OpeningBook, played from before searching, or None
+        :param tablebase: Tablebase.Tablebase, for perfect endgames, or None"""
+        self.color = color
+        self.game = Game('pins', lazy=True)
+        self.book = book
+        # Promotion sent ahead of its move, applied once the pawn has moved
+        self.promotion = None
+        # Leave room for messaging around the search
+        if workers > 1:
+            self.engine = ParallelEngine(workers, maxTime=latency * 0.9, tablebase=tablebase)
+        else:
+            self.engine = Engine(maxTime=latency * 0.9, tablebase=tablebase)
+
+    def side(self):
+        """Pieces of the bot's side
+        :return: dict[str, Piece]"""
+        return self.game.white if self.color == 'white' else self.game.black
+
+    def opponent(self):
+        """Pieces of the other side
+        :return: dict[str, Piece]"""
+        return self.game.black if self.color == 'white' else self.game.white
+
+    def receiveMove(self, data):
+        """Plays an opponent move in the Move format P#xy
+        :param data: str"""
+        piece = self.opponent()[data[0:2]]
+        self.game.move(piece, [int(data[2]), int(data[3])])
+        if self.promotion is not None:
+            self.game.promote(piece, self.promotion)
+            self.promotion = None
+
+    def receiveCode(self, data):
+        """Plays an opponent move in the Code format, 4 hex digits of a move encoded by Game.moveCode
+        :param data: str"""
+        self.game.applyMove(int(data, 16))
+
+    def receiveProm(self, data):
+        """Keeps an opponent promotion in the Prom format P#V until its move arrives, so the pawn move
+        restarts the halfmove clock like in the clients
+        :param data: str"""
+        self.promotion = data[2]
+
+    def reply(self):
+        """Plays a book move while the game is in the book, otherwise searches for the bot's move
+        :return: list[(str, str)] of (command, data) messages to send, a Code message with the move
+            and its promotion, empty if the game is over or it is not the bot's turn"""
+        if self.game.winner or self.game.turn != self.color:
+            return []
+        move = self.book.choose(self.game) if self.book else None
+        if move is None:
+            result = self.engine.search(self.game)
+            if result['frm'] is None:
+                return []
+            move = result['frm'], result['to'], result['promotion']
+        frm, to, promotion = move
+        self.game.move(self.game.squares[frm], to, promotion)
+        return [('Code', format(self.game.played[-1], '04x'))]
+
+
+def main(argv=None):
+    """Command line entry: python -m Engine [--fen FEN] [--time S] [--nodes N] [--depth N] [--workers N]
+    [--tablebase FILE]"""
+    parser = argparse.ArgumentParser(description='Search a position and print the best move')
+    parser.add_argument('--fen', default=START_FEN)
+    parser.add_argument('--time', type=float, default=1.0, help='seconds to search, 0 for no limit')
+    parser.add_argument('--nodes', type=int, default=None, help='most nodes to search')
+    parser.add_argument('--depth', type=int, default=32, help='deepest iteration')
+    parser.add_argument('--workers', type=int, default=1, help='processes to split root moves over')
+    parser.add_argument('--tablebase', default=None, help='tablebase file written by python -m Tablebase build')
+    args = parser.parse_args(argv)
+
+    tablebase = Tablebase(args.tablebase) if args.tablebase else None
+    if args.workers > 1:
+        engine = ParallelEngine(args.workers, args.time or None, args.nodes, args.depth, out=print,
+                                tablebase=tablebase)
+    else:
+        engine = Engine(args.time or None, args.nodes, args.depth, out=print, tablebase=tablebase)
+    result = engine.search(Game.from_fen(args.fen, 'pins'))
+    if args.workers > 1:
+        engine.close()
+    print('bestmove ' + str(result['move']) + '  depth ' + str(result['depth']) + '  score ' + str(result['score'])
+          + '  nodes ' + str(result['nodes']) + '  time ' + format(result['time'], '.3f') + 's  nps '
+          + str(result['nps']))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -150,15 +150,15 @@ class GraphicsUpdater:
                     pieceValue = self.board.white[selectedPieceName].piece
                 else:
                     pieceValue = self.board.black[selectedPieceName].piece
-                if ((self.side == 'white' and pos[1] == 7)
-                    or (self.side == 'black' and pos[1] == 0)) and pieceValue == 'P':
-                    self.promote_ask(selectedPieceName, pos)
-                else:
-                    self.client.sendMove(selectedPieceName + str(pos[0]) + str(pos[1]))
                 if self.nextMove == 'white':
                     self.nextMove = 'black'
                 else:
                     self.nextMove = 'white'
+                if ((self.side == 'white' and pos[1] == 7)
+                    or (self.side == 'black' and pos[1] == 0)) and pieceValue == 'P':
+                    self.promote_ask(selectedPieceName, pos)
+                else:
+                    self.sendPlayed(selectedPieceName)
                 self.selectedPiece = None
                 selectedPieceName = ''
 
@@ -324,10 +324,30 @@ class GraphicsUpdater:
             self.board.promote(self.board.white[piece], value)
         if self.side == 'black':
             self.board.promote(self.board.black[piece], value)
-        self.client.sendProm(piece + value)
-        self.client.sendMove(piece + str(pos[0]) + str(pos[1]))
         self.setBoard()
         window.destroy()
+        # Promotion and move in one message
+        self.sendPlayed(piece)
+
+    def sendPlayed(self, pieceName):
+        """Sends the move just played on the board, encoded by the board, and takes it back if the server
+        refuses it
+        :param pieceName: str"""
+        reply = self.client.sendPlayed(self.board.played[-1], pieceName)
+        if reply.startswith('ERR'):
+            self.takeBack(reply)
+
+    def takeBack(self, reply):
+        """Takes back the last move on the board by replaying the others on a new board, so the board stays
+        the same as the opponent's
+        :param reply: str, the server's refusal"""
+        board = type(self.board)()
+        for code in self.board.played[:-1]:
+            board.applyMove(code)
+        self.board = board
+        self.nextMove = self.side
+        self.setBoard()
+        self.graphics.statusText.configure(text='Move refused, ' + reply)
 
     def connectServer(self):
         """Connects to server based on input"""
@@ -438,13 +458,16 @@ class GraphicsUpdater:
         screen.iconbitmap("ChessPieces/AppIcon.ico")
         winnerLabel = tk.Label(screen, height=10, width=30)
         winnerLabel.grid(row=0, column=0)
-        if winner != 'stalemate':
-            if winner == "Quit":
-                winnerLabel.configure(text=self.otherSide.capitalize() + ' Resigned!')
-            else:
-                winnerLabel.configure(text=winner.capitalize() + ' Won!')
-        else:
+        if winner == 'stalemate':
             winnerLabel.configure(text='A stalemate was reached!')
+        elif winner == 'repetition':
+            winnerLabel.configure(text='Draw by threefold repetition!')
+        elif winner == 'fifty':
+            winnerLabel.configure(text='Draw by the fifty move rule!')
+        elif winner == "Quit":
+            winnerLabel.configure(text=self.otherSide.capitalize() + ' Resigned!')
+        else:
+            winnerLabel.configure(text=winner.capitalize() + ' Won!')
         while True and self.client.running:
             self.update()
 
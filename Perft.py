@@ -0,0 +1,272 @@
+import argparse
+import time
+
+from Chess import Game, Piece, START_FEN, moveName
+from Bitboard import BitboardGame, COLORS, KINDS
+
+# Reference positions with their known node counts {depth: nodes}
+POSITIONS = {
+    'start': (START_FEN, {1: 20, 2: 400, 3: 8902, 4: 197281, 5: 4865609}),
+    'kiwipete': ('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+                 {1: 48, 2: 2039, 3: 97862, 4: 4085603}),
+    'endgame': ('8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+                {1: 14, 2: 191, 3: 2812, 4: 43238, 5: 674624}),
+    'promotions': ('r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+                   {1: 6, 2: 264, 3: 9467, 4: 422333}),
+    'middlegame': ('rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+                   {1: 44, 2: 1486, 3: 62379, 4: 2103487}),
+    'symmetric': ('r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+                  {1: 46, 2: 2079, 3: 89890, 4: 3894594}),
+    # En passant traps
+    'ep-discovered-check': ('3k4/3p4/8/K1P4r/8/8/8/8 b - - 0 1', {1: 18, 2: 92, 3: 1670, 6: 1134888}),
+    'ep-pinned-pawn': ('8/8/4k3/8/2p5/8/B2P2K1/8 w - - 0 1', {1: 13, 2: 102, 3: 1266, 6: 1015133}),
+    'ep-gives-check': ('8/8/1k6/2b5/2pP4/8/5K2/8 b - d3 0 1', {1: 15, 2: 126, 3: 1928, 6: 1440467}),
+    # Castling traps
+    'short-castle-check': ('5k2/8/8/8/8/8/8/4K2R w K - 0 1', {1: 15, 2: 66, 3: 1198, 6: 661072}),
+    'long-castle-check': ('3k4/8/8/8/8/8/8/R3K3 w Q - 0 1', {1: 16, 2: 71, 3: 1286, 6: 803711}),
+    'castle-rights': ('r3k2r/1b4bq/8/8/8/8/7B/R3K2R w KQkq - 0 1', {1: 26, 2: 1141, 3: 27826, 4: 1274206}),
+    'castle-prevented': ('r3k2r/8/3Q4/8/8/5q2/8/R3K2R b KQkq - 0 1', {1: 44, 2: 1494, 3: 50509, 4: 1720476}),
+    # The rook off its corner is read first and must not take the castling rook's name
+    'castle-rook-off-corner': ('4k3/8/8/8/8/8/6R1/R3K3 w Q - 0 1', {1: 30, 2: 131, 3: 3902, 5: 596903}),
+    # Promotion and check traps
+    'promote-out-of-check': ('2K2r2/4P3/8/8/8/8/8/3k4 w - - 0 1', {1: 11, 2: 133, 3: 1442, 6: 3821001}),
+    'discovered-check': ('8/8/1P2K3/8/2n5/1q6/8/5k2 b - - 0 1', {1: 29, 2: 165, 3: 5160, 5: 1004658}),
+    'promote-to-check': ('4k3/1P6/8/8/8/8/K7/8 w - - 0 1', {1: 9, 2: 40, 3: 472, 6: 217342}),
+    'underpromote-to-check': ('8/P1k5/K7/8/8/8/8/8 w - - 0 1', {1: 6, 2: 27, 3: 273, 6: 92683}),
+    'self-stalemate': ('K1k5/8/P7/8/8/8/8/8 w - - 0 1', {1: 2, 2: 6, 3: 13, 6: 2217}),
+    'stalemate-checkmate': ('8/k1P5/8/1K6/8/8/8/8 w - - 0 1', {1: 10, 2: 25, 3: 268, 7: 567584}),
+    'double-check': ('8/8/2k5/5q2/5n2/8/5K2/8 b - - 0 1', {1: 37, 2: 183, 3: 6559, 4: 23527}),
+}
+
+def loadFen(fen, backend='bitboard', generator='pins'):
+    """Sets up a game from FEN on the chosen backend, with legal moves ready for the side to move
+    :param fen: str
+    :param backend: str, 'bitboard' or 'game'
+    :param generator: str, legal move filter of Chess.Game, 'trial' or 'pins'
+    :return: (Game or BitboardGame, str color to move)"""
+    if backend == 'bitboard':
+        game = BitboardGame.from_fen(fen)
+        return game, COLORS[game.turn]
+    game = Game.from_fen(fen, generator)
+    return game, game.turn
+
+
+def perftBitboard(game: BitboardGame, depth):
+    """Counts leaf nodes, counting the moves of the last ply without playing them
+    :param game: BitboardGame
+    :param depth: int
+    :return: int"""
+    moves = game.legalMoves()
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+    nodes = 0
+    for move in moves:
+        game.push(move)
+        nodes += perftBitboard(game, depth - 1)
+        game.pop()
+    return nodes
+
+
+def rootMovesBitboard(game: BitboardGame):
+    """Root moves of a bitboard game, with a function to play and take back each
+    :param game: BitboardGame
+    :return: list of (str, function, function)"""
+    moves = []
+    for move in game.legalMoves():
+        frm = move & 63
+        to = (move >> 6) & 63
+        promotion = KINDS[move >> 12] if move >> 12 else ''
+        moves.append((moveName([frm % 8, frm // 8], [to % 8, to // 8], promotion),
+                      lambda move=move: game.push(move), game.pop))
+    return moves
+
+
+def saveMoves(game: Game):
+    """Keeps the generated move lists of every piece, which make_move leaves alone but regenerating replaces
+    :param game: Game
+    :return: list"""
+    return [(piece, piece.moves, piece.attacks) for side in (game.white, game.black) for piece in side.values()]
+
+
+def restoreMoves(saved):
+    """Puts back move lists kept by saveMoves
+    :param saved: list"""
+    for piece, moves, attacks in saved:
+        piece.moves = moves
+        piece.attacks = attacks
+
+
+def gameMoves(game: Game, color):
+    """Legal moves of a side, a pawn reaching the last row once for each promotion
+    :param game: Game
+    :param color: str
+    :return: list of (Piece, list, str)"""
+    moves = []
+    lastRow = 7 if color == 'white' else 0
+    for piece in (game.white if color == 'white' else game.black).values():
+        for move in piece.simpleMoves:
+            if piece.piece[0] == 'P' and move[1] == lastRow:
+                for value in 'QRBN':
+                    moves.append((piece, move, value))
+            else:
+                moves.append((piece, move, ''))
+    return moves
+
+
+def playGame(game: Game, piece: Piece, move, value, color):
+    """Plays a move on a Game and regenerates the opponent's legal moves, like Game.move does
+    :param game: Game
+    :param piece: Piece
+    :param move: list
+    :param value: str, piece to promote to or ''
+    :param color: str, side playing the move
+    :return: tuple to pass to takeBackGame"""
+    saved = saveMoves(game)
+    previousPos = piece.square
+    undo = game.make_move(piece, move)
+    if value:
+        game.promote(piece, value)
+    game.possibleMoves()
+    game.enPassant(piece, previousPos)
+    game.moveChecker('black' if color == 'white' else 'white')
+    return saved, undo, piece, value
+
+
+def takeBackGame(game: Game, played):
+    """Takes back a move played by playGame
+    :param game: Game
+    :param played: tuple"""
+    saved, undo, piece, value = played
+    if value:
+        game.promote(piece, 'P')
+    game.unmake_move(undo)
+    restoreMoves(saved)
+
+
+def perftGame(game: Game, depth, color):
+    """Counts leaf nodes on Chess.Game, using the same move generation as Game.move
+    :param game: Game
+    :param depth: int
+    :param color: str, side to move
+    :return: int"""
+    moves = gameMoves(game, color)
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+    other = 'black' if color == 'white' else 'white'
+    nodes = 0
+    for piece, move, value in moves:
+        played = playGame(game, piece, move, value, color)
+        nodes += perftGame(game, depth - 1, other)
+        takeBackGame(game, played)
+    return nodes
+
+
+def rootMovesGame(game: Game, color):
+    """Root moves of a Game, with a function to play and take back each
+    :param game: Game
+    :param color: str
+    :return: list of (str, function, function)"""
+    moves = []
+    for piece, move, value in gameMoves(game, color):
+        played = []
+        moves.append((moveName(piece.position, move, value),
+                      lambda piece=piece, move=move, value=value, played=played:
+                      played.append(playGame(game, piece, move, value, color)),
+                      lambda played=played: takeBackGame(game, played.pop())))
+    return moves
+
+
+def perft(fen, depth, backend='bitboard', generator='pins', divide=False, out=print):
+    """Runs perft on a position and reports nodes and nodes per second
+    :param fen: str
+    :param depth: int
+    :param backend: str, 'bitboard' or 'game'
+    :param generator: str, 'trial' or 'pins' for the game backend
+    :param divide: bool, print the node count under every root move
+    :param out: function used for output
+    :return: int nodes"""
+    game, color = loadFen(fen, backend, generator)
+    other = 'black' if color == 'white' else 'white'
+    start = time.perf_counter()
+    if not divide:
+        if backend == 'bitboard':
+            nodes = perftBitboard(game, depth)
+        else:
+            nodes = perftGame(game, depth, color)
+    else:
+        nodes = 0
+        roots = rootMovesBitboard(game) if backend == 'bitboard' else rootMovesGame(game, color)
+        for name, play, takeBack in sorted(roots, key=lambda r: r[0]):
+            play()
+            if backend == 'bitboard':
+                count = perftBitboard(game, depth - 1)
+            else:
+                count = perftGame(game, depth - 1, other)
+            takeBack()
+            out(name + ': ' + str(count))
+            nodes += count
+    elapsed = time.perf_counter() - start
+    out('Nodes: ' + str(nodes) + '  Time: ' + format(elapsed, '.3f') + 's  NPS: '
+        + str(int(nodes / elapsed) if elapsed else 0))
+    return nodes
+
+
+def suite(maxDepth, backend='bitboard', generator='pins', maxNodes=None, out=print):
+    """Checks that every reference position reads back to the same FEN, and its known node counts
+    :param maxDepth: int, deepest depth to run
+    :param backend: str
+    :param generator: str
+    :param maxNodes: int, skip depths expected to exceed this many nodes
+    :param out: function used for output
+    :return: bool, True if every count matched"""
+    ok = True
+    total = 0
+    start = time.perf_counter()
+    for name, (fen, counts) in POSITIONS.items():
+        written = loadFen(fen, backend, generator)[0].to_fen()
+        if written != fen:
+            ok = False
+            out('FAIL ' + name + ' FEN: ' + written + ' expected ' + fen)
+        for depth, expected in sorted(counts.items()):
+            if depth > maxDepth or (maxNodes is not None and expected > maxNodes):
+                continue
+            game, color = loadFen(fen, backend, generator)
+            if backend == 'bitboard':
+                nodes = perftBitboard(game, depth)
+            else:
+                nodes = perftGame(game, depth, color)
+            total += nodes
+            passed = nodes == expected
+            ok = ok and passed
+            out(('OK   ' if passed else 'FAIL ') + name + ' depth ' + str(depth) + ': '
+                + str(nodes) + (' expected ' + str(expected) if not passed else ''))
+    elapsed = time.perf_counter() - start
+    out('Nodes: ' + str(total) + '  Time: ' + format(elapsed, '.3f') + 's  NPS: '
+        + str(int(total / elapsed) if elapsed else 0))
+    return ok
+
+
+def main(argv=None):
+    """Command line entry: python -m Perft --depth N [--fen FEN | --position NAME] [--divide] [--suite]"""
+    parser = argparse.ArgumentParser(description='Count move generator leaf nodes and measure nodes per second')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fen', default=None, help='position to search, defaults to the start position')
+    parser.add_argument('--position', choices=sorted(POSITIONS), help='one of the reference positions')
+    parser.add_argument('--divide', action='store_true', help='print node counts under every root move')
+    parser.add_argument('--backend', choices=('bitboard', 'game'), default='bitboard')
+    parser.add_argument('--generator', choices=('trial', 'pins'), default='pins',
+                        help='legal move filter used by the game backend')
+    parser.add_argument('--suite', action='store_true',
+                        help='check all reference positions up to --depth against their known counts')
+    parser.add_argument('--max-nodes', type=int, default=None, help='skip suite entries larger than this')
+    args = parser.parse_args(argv)
+
+    if args.suite:
+        return 0 if suite(args.depth, args.backend, args.generator, args.max_nodes) else 1
+    fen = args.fen or (POSITIONS[args.position][0] if args.position else START_FEN)
+    perft(fen, args.depth, args.backend, args.generator, args.divide)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
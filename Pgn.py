@@ -0,0 +1,350 @@
+import argparse
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from Chess import Game, squareIndex, squarePosition
+
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+_HEADER = re.compile(r'\[(\w+)\s+"(.*)"\]')
+# Comments, variations are handled separately since they nest
+_NOISE = re.compile(r'\{[^}]*\}|;[^\n]*|\$\d+')
+_MOVE_NUMBER = re.compile(r'^\d+\.+')
+
+
+def readGames(stream):
+    """Yields the games of a PGN text stream one at a time, without reading the whole file
+    :param stream: iterable of str lines, like an open file
+    :return: generator of (dict[str, str] headers, str movetext)"""
+    headers = {}
+    movetext = []
+    for line in stream:
+        line = line.strip()
+        if line.startswith('['):
+            if movetext:
+                yield headers, ' '.join(movetext)
+                headers = {}
+                movetext = []
+            match = _HEADER.match(line)
+            if match:
+                headers[match.group(1)] = match.group(2)
+        elif line:
+            movetext.append(line)
+    if headers or movetext:
+        yield headers, ' '.join(movetext)
+
+
+def sanMoves(movetext):
+    """Moves of a movetext in SAN, leaving out comments, variations, annotations, move numbers and the result
+    :param movetext: str
+    :return: list[str]"""
+    text = _NOISE.sub(' ', movetext)
+    # Variations can nest, keep only what is outside all parentheses
+    depth = 0
+    main = []
+    for char in text:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth = max(depth - 1, 0)
+        elif depth == 0:
+            main.append(char)
+    moves = []
+    for token in ''.join(main).split():
+        token = _MOVE_NUMBER.sub('', token)
+        if token and token not in RESULTS:
+            moves.append(token)
+    return moves
+
+
+def startGame(headers, generator='pins'):
+    """Lazy game at the position a PGN game starts from, the FEN header's for a game set up from one
+    :param headers: dict[str, str], or None for the initial position
+    :param generator: str, legal move filter of the Game
+    :return: Game"""
+    fen = headers.get('FEN') if headers else None
+    if not fen:
+        return Game(generator, lazy=True)
+    try:
+        return Game.from_fen(fen, generator, lazy=True)
+    except (KeyError, IndexError, ValueError):
+        raise ValueError('Bad FEN ' + fen)
+
+
+def legalMoves(game: Game):
+    """Pieces of the side to move with their legal moves as square indexes, generating them if a lazy game
+    has not yet
+    :param game: Game
+    :return: list of (Piece, bytes)"""
+    if game.stale:
+        game.generate()
+    side = game.white if game.turn == 'white' else game.black
+    return [(piece, piece.moves) for piece in side.values() if piece.square >= 0 and piece.moves]
+
+
+def parseSan(game: Game, san):
+    """Finds the move a SAN string stands for in the position of a game
+    :param game: Game
+    :param san: str, like e4, Nbd7, exd6, O-O, e8=Q+
+    :return: (Piece, list, str) piece, position to move to and the promotion or ''"""
+    text = san.rstrip('+#!?')
+    home = 0 if game.turn == 'white' else 56
+    if text in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+        target = home + (6 if len(text) == 3 else 2)
+        for piece, moves in legalMoves(game):
+            if piece.piece[0] == 'K' and piece.movesDone == 0 and target in moves:
+                return piece, squarePosition(target), ''
+        raise ValueError('Illegal move ' + san)
+
+    promotion = ''
+    if '=' in text:
+        text, promotion = text.split('=', 1)
+    elif len(text) > 2 and text[-1] in 'QRBN' and text[0] not in 'KQRBN':
+        # Promotion written without =, like e8Q
+        text, promotion = text[:-1], text[-1]
+    kind = text[0] if text[0] in 'KQRBN' else 'P'
+    body = (text[1:] if kind != 'P' else text).replace('x', '').replace('-', '')
+    target = squareIndex([ord(body[-2]) - ord('a'), int(body[-1]) - 1]) if len(body) >= 2 and \
+        body[-1].isdigit() else None
+    if target is None:
+        raise ValueError('Unreadable move ' + san)
+    hint = body[:-2]
+    found = []
+    for piece, moves in legalMoves(game):
+        if piece.piece[0] != kind or target not in moves:
+            continue
+        x = piece.square % 8
+        y = piece.square // 8
+        if any((c.isalpha() and ord(c) - ord('a') != x) or (c.isdigit() and int(c) - 1 != y) for c in hint):
+            continue
+        found.append(piece)
+    if len(found) != 1:
+        raise ValueError(('Ambiguous' if found else 'Illegal') + ' move ' + san)
+    if kind == 'P' and target // 8 in (0, 7) and promotion not in ('Q', 'R', 'B', 'N'):
+        raise ValueError('Missing promotion in ' + san)
+    return found[0], squarePosition(target), promotion if kind == 'P' else ''
+
+
+def playMove(game: Game, piece, position, promotion=''):
+    """Plays a move through Game.move, promotion included
+    :param game: Game
+    :param piece: Piece
+    :param position: list
+    :param promotion: str"""
+    game.move(piece, position, promotion)
+
+
+def playSan(game: Game, san):
+    """Plays a SAN move on a game
+    :param game: Game
+    :param san: str
+    :return: (Piece, list, str) the move played, see parseSan"""
+    move = parseSan(game, san)
+    playMove(game, *move)
+    return move
+
+
+def moveSan(game: Game, piece, position, promotion=''):
+    """Writes a legal move of the side to move in SAN, before it is played
+    :param game: Game
+    :param piece: Piece
+    :param position: list
+    :param promotion: str
+    :return: str"""
+    target = squareIndex(position)
+    kind = piece.piece[0]
+    name = 'abcdefgh'[position[0]] + str(position[1] + 1)
+    if kind == 'K' and abs(target - piece.square) == 2:
+        san = 'O-O' if target % 8 == 6 else 'O-O-O'
+    elif kind == 'P':
+        san = name
+        if target % 8 != piece.square % 8:
+            san = 'abcdefgh'[piece.square % 8] + 'x' + name
+        if promotion:
+            san += '=' + promotion
+    else:
+        others = [other for other, moves in legalMoves(game)
+                  if other is not piece and other.piece[0] == kind and target in moves]
+        hint = ''
+        if others:
+            if all(other.square % 8 != piece.square % 8 for other in others):
+                hint = 'abcdefgh'[piece.square % 8]
+            elif all(other.square // 8 != piece.square // 8 for other in others):
+                hint = str(piece.square // 8 + 1)
+            else:
+                hint = 'abcdefgh'[piece.square % 8] + str(piece.square // 8 + 1)
+        san = kind + hint + ('x' if game.squares[target] is not None else '') + name
+    # Check, with the promoted piece in place
+    value = piece.piece
+    undo = game.make_move(piece, target)
+    if promotion:
+        piece.piece = promotion
+    enemy = game.black if piece.color == 'white' else game.white
+    check = game.isAttacked(enemy['K0'].square, piece.color)
+    piece.piece = value
+    game.unmake_move(undo)
+    return san + ('+' if check else '')
+
+
+def writeGame(moves, headers=None, result='*'):
+    """Formats SAN moves as a PGN game
+    :param moves: list[str]
+    :param headers: dict[str, str]
+    :param result: str
+    :return: str"""
+    headers = dict(headers or {})
+    headers.setdefault('Result', result)
+    lines = ['[' + key + ' "' + value + '"]' for key, value in headers.items()]
+    text = []
+    for i, san in enumerate(moves):
+        if i % 2 == 0:
+            text.append(str(i // 2 + 1) + '.')
+        text.append(san)
+    text.append(headers['Result'])
+    return '\n'.join(lines) + '\n\n' + ' '.join(text) + '\n'
+
+
+def pieceName(game: Game, piece):
+    """Name of a piece in its side, like R1 or P3, as clients and the server send it
+    :param game: Game
+    :param piece: Piece
+    :return: str"""
+    side = game.white if piece.color == 'white' else game.black
+    return next(name for name, other in side.items() if other is piece)
+
+
+def replayGame(movetext, generator='pins', names=False, headers=None):
+    """Replays the moves of a game through Game.move and turns them into the Code messages clients send,
+    a move with its promotion each
+    :param movetext: str
+    :param generator: str, legal move filter of the Game
+    :param names: bool, give the messages by piece name instead, Move P#xy and Prom P#V, Prom before Move
+        as clients of the text protocol send them
+    :param headers: dict[str, str], a FEN header sets the start position
+    :return: (list[str], str, str, bytes) messages, winner of the final position, the error or ''
+        and the game record of the moves replayed"""
+    try:
+        game = startGame(headers, generator)
+    except ValueError as e:
+        return [], '', str(e), b''
+    named = []
+    error = ''
+    for ply, san in enumerate(sanMoves(movetext)):
+        try:
+            piece, position, promotion = parseSan(game, san)
+        except ValueError as e:
+            error = 'ply ' + str(ply + 1) + ': ' + str(e)
+            break
+        if names:
+            name = pieceName(game, piece)
+            if promotion:
+                named.append('Prom' + name + promotion)
+            named.append('Move' + name + str(position[0]) + str(position[1]))
+        playMove(game, piece, position, promotion)
+    return named if names else codeMessages(game), game.winner, error, game.toRecord()
+
+
+def codeMessages(game: Game):
+    """Moves played on a game as Code messages
+    :param game: Game
+    :return: list[str]"""
+    return ['Code' + format(code, '04x') for code in game.played]
+
+
+def replayChunk(games, generator='pins', names=False):
+    """Worker process task: replays a chunk of games
+    :param games: list of (int number, dict headers, str movetext)
+    :param generator: str
+    :param names: bool, see replayGame
+    :return: list of dict with number, headers, moves, winner, error and record"""
+    results = []
+    for number, headers, movetext in games:
+        moves, winner, error, record = replayGame(movetext, generator, names, headers)
+        results.append({'number': number, 'headers': headers, 'moves': moves, 'winner': winner, 'error': error,
+                        'record': record})
+    return results
+
+
+def importGames(paths, workers=2, chunk=50, generator='pins', names=False):
+    """Replays every game of PGN files, spreading chunks of games over worker processes.
+    Files are read as a stream and only a few chunks per worker are in flight, so memory stays flat
+    however large the archive
+    :param paths: list[str], PGN files
+    :param workers: int, processes, 1 replays in this process
+    :param chunk: int, games sent to a worker at once
+    :param generator: str, legal move filter of the Game
+    :param names: bool, messages by piece name, see replayGame
+    :return: generator of dicts from replayChunk, in file order"""
+    def chunks():
+        number = 0
+        for path in paths:
+            with open(path, encoding='utf-8', errors='replace') as stream:
+                games = readGames(stream)
+                while True:
+                    batch = []
+                    for headers, movetext in islice(games, chunk):
+                        number += 1
+                        batch.append((number, headers, movetext))
+                    if not batch:
+                        break
+                    yield batch
+
+    if workers <= 1:
+        for batch in chunks():
+            yield from replayChunk(batch, generator, names)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for batch in chunks():
+            pending.append(pool.submit(replayChunk, batch, generator, names))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def main(argv=None):
+    """Command line entry: python -m Pgn PGN... [--workers N] [--moves FILE [--names]] [--records FILE] [...]"""
+    parser = argparse.ArgumentParser(description='Replay the games of PGN files through Chess.Game')
+    parser.add_argument('pgn', nargs='+')
+    parser.add_argument('--workers', type=int, default=2, help='processes to replay games in')
+    parser.add_argument('--chunk', type=int, default=50, help='games sent to a worker at once')
+    parser.add_argument('--generator', choices=('trial', 'pins'), default='pins')
+    parser.add_argument('--moves', default=None, help='file to write each game as client messages, a line per game')
+    parser.add_argument('--names', action='store_true',
+                        help='write moves as Move/Prom messages by piece name instead of Code messages')
+    parser.add_argument('--records', default=None, help='file to write the games without errors as game records')
+    args = parser.parse_args(argv)
+
+    output = open(args.moves, 'w') if args.moves else None
+    records = open(args.records, 'wb') if args.records else None
+    games = 0
+    errors = 0
+    moves = 0
+    start = time.perf_counter()
+    for result in importGames(args.pgn, args.workers, args.chunk, args.generator, args.names):
+        games += 1
+        moves += len(result['moves'])
+        if result['error']:
+            errors += 1
+            headers = result['headers']
+            print('Game ' + str(result['number']) + ' (' + headers.get('White', '?') + ' - '
+                  + headers.get('Black', '?') + '): ' + result['error'])
+        if output is not None:
+            output.write(str(result['number']) + ' ' + ' '.join(result['moves']) + '\n')
+        if records is not None and not result['error']:
+            records.write(result['record'])
+    elapsed = time.perf_counter() - start
+    if output is not None:
+        output.close()
+    if records is not None:
+        records.close()
+    print('Games: ' + str(games) + '  Errors: ' + str(errors) + '  Messages: ' + str(moves) + '  Time: '
+          + format(elapsed, '.3f') + 's  Games/s: ' + format(games / elapsed if elapsed else 0.0, '.1f'))
+    return 0 if not errors else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,147 @@
+import struct
+
+# Sent first by a client wanting framed messages and echoed by a server that speaks them. A text message
+# starts with the user name, never with a zero byte, so the server tells the two apart by the first bytes
+HELLO = b'\x00CHF\x01'
+# Greeting of a client carrying requests, replies and server pushes over one connection
+HELLO_MULTIPLEXED = b'\x00CHF\x02'
+# Frame: body length, then the body
+LENGTH = struct.Struct('>I')
+# Client request body: command, user name length, user name, cookie length, cookie, then data to the end
+REQUEST = struct.Struct('>BH')
+FIELD = struct.Struct('>H')
+# Multiplexed frames start with a message id. A reply carries the id of its request, a push carries PUSH
+MESSAGE_ID = struct.Struct('>I')
+PUSH = 0
+COMMANDS = ('Cookie', 'User', 'SetRecv', 'Start', 'GetName', 'Move', 'Prom', 'Code', 'Chat', 'End', 'Stats')
+# Longest body accepted, anything longer is taken for a broken stream
+MAX_FRAME = 1 << 20
+
+
+def encodeFrame(body):
+    """Prefixes a body with its length
+    :param body: bytes
+    :return: bytes"""
+    return LENGTH.pack(len(body)) + body
+
+
+def requestBody(user, cookie, command, data):
+    """Body of a client request. Fields are counted, not split on ':', so they may hold any text
+    :param user: str
+    :param cookie: str
+    :param command: str, one of COMMANDS
+    :param data: str
+    :return: bytes"""
+    user = user.encode()
+    cookie = cookie.encode()
+    return REQUEST.pack(COMMANDS.index(command), len(user)) + user + FIELD.pack(len(cookie)) + cookie + data.encode()
+
+
+def encodeRequest(user, cookie, command, data):
+    """Frames a client request
+    :param user: str
+    :param cookie: str
+    :param command: str, one of COMMANDS
+    :param data: str
+    :return: bytes"""
+    return encodeFrame(requestBody(user, cookie, command, data))
+
+
+def decodeRequest(body, offset=0):
+    """Reads a framed client request
+    :param body: bytes, frame body
+    :param offset: int, start of the request in the body
+    :return: (str, str, str, str) user, cookie, command and data"""
+    code, length = REQUEST.unpack_from(body, offset)
+    if code >= len(COMMANDS):
+        raise ValueError('Unknown command ' + str(code))
+    start = offset + REQUEST.size + length
+    user = body[offset + REQUEST.size:start].decode()
+    length, = FIELD.unpack_from(body, start)
+    start += FIELD.size
+    cookie = body[start:start + length].decode()
+    data = body[start + length:].decode()
+    return user, cookie, COMMANDS[code], data
+
+
+def encodeReply(msg):
+    """Frames a server message, the body is the same text the text protocol sends
+    :param msg: str
+    :return: bytes"""
+    return encodeFrame(msg.encode())
+
+
+def encodeMultiplexedRequest(messageId, user, cookie, command, data):
+    """Frames a client request on a multiplexed connection
+    :param messageId: int, above PUSH, returned with the reply
+    :param user: str
+    :param cookie: str
+    :param command: str, one of COMMANDS
+    :param data: str
+    :return: bytes"""
+    return encodeFrame(MESSAGE_ID.pack(messageId) + requestBody(user, cookie, command, data))
+
+
+def decodeMultiplexedRequest(body):
+    """Reads a client request of a multiplexed connection
+    :param body: bytes, frame body
+    :return: (int, str, str, str, str) message id, user, cookie, command and data"""
+    messageId, = MESSAGE_ID.unpack_from(body)
+    return (messageId,) + decodeRequest(body, MESSAGE_ID.size)
+
+
+def encodeMultiplexedReply(messageId, msg):
+    """Frames a server message on a multiplexed connection
+    :param messageId: int, id of the request answered, or PUSH
+    :param msg: str
+    :return: bytes"""
+    return encodeFrame(MESSAGE_ID.pack(messageId) + msg.encode())
+
+
+def decodeMultiplexedReply(body):
+    """Reads a server message of a multiplexed connection
+    :param body: bytes, frame body
+    :return: (int, str) message id, PUSH for a push, and the text"""
+    messageId, = MESSAGE_ID.unpack_from(body)
+    return messageId, body[MESSAGE_ID.size:].decode()
+
+
+class FrameDecoder:
+    """Splits a byte stream into frames, whatever way the network cut or joined them.
+    Bytes go into one buffer that is reused, consumed frames are cut off the front only when more data comes"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # Start of the bytes not yet read as a frame
+        self.position = 0
+
+    def feed(self, data):
+        """Adds received bytes
+        :param data: bytes"""
+        if self.position:
+            del self.buffer[:self.position]
+            self.position = 0
+        self.buffer += data
+
+    def next(self):
+        """Takes the next whole frame
+        :return: bytes body, or None until more data is fed"""
+        available = len(self.buffer) - self.position
+        if available < LENGTH.size:
+            return None
+        length, = LENGTH.unpack_from(self.buffer, self.position)
+        if length > MAX_FRAME:
+            raise ValueError('Frame of ' + str(length) + ' bytes is too long')
+        if available < LENGTH.size + length:
+            return None
+        start = self.position + LENGTH.size
+        self.position = start + length
+        return bytes(self.buffer[start:self.position])
+
+    def frames(self):
+        """Takes every whole frame fed so far
+        :return: generator of bytes"""
+        frame = self.next()
+        while frame is not None:
+            yield frame
+            frame = self.next()
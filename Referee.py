@@ -0,0 +1,141 @@
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from Chess import Game
+
+# Games checked by this worker, by game id    {game id: [Game, promotion sent ahead of its move or None]}
+_games = {}
+
+
+def openGame(gameId):
+    """Worker task: starts refereeing a game from the start position
+    :param gameId: str"""
+    _games[gameId] = [Game('pins', lazy=True), None]
+
+
+def closeGame(gameId):
+    """Worker task: forgets a game
+    :param gameId: str"""
+    _games.pop(gameId, None)
+
+
+def checkMove(gameId, color, command, data):
+    """Worker task: plays a move on the referee's game if it is legal for the player sending it
+    :param gameId: str
+    :param color: str, side of the player sending the move
+    :param command: str, Code, Move or Prom, see Server.handle_command
+    :param data: str
+    :return: str, why the move is refused, '' if it was played"""
+    entry = _games.get(gameId)
+    if entry is None:
+        return 'No game'
+    game = entry[0]
+    side = game.white if color == 'white' else game.black
+    try:
+        if command == 'Code':
+            if game.turn != color:
+                return 'Not your turn'
+            game.applyMove(int(data, 16))
+            return ''
+        if command == 'Prom':
+            piece = side[data[0:2]]
+            if data[2] not in 'QRBN':
+                return 'Bad promotion'
+            if piece.piece[0] == 'P' and piece.square // 8 == (7 if color == 'white' else 0):
+                game.promote(piece, data[2])
+            elif game.turn == color and piece.piece[0] == 'P':
+                # Sent ahead of the pawn move, kept until the move arrives
+                entry[1] = data[2]
+            else:
+                return 'Bad promotion'
+            return ''
+        if game.turn != color:
+            return 'Not your turn'
+        piece = side[data[0:2]]
+        to = int(data[2]) + 8 * int(data[3])
+        if game.stale:
+            game.generate()
+        if piece.square < 0 or to not in piece.moves:
+            return 'Illegal move'
+        promotion = ''
+        if piece.piece[0] == 'P' and (to < 8 or to >= 56) and entry[1] is not None:
+            promotion = entry[1]
+        entry[1] = None
+        game.move(piece, to, promotion)
+        return ''
+    except (KeyError, IndexError, ValueError) as error:
+        return str(error) or 'Bad move'
+
+
+class Referee:
+    """Keeps a Chess.Game per game and checks every move on it in a pool of workers, so the server never
+    forwards an illegal move and the move generation never holds up the server.
+    A game always goes to the same worker, which keeps its moves in order"""
+
+    def __init__(self, workers=2, processes=True, window=10000):
+        """:param workers: int
+        :param processes: bool, worker processes, else threads
+        :param window: int, latest checks kept for the latency percentiles"""
+        pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self.shards = [pool(1) for _ in range(workers)]
+        # Starts the workers now, a process started later would inherit the server's listening socket
+        for shard in self.shards:
+            shard.submit(int).result()
+        # Done callbacks run in the threads of every shard
+        self.counted = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.checked = 0
+
+    def shard(self, gameId):
+        """Worker a game lives in, the same in every run
+        :param gameId: str
+        :return: Executor"""
+        return self.shards[zlib.crc32(gameId.encode()) % len(self.shards)]
+
+    def open(self, gameId):
+        """Starts refereeing a game
+        :param gameId: str"""
+        self.shard(gameId).submit(openGame, gameId)
+
+    def close(self, gameId):
+        """Stops refereeing a game
+        :param gameId: str"""
+        self.shard(gameId).submit(closeGame, gameId)
+
+    def check(self, gameId, color, command, data):
+        """Checks and plays a move in the game's worker
+        :param gameId: str
+        :param color: str
+        :param command: str
+        :param data: str
+        :return: concurrent.futures.Future of str, see checkMove"""
+        start = time.perf_counter()
+        future = self.shard(gameId).submit(checkMove, gameId, color, command, data)
+
+        def done(finished):
+            latency = time.perf_counter() - start
+            with self.counted:
+                self.checked += 1
+                self.latencies.append(latency)
+
+        future.add_done_callback(done)
+        return future
+
+    def percentiles(self):
+        """Latency of the latest checks, from submitting a move to its answer
+        :return: dict with count of all checks and p50, p90, p99 and max in milliseconds"""
+        with self.counted:
+            latencies = sorted(self.latencies)
+            stats = {'count': self.checked}
+        for name, share in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)):
+            stats[name] = latencies[min(int(share * len(latencies)), len(latencies) - 1)] * 1000 if latencies \
+                else 0.0
+        return stats
+
+    def shutdown(self):
+        """Stops the workers"""
+        for shard in self.shards:
+            shard.shutdown()
@@ -1,16 +1,175 @@
 from socket import *
+from contextlib import contextmanager
+import argparse
+import asyncio
 import threading
+import time
+import zlib
+
+from Book import OpeningBook
+from Engine import Bot
+import Protocol
+from Referee import Referee
+from Tablebase import Tablebase
+
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def raise_file_limit():
+    """Raises the soft limit of open files to the hard limit, each connection takes a file descriptor"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class LockStripes:
+    """A fixed number of locks shared out by key: a key always takes the same lock, and threads working on
+    different keys seldom wait on each other. Counts how often each lock was taken and how often it had to be
+    waited for, so contention can be measured"""
+
+    def __init__(self, stripes=16):
+        """:param stripes: int, locks"""
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        # Counters per lock, only changed while holding it
+        self.acquired = [0] * stripes
+        self.contended = [0] * stripes
+        self.waited = [0.0] * stripes
+
+    @contextmanager
+    def hold(self, key=''):
+        """Holds the lock of a key for the body of a with statement
+        :param key: str"""
+        index = zlib.crc32(key.encode()) % len(self.locks) if len(self.locks) > 1 else 0
+        lock = self.locks[index]
+        waited = None
+        if not lock.acquire(False):
+            start = time.perf_counter()
+            lock.acquire()
+            waited = time.perf_counter() - start
+        try:
+            self.acquired[index] += 1
+            if waited is not None:
+                self.contended[index] += 1
+                self.waited[index] += waited
+            yield
+        finally:
+            lock.release()
+
+    def counters(self):
+        """:return: dict with the times the locks were acquired, contended and the seconds waited for them"""
+        return {'acquired': sum(self.acquired), 'contended': sum(self.contended), 'waited': sum(self.waited)}
+
+
+class Matchmaker:
+    """Players waiting for a game, indexed so a match is found without looking through everyone waiting:
+    a queue of players taking any opponent per rating bucket, and the players challenging each user name.
+    Finding a match and taking both players out happens under one lock"""
+
+    def __init__(self, bucket_size=None):
+        """:param bucket_size: int, rating points per bucket, players taking any opponent are matched within
+            their bucket or the next ones. None puts everybody in one bucket"""
+        self.bucket_size = bucket_size
+        self.lock = LockStripes(1)
+        # Everyone waiting    {cookie: (user, desired opponent, bucket, arrival number)}
+        self.entries = {}
+        # Maps the user name of a waiting player to its cookie    {user: cookie}
+        self.users = {}
+        # Players taking any opponent, oldest first, by bucket    {bucket: {cookie: None}}
+        self.anyone = {}
+        # Players waiting for one user, oldest first    {desired user: {cookie: None}}
+        self.challenges = {}
+        self.arrivals = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, cookie):
+        return cookie in self.entries
+
+    def bucket(self, rating):
+        """:param rating: int or None
+        :return: int bucket, None without ratings"""
+        if self.bucket_size is None or rating is None:
+            return None
+        return int(rating) // self.bucket_size
+
+    def match(self, cookie, user, desired='None', rating=None):
+        """Matches a player with a waiting opponent, or makes the player wait. A player taking any opponent gets
+        whoever waits longest among the players challenging them and those in reach of their rating
+        :param cookie: str
+        :param user: str
+        :param desired: str, user name of the opponent wanted, 'None' for anyone
+        :param rating: int, or None
+        :return: str cookie of the opponent, who no longer waits, or None if the player now waits"""
+        with self.lock.hold():
+            self.remove(cookie)
+            key = self.bucket(rating)
+            if desired == 'None':
+                candidates = [self.challenges.get(user)]
+                if key is None:
+                    candidates.append(self.anyone.get(None))
+                else:
+                    candidates += [self.anyone.get(key - 1), self.anyone.get(key), self.anyone.get(key + 1)]
+                oldest = [next(iter(waiting)) for waiting in candidates if waiting]
+                if oldest:
+                    opponent = min(oldest, key=lambda waiting: self.entries[waiting][3])
+                    self.remove(opponent)
+                    return opponent
+            else:
+                opponent = self.users.get(desired)
+                if opponent is not None and self.entries[opponent][1] in ('None', user):
+                    self.remove(opponent)
+                    return opponent
+            self.arrivals += 1
+            self.entries[cookie] = (user, desired, key, self.arrivals)
+            self.users[user] = cookie
+            if desired == 'None':
+                self.anyone.setdefault(key, {})[cookie] = None
+            else:
+                self.challenges.setdefault(desired, {})[cookie] = None
+            return None
+
+    def leave(self, cookie):
+        """Takes a player out of the queue if waiting
+        :param cookie: str"""
+        with self.lock.hold():
+            self.remove(cookie)
+
+    def remove(self, cookie):
+        """Takes a player out of every index, the lock must be held
+        :param cookie: str"""
+        entry = self.entries.pop(cookie, None)
+        if entry is None:
+            return
+        user, desired, key, arrival = entry
+        if self.users.get(user) == cookie:
+            del self.users[user]
+        index, name = (self.anyone, key) if desired == 'None' else (self.challenges, desired)
+        waiting = index[name]
+        del waiting[cookie]
+        # Names challenged once would otherwise pile up
+        if not waiting:
+            del index[name]
 
 
 class Queue:
-    """Provides data that the Server uses to manage games and clients"""
+    """Provides data that the Server uses to manage games and clients. Client threads change it through the
+    methods below, which hold the lock of the name, cookie or game they change"""
 
-    def __init__(self):
-        """Initialize needed Queues and vars"""
+    def __init__(self, stripes=16):
+        """Initialize needed Queues and vars
+        :param stripes: int, locks of each kind"""
         # Maps user to cookie    {username: cookie}
         self.userMap = {}
-        # dict of people waiting for game {cookie: desiredOpponentCookie}
-        self.waiting = {}
+        # People waiting for a game, see Matchmaker
+        self.waiting = Matchmaker()
         # dict of ongoing games    {cookie : opCookie}
         self.game = {}
         # Maps cookie to user    {cookie: user}
@@ -19,20 +178,132 @@ class Queue:
         self.cookieReceiver = {}
         # Keeps track of number of users, cookies based off of this
         self.users = 0
+        # Computer opponents by their cookie    {cookie: Bot}
+        self.bots = {}
+        # Side each player of a game has    {cookie: 'white' or 'black'}
+        self.colors = {}
+        # Locks by user name for userMap, by cookie for cookieMap and cookieReceiver, by white cookie for game,
+        # colors and bots
+        self.names = LockStripes(stripes)
+        self.sessions = LockStripes(stripes)
+        self.games = LockStripes(stripes)
+        self.cookies = LockStripes(1)
+
+    def new_cookie(self):
+        """Hands out the next cookie, never the same one twice
+        :return: str"""
+        with self.cookies.hold():
+            self.users += 1
+            return str(self.users)
+
+    def claim_user(self, user, cookie):
+        """Gives a user name to a client unless another client has it
+        :param user: str
+        :param cookie: str
+        :return: bool, True if the client has the name now"""
+        with self.names.hold(user):
+            return self.userMap.setdefault(user, cookie) == cookie
+
+    def release_user(self, user, cookie=None):
+        """Frees a user name
+        :param user: str
+        :param cookie: str, frees the name only if this client still has it, None frees it anyway
+        :return: str cookie that had the name, None if nothing was freed"""
+        with self.names.hold(user):
+            if cookie is not None and self.userMap.get(user) != cookie:
+                return None
+            return self.userMap.pop(user, None)
+
+    def set_name(self, cookie, user):
+        """Records the user name of a client, or of a computer opponent
+        :param cookie: str
+        :param user: str"""
+        with self.sessions.hold(cookie):
+            self.cookieMap[cookie] = user
+
+    def set_receiver(self, cookie, connection):
+        """Sends what is pushed to a client through connection from now on
+        :param cookie: str
+        :param connection: socket or asyncio.StreamWriter"""
+        with self.sessions.hold(cookie):
+            self.cookieReceiver[cookie] = connection
+
+    def drop_receiver(self, cookie, connection):
+        """Forgets the receiver of a client if it is still connection, a newer one is kept
+        :param cookie: str
+        :param connection: socket or asyncio.StreamWriter
+        :return: bool, True if connection was the receiver"""
+        with self.sessions.hold(cookie):
+            if self.cookieReceiver.get(cookie) is not connection:
+                return False
+            del self.cookieReceiver[cookie]
+            return True
+
+    def pair(self, white, black, bot=None):
+        """Records a new game
+        :param white: str, cookie
+        :param black: str, cookie
+        :param bot: Bot playing black, or None"""
+        with self.games.hold(white):
+            if bot is not None:
+                self.bots[black] = bot
+            self.colors[white] = 'white'
+            self.colors[black] = 'black'
+            self.game[white] = black
+            self.game[black] = white
+
+    def end_game(self, cookie):
+        """Forgets the game of a client and the names of both players
+        :param cookie: str
+        :return: (str cookie of white, Bot or None), None if the client had no game or it ended already"""
+        opponent = self.game.get(cookie)
+        ended = None
+        if opponent is not None:
+            white = cookie if self.colors.get(cookie) == 'white' else opponent
+            with self.games.hold(white):
+                # The opponent may have ended it meanwhile
+                if self.game.get(cookie) == opponent:
+                    for player in (cookie, opponent):
+                        self.game.pop(player, None)
+                        self.colors.pop(player, None)
+                    ended = (white, self.bots.pop(opponent, None))
+        for player in (cookie, opponent) if ended is not None else (cookie,):
+            with self.sessions.hold(player):
+                self.cookieMap.pop(player, None)
+        return ended
+
+    def contention(self):
+        """:return: dict of LockStripes.counters by what the locks guard"""
+        return {'names': self.names.counters(), 'sessions': self.sessions.counters(),
+                'games': self.games.counters(), 'cookies': self.cookies.counters(),
+                'waiting': self.waiting.lock.counters()}
 
 
 class Server:
     """Communicates to Clients"""
 
-    def __init__(self, address='0.0.0.0', port_number=4000, connections=10):
-        """Binds to address:port, creates a Queue object, and threads off incoming connections.
-         Handles up to connections/2 clients,
-        as each client requires 2 socket connections
+    def __init__(self, address='0.0.0.0', port_number=4000, connections=10, bot_latency=1.0, book_path=None,
+                 tablebase_path=None, mode='thread', referee_workers=2, referee_processes=True):
+        """Binds to address:port, creates a Queue object, and serves incoming connections.
+        In thread mode every connection gets a thread, and as each client requires 2 socket connections
+        that is 2 threads per client, 1 for a multiplexed client. In asyncio mode one event loop serves every
+        connection
         :param address: str
         :param port_number: int
-        :param connections: int"""
+        :param connections: int, backlog of connections waiting to be accepted
+        :param bot_latency: float, seconds a computer opponent may take per move
+        :param book_path: str, opening book shared by all computer opponents, or None
+        :param tablebase_path: str, endgame tablebase shared by all computer opponents, or None
+        :param mode: str, 'thread' or 'asyncio'
+        :param referee_workers: int, workers checking moves, 0 forwards moves unchecked
+        :param referee_processes: bool, the workers are processes, else threads"""
 
         identifier = (address, port_number)
+        self.setup(bot_latency, book_path, tablebase_path, referee_workers, referee_processes)
+
+        if mode == 'asyncio':
+            asyncio.run(self.serve(identifier, connections))
+            return
 
         # Create and bind server socket.
         self.server_socket = socket(AF_INET, SOCK_STREAM)
@@ -40,160 +311,507 @@ class Server:
 
         self.server_socket.listen(connections)
 
-        self.q = Queue()
-
         while True:
             connection_socket, client_address = self.server_socket.accept()
             thread = threading.Thread(target=self.handle_client, args=(connection_socket,))
             thread.start()
 
-    def reply(self, socket, msg=''):
-        """Sends message to socket
-        :param socket: socket
+    def setup(self, bot_latency=1.0, book_path=None, tablebase_path=None, referee_workers=2, referee_processes=True):
+        """Creates the Queue and what the server shares between games, see __init__
+        :param bot_latency: float
+        :param book_path: str or None
+        :param tablebase_path: str or None
+        :param referee_workers: int
+        :param referee_processes: bool"""
+        self.bot_latency = bot_latency
+        self.book = OpeningBook(book_path) if book_path else None
+        self.tablebase = Tablebase(tablebase_path) if tablebase_path else None
+
+        self.q = Queue()
+        # Checks every move before it is forwarded, see Referee
+        self.referee = Referee(referee_workers, referee_processes) if referee_workers else None
+        # Maps a connection set as receiver to its cookie, to clean up when it drops    {connection: cookie}
+        self.receiver_cookies = {}
+        # Connections that negotiated the framed protocol
+        self.framed = set()
+        # Framed connections carrying replies and pushes alike, and the id of the request each is serving
+        self.multiplexed = set()
+        self.request_ids = {}
+        # Lock of every socket in thread mode, other clients' threads push through it too    {socket: Lock}
+        self.writing = {}
+        # Connections being passed to another process, whatever else they sent is left unread
+        self.moving = set()
+        # Event loop of the asyncio mode, None in thread mode
+        self.loop = None
+
+    async def serve(self, identifier, connections):
+        """Serves every connection on the running event loop, forever
+        :param identifier: (str, int) address and port
+        :param connections: int, backlog"""
+        self.loop = asyncio.get_running_loop()
+        raise_file_limit()
+        server = await asyncio.start_server(self.handle_stream, identifier[0], identifier[1], backlog=connections)
+        print('Serving on', identifier, 'with asyncio')
+        async with server:
+            await server.serve_forever()
+
+    def reply(self, socket, msg='', message_id=None):
+        """Sends message to socket, framed if the client negotiated frames
+        :param socket: socket or asyncio.StreamWriter
+        :param msg: str
+        :param message_id: int, id a multiplexed connection gets the message with, defaults to the id of the
+            request the connection is serving"""
+        if socket in self.multiplexed:
+            if message_id is None:
+                message_id = self.request_ids.get(socket, Protocol.PUSH)
+            self.write(socket, Protocol.encodeMultiplexedReply(message_id, msg))
+        elif socket in self.framed:
+            self.write(socket, Protocol.encodeReply(msg))
+        else:
+            self.write(socket, msg.encode())
+
+    def push(self, cookie, msg):
+        """Sends a message the client did not ask for, through the connection it set as receiver
+        :param cookie: str
         :param msg: str"""
-        reply = msg.encode()
-        socket.send(reply)
+        receiver = self.q.cookieReceiver.get(cookie)
+        # A client that has left gets nothing
+        if receiver is not None:
+            self.reply(receiver, msg, Protocol.PUSH)
+
+    def write(self, socket, data):
+        """Sends bytes to socket, or queues them on the event loop's transport for a stream
+        :param socket: socket or asyncio.StreamWriter
+        :param data: bytes"""
+        if isinstance(socket, asyncio.StreamWriter):
+            socket.write(data)
+            return
+        lock = self.writing.get(socket)
+        if lock is None:
+            socket.sendall(data)
+            return
+        # A frame goes out whole, even when the opponent's thread pushes to the socket meanwhile
+        with lock:
+            socket.sendall(data)
+
+    def negotiate(self, connection, data):
+        """Picks the protocol of a connection from the first data it sent. A client opening with Protocol.HELLO
+        gets frames, one opening with Protocol.HELLO_MULTIPLEXED gets frames with message ids, and both get
+        their greeting back. Any other gets the text protocol
+        :param connection: socket or asyncio.StreamWriter
+        :param data: bytes, at least len(Protocol.HELLO) unless the connection closed
+        :return: (Protocol.FrameDecoder, bytes) decoder, None for text, and the data after the greeting"""
+        greeting = data[:len(Protocol.HELLO)]
+        if greeting == Protocol.HELLO_MULTIPLEXED:
+            self.multiplexed.add(connection)
+        elif greeting != Protocol.HELLO:
+            return None, data
+        self.framed.add(connection)
+        self.write(connection, greeting)
+        return Protocol.FrameDecoder(), data[len(greeting):]
+
+    def start_bot(self, cookie, user):
+        """Starts a game against a computer opponent, the client plays white
+        :param cookie: str
+        :param user: str"""
+        bot_cookie = self.q.new_cookie()
+        self.q.set_name(bot_cookie, 'Bot')
+        self.q.set_name(cookie, user)
+        self.start_game(cookie, bot_cookie, Bot('black', self.bot_latency, book=self.book, tablebase=self.tablebase))
+        self.push(cookie, str("StartW" + bot_cookie))
+
+    def start_game(self, white, black, bot=None):
+        """Records a new game and has the referee follow it
+        :param white: str, cookie
+        :param black: str, cookie
+        :param bot: Bot playing black, or None"""
+        self.q.pair(white, black, bot)
+        if self.referee is not None:
+            self.referee.open(white)
+
+    def leave_game(self, cookie, result='Quit'):
+        """Ends the game of a client that closed or lost its connection, or ended the game, and frees the names
+        :param cookie: str
+        :param result: str, sent to the opponent after 'End'"""
+        opponent = self.q.game.get(cookie)
+        user = self.q.cookieMap.get(cookie)
+        opponent_user = self.q.cookieMap.get(opponent)
+        ended = self.q.end_game(cookie)
+        # Remove from Queue
+        self.q.waiting.leave(cookie)
+        if ended is not None:
+            white, bot = ended
+            if self.referee is not None:
+                self.referee.close(white)
+            # Computer opponent leaves with the game
+            if bot is None:
+                self.push(opponent, str("End" + result))
+                # Free up oponents username
+                if opponent_user is not None:
+                    self.release_user(opponent_user, opponent)
+        if user is not None:
+            self.release_user(user, cookie)
+
+    def game_id(self, cookie):
+        """Id of the game a client plays, the cookie of its white player
+        :param cookie: str
+        :return: str"""
+        return cookie if self.q.colors[cookie] == 'white' else self.q.game[cookie]
+
+    def check_move(self, connection, cookie, command, data):
+        """Has the referee check a move in its worker pool, then answers and forwards it, or refuses it.
+        The connection is free for other messages meanwhile
+        :param connection: socket or asyncio.StreamWriter the move came from
+        :param cookie: str
+        :param command: str, Code, Move or Prom
+        :param data: str"""
+        # The answer goes out later, a multiplexed connection may be serving another request by then
+        message_id = self.request_ids.get(connection)
+        opponent = self.q.game.get(cookie)
+        color = self.q.colors.get(cookie)
+        if opponent is None or color is None:
+            self.reply(connection, 'ERR: No game', message_id)
+            return
+        if self.referee is None:
+            self.finish_move(connection, message_id, cookie, command, data, '')
+            return
+        future = self.referee.check(cookie if color == 'white' else opponent, color, command, data)
+        if self.loop is None:
+            self.finish_move(connection, message_id, cookie, command, data, future.result())
+            return
+        asyncio.wrap_future(future, loop=self.loop).add_done_callback(
+            lambda done: self.finish_move(connection, message_id, cookie, command, data, done.result()))
+
+    def finish_move(self, connection, message_id, cookie, command, data, error):
+        """Answers a checked move and passes it to the opponent, or refuses it
+        :param connection: socket or asyncio.StreamWriter the move came from
+        :param message_id: int, id of the request on a multiplexed connection, or None
+        :param cookie: str
+        :param command: str
+        :param data: str
+        :param error: str, why the referee refused the move, '' if legal"""
+        if error:
+            self.reply(connection, 'ERR: ' + error, message_id)
+            return
+        opponent = self.q.game.get(cookie)
+        # The game ended while the move was checked
+        if opponent is None:
+            self.reply(connection, 'ERR: No game', message_id)
+            return
+        self.reply(connection, 'OK', message_id)
+        if opponent in self.q.bots:
+            self.bot_answer(cookie, command, data)
+        else:
+            # forward data to opponent
+            self.push(opponent, command + data)
+
+    def bot_answer(self, cookie, command, data):
+        """Passes a client's message to its computer opponent and sends back the bot's move when it is its turn
+        :param cookie: str, cookie of the client
+        :param command: str, Code, Move or Prom
+        :param data: str"""
+        bot = self.q.bots.get(self.q.game.get(cookie))
+        if bot is None:
+            return
+        if command == 'Prom':
+            bot.receiveProm(data)
+            return
+        if command == 'Code':
+            bot.receiveCode(data)
+        else:
+            bot.receiveMove(data)
+        if self.loop is None:
+            self.send_bot_reply(cookie, bot.reply())
+            return
+        # The search would stall every other connection, it runs in a thread while the loop goes on
+        future = self.loop.run_in_executor(None, bot.reply)
+        future.add_done_callback(lambda done: self.send_bot_reply(cookie, done.result()))
+
+    def send_bot_reply(self, cookie, messages):
+        """Sends a computer opponent's messages to its client, unless the client has left meanwhile
+        :param cookie: str, cookie of the client
+        :param messages: list of (str command, str data)"""
+        if cookie not in self.q.cookieReceiver or cookie not in self.q.game:
+            return
+        for bot_command, bot_data in messages:
+            if self.referee is not None:
+                # Keeps the referee's game in step, the bot only plays legal moves
+                bot_color = self.q.colors[self.q.game[cookie]]
+                self.referee.check(self.game_id(cookie), bot_color, bot_command, bot_data)
+            self.push(cookie, bot_command + bot_data)
+
+    def handle_data(self, connection, decoder, data):
+        """Acts on the messages in data received from a client
+        :param connection: socket or asyncio.StreamWriter the data came from
+        :param decoder: Protocol.FrameDecoder of a framed connection, None for the text protocol
+        :param data: bytes
+        :return: bool, False once the client ended its connection"""
+        if decoder is None:
+            return self.handle_message(connection, data)
+        decoder.feed(data)
+        multiplexed = connection in self.multiplexed
+        # Frames after a connection starts moving are left in the decoder for the process taking it
+        while connection not in self.moving:
+            body = decoder.next()
+            if body is None:
+                break
+            try:
+                if multiplexed:
+                    message_id, *request = Protocol.decodeMultiplexedRequest(body)
+                    self.request_ids[connection] = message_id
+                else:
+                    request = Protocol.decodeRequest(body)
+                if not self.handle_command(connection, *request):
+                    return False
+            except Exception as e:
+                print('Bad request:', repr(e))
+        return True
+
+    def handle_message(self, connection, message):
+        """Acts on one text protocol message, each recv is taken for a whole message
+        :param connection: socket or asyncio.StreamWriter the message came from
+        :param message: bytes
+        :return: bool, False once the client ended its connection"""
+        # Messages will be received in the form:
+        # User: Cookie: Command: Data
+        # Split into parts
+        msg = message.decode()
+        user = msg[0: msg.index(':')]
+        msg = msg[msg.index(':') + 2:]
+        cookie = msg[0: msg.index(':')]
+        msg = msg[msg.index(':') + 2:]
+        command = msg[0: msg.index(':')]
+        msg = msg[msg.index(':') + 2:]
+        data = msg
+        return self.handle_command(connection, user, cookie, command, data)
+
+    def handle_command(self, connection, user, cookie, command, data):
+        """Acts on one command of a client, sends info to clients and keeps track of what clients are in each game
+        :param connection: socket or asyncio.StreamWriter the command came from
+        :param user: str
+        :param cookie: str
+        :param command: str
+        :param data: str
+        :return: bool, False once the client ended its connection"""
+        running = True
+        # Check for known commands
+        if command == 'Stats':
+            self.reply(connection, self.stats())
+            return running
+        if command == "SetRecv":
+            self.q.set_receiver(cookie, connection)
+            self.receiver_cookies[connection] = cookie
+            # Messages destined to the client with this cookie go through this socket
+            print('set receiver at cookie', cookie)
+
+        # if username exists
+        owner = self.q.userMap.get(user)
+        if owner is not None:
+            # and does not match cookie
+            if owner != cookie:
+                error = "ERR: Username already exists!"
+                self.reply(connection, error)
+            else:
+                # client searching for game
+                if command == 'Start':
+                    self.reply(connection, 'None')
+                    # computer opponent asked for
+                    if data == 'Bot':
+                        self.start_bot(cookie, user)
+                    else:
+                        # any opponent if data is 'None', else the user named, added to the queue if not waiting
+                        opponent = self.q.waiting.match(cookie, user, data)
+                        if opponent is not None:
+                            # link waiting opponent to new client
+                            self.start_game(opponent, cookie)
+                            try:
+                                self.push(cookie, str("StartB" + opponent))
+                                self.push(opponent, (str("StartW" + cookie)))
+                            except Exception as e:
+                                print(e)
+                    self.q.set_name(cookie, user)
+                    self.reply(connection, "No")
+                # lookup name given cookie
+                if command == 'GetName':
+                    reply = self.q.cookieMap.get(data, 'None')
+                    self.reply(connection, reply)
+                # Move Format: P#xy  where c is color, P is piece,
+                # P is piece num, x is 0-7, y is 0-7 -- use # = 0 for singular pieces(Q, K)
+                # Code Format: 4 hex digits of a 16 bit move, from, to and promotion, see Chess.encodeMove
+                # Promote Format: P#V    where V is value
+                if command in ('Move', 'Code', 'Prom'):
+                    self.check_move(connection, cookie, command, data)
+                if command == 'Chat':
+                    reply = 'OK'
+                    self.reply(connection, reply)
+                    # forward data to opponent
+                    opponent = self.q.game.get(cookie)
+                    if opponent is not None and opponent not in self.q.bots:
+                        self.push(opponent, (str("Chat" + data)))
+                if command == 'End':
+                    if data != 'None':
+                        reply = "End: Closing Connection"
+                        self.reply(connection, reply)
+                        self.leave_game(cookie, data)
+                        # Remove username association
+                        self.release_user(user, cookie)
+                        running = False
+        else:
+            # Client asking for cookie
+            if command == 'Cookie':
+                reply = self.q.new_cookie()
+                self.reply(connection, reply)
+            # Client wants to be assigned a name
+            if command == 'User':
+                if user == 'None':
+                    reply = "ERR: Invalid Name!"
+                    self.reply(connection, reply)
+                elif self.q.claim_user(user, cookie):
+                    reply = "OK"
+                    self.reply(connection, reply)
+                else:
+                    # Taken by another client since the check above
+                    self.reply(connection, "ERR: Username already exists!")
+
+        print(user, cookie, command, data)
+        return running
 
     def handle_client(self, connection_socket):
-        """Awaits Client Commands, sends info to clients and keeps track of what clients are in each game
+        """Awaits Client Commands on a socket in its own thread until the client ends or drops the connection
         :param connection_socket: socket"""
         print('Handling Client!')
+        self.writing[connection_socket] = threading.Lock()
         running = True
+        decoder = None
+        message = b''
+        try:
+            # A greeting cut short by the network is read to the end
+            while Protocol.HELLO.startswith(message) and len(message) < len(Protocol.HELLO):
+                data = connection_socket.recv(2048)
+                if not data:
+                    break
+                message += data
+        except OSError:
+            running = False
+        decoder, message = self.negotiate(connection_socket, message)
         while running:
+            if message:
+                try:
+                    running = self.handle_data(connection_socket, decoder, message)
+                except Exception as e:
+                    print('Bad message:', repr(e))
+                    # A broken frame leaves the rest of the stream unreadable
+                    if decoder is not None:
+                        break
             try:
-                # Messages will be received in the form:
-                # User: Cookie: Command: Data
-                # Split into parts
-                message_from_client = connection_socket.recv(2048)
-                msg = message_from_client.decode()
-                user = msg[0: msg.index(':')]
-                msg = msg[msg.index(':') + 2:]
-                cookie = msg[0: msg.index(':')]
-                msg = msg[msg.index(':') + 2:]
-                command = msg[0: msg.index(':')]
-                msg = msg[msg.index(':') + 2:]
-                data = msg
-
-                # Check for known commands
-                if command == "SetRecv":
-                    self.q.cookieReceiver[cookie] = connection_socket
-                    # Messages destined to the client with this cookie go through this socket
-                    print('set receiver at cookie', cookie)
-
-                # if username exists
-                if user in self.q.userMap:
-                    # and does not match cookie
-                    if self.q.userMap[user] != cookie:
-                        error = "ERR: Username already exists!"
-                        reply = error.encode()
-                        connection_socket.send(reply)
-                    else:
-                        # client searching for game
-                        if command == 'Start':
-                            self.reply(connection_socket, 'None')
-                            found = False
-                            # no specified opponent
-                            if data == 'None':
-                                for userCookie in self.q.waiting:
-                                    if self.q.waiting[userCookie] == 'None' or self.q.waiting[userCookie] == user:
-                                        # link waiting opponents to new client
-                                        self.q.game[cookie] = userCookie
-                                        self.q.game[userCookie] = cookie
-                                        try:
-                                            self.reply(self.q.cookieReceiver[cookie], str("StartB" + userCookie))
-                                            self.reply(self.q.cookieReceiver[userCookie], (str("StartW" + cookie)))
-                                        except Exception as e:
-                                            print(e)
-                                        found = True
-                                        # remove client from waiting queue
-                                        del self.q.waiting[userCookie]
-                                        break
-                            else:
-                                # find chosen opponent
-                                if data in self.q.userMap:  # username to cookie
-                                    if self.q.userMap[data] in self.q.waiting and \
-                                            (self.q.waiting[self.q.userMap[data]] == user or
-                                             self.q.waiting[self.q.userMap[data]] == 'None'):
-                                        # self.q.userMap[data] is opponent cookie
-                                        self.q.game[cookie] = self.q.userMap[data]
-                                        self.q.game[self.q.userMap[data]] = cookie
-                                        try:
-                                            self.reply \
-                                                (self.q.cookieReceiver[cookie], str("StartB" + self.q.userMap[data]))
-                                            self.reply \
-                                                (self.q.cookieReceiver[self.q.userMap[data]], (str("StartW" + cookie)))
-                                        except Exception as e:
-                                            print(e)
-                                        found = True
-                                        # remove client from waiting queue
-                                        del self.q.waiting[self.q.userMap[data]]
-                            # add client to waiting queue if no opponent found
-                            if not found:
-                                self.q.waiting[cookie] = data
-                            self.q.cookieMap[cookie] = user
-                            self.reply(connection_socket, "No")
-                        # lookup name given cookie
-                        if command == 'GetName':
-                            reply = 'None'
-                            if data in self.q.cookieMap:
-                                reply = self.q.cookieMap[data]
-                            self.reply(connection_socket, reply)
-                        # Move Format: P#xy  where c is color, P is piece,
-                        # P is piece num, x is 0-7, y is 0-7 -- use # = 0 for singular pieces(Q, K)
-                        if command == 'Move':
-                            reply = 'OK'
-                            self.reply(connection_socket, reply)
-                            # forward data to opponent
-                            self.reply(self.q.cookieReceiver[self.q.game[cookie]], (str("Move" + data)))
-                        if command == 'Prom':  # Promote Format: P#a1V    where V is value
-                            reply = 'OK'
-                            self.reply(connection_socket, reply)
-                            # forward data to opponent
-                            self.reply(self.q.cookieReceiver[self.q.game[cookie]], (str("Prom" + data)))
-                        if command == 'Chat':
-                            reply = 'OK'
-                            self.reply(connection_socket, reply)
-                            # forward data to opponent
-                            self.reply(self.q.cookieReceiver[self.q.game[cookie]], (str("Chat" + data)))
-                        if command == 'End':
-                            if data != 'None':
-                                reply = "End: Closing Connection"
-                                self.reply(connection_socket, reply)
-                                if cookie in self.q.game:
-                                    self.reply(self.q.cookieReceiver[self.q.game[cookie]], (str("End" + data)))
-                                    if self.q.cookieMap[self.q.game[cookie]] in self.q.userMap:
-                                        # Free up oponents username
-                                        del self.q.userMap[self.q.cookieMap[self.q.game[cookie]]]
-                                # Remove from Queue
-                                if cookie in self.q.waiting:
-                                    del self.q.waiting[cookie]
-                                # Remove username association
-                                if user in self.q.userMap:
-                                    del self.q.userMap[user]
-                                running = False
-                                # close socket
-                                connection_socket.close()
-                                reply = 'None'
-                                self.reply(connection_socket, reply)
-                else:
-                    # Client asking for cookie
-                    if command == 'Cookie':
-                        self.q.users += 1
-                        reply = str(self.q.users)
-                        self.reply(connection_socket, reply)
-                    # Client wants to be assigned a name
-                    if command == 'User':
-                        if user == 'None':
-                            reply = "ERR: Invalid Name!"
-                            self.reply(connection_socket, reply)
-                        else:
-                            self.q.userMap[user] = cookie
-                            reply = "OK"
-                            self.reply(connection_socket, reply)
-
-                print(user, cookie, command, data)
-            except Exception as e:
-                pass
+                message = connection_socket.recv(2048)
+            except OSError:
+                break
+            if not message:
+                break
+        self.forget(connection_socket)
+        connection_socket.close()
+
+    async def handle_stream(self, reader, writer):
+        """Awaits Client Commands on a connection of the event loop until the client ends or drops it.
+        An idle connection costs a few kilobytes of buffers instead of a thread
+        :param reader: asyncio.StreamReader
+        :param writer: asyncio.StreamWriter"""
+        running = True
+        message = b''
+        try:
+            # A greeting cut short by the network is read to the end
+            while Protocol.HELLO.startswith(message) and len(message) < len(Protocol.HELLO):
+                data = await reader.read(2048)
+                if not data:
+                    break
+                message += data
+        except OSError:
+            running = False
+        decoder, message = self.negotiate(writer, message)
+        if running:
+            await self.read_stream(reader, writer, decoder, message)
+        self.forget(writer)
+        writer.close()
+
+    async def read_stream(self, reader, writer, decoder, message=b''):
+        """Acts on the messages of a negotiated connection until the client ends or drops it
+        :param reader: asyncio.StreamReader
+        :param writer: asyncio.StreamWriter
+        :param decoder: Protocol.FrameDecoder, None for the text protocol
+        :param message: bytes, received already"""
+        running = True
+        while running:
+            if message:
+                try:
+                    running = self.handle_data(writer, decoder, message)
+                except Exception as e:
+                    print('Bad message:', repr(e))
+                    # A broken frame leaves the rest of the stream unreadable
+                    if decoder is not None:
+                        break
+            try:
+                message = await reader.read(2048)
+            except OSError:
+                break
+            if not message:
+                break
+
+    def release_user(self, user, cookie=None):
+        """Frees a user name for the next player to take
+        :param user: str
+        :param cookie: str, frees the name only if this client still has it, None frees it anyway
+        :return: str cookie that had the name, None if nothing was freed"""
+        return self.q.release_user(user, cookie)
+
+    def stats(self):
+        """Move check latency percentiles and lock contention, for the Stats command
+        :return: str"""
+        if self.referee is None:
+            checks = 'Moves are not checked'
+        else:
+            stats = self.referee.percentiles()
+            checks = 'Checked: ' + str(stats['count']) + '  ' + '  '.join(
+                name + ': ' + format(stats[name], '.3f') + 'ms' for name in ('p50', 'p90', 'p99', 'max'))
+        # Times each kind of lock had to be waited for, of the times it was taken
+        return checks + '  Locks: ' + '  '.join(
+            name + ' ' + str(counters['contended']) + '/' + str(counters['acquired']) + ' '
+            + format(counters['waited'] * 1000, '.3f') + 'ms' for name, counters in self.q.contention().items())
+
+    def forget(self, connection):
+        """Drops a closed connection. If it was the client's receiver, the client has left: it is taken off the
+        waiting queue and its game ends
+        :param connection: socket or asyncio.StreamWriter"""
+        self.framed.discard(connection)
+        self.multiplexed.discard(connection)
+        self.request_ids.pop(connection, None)
+        self.writing.pop(connection, None)
+        cookie = self.receiver_cookies.pop(connection, None)
+        if cookie is None:
+            return
+        # A client that lost its receiver has left, its game ends
+        if self.q.drop_receiver(cookie, connection):
+            self.leave_game(cookie)
+
+
+def main(argv=None):
+    """Command line entry: python3 Server.py [--address A] [--port N] [--backlog N] [--mode thread|asyncio]"""
+    parser = argparse.ArgumentParser(description='Chess game server')
+    parser.add_argument('--address', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=4000)
+    parser.add_argument('--backlog', type=int, default=10, help='connections waiting to be accepted')
+    parser.add_argument('--mode', choices=('thread', 'asyncio'), default='thread',
+                        help='a thread per connection or one event loop for all')
+    parser.add_argument('--bot-latency', type=float, default=1.0, help='seconds the computer opponent thinks')
+    parser.add_argument('--book', default=None, help='opening book for the computer opponent')
+    parser.add_argument('--tablebase', default=None, help='endgame tablebase for the computer opponent')
+    parser.add_argument('--referee-workers', type=int, default=2, help='workers checking moves, 0 to not check')
+    parser.add_argument('--referee-threads', action='store_true', help='check moves in threads, not processes')
+    args = parser.parse_args(argv)
+    Server(args.address, args.port, args.backlog, args.bot_latency, args.book, args.tablebase, args.mode,
+           args.referee_workers, not args.referee_threads)
+    return 0
 
 
-Server()
+if __name__ == '__main__':
+    raise SystemExit(main())
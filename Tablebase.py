@@ -0,0 +1,407 @@
+import argparse
+import mmap
+import struct
+import time
+from itertools import product
+
+from Chess import Game
+from Bitboard import KING_ATTACKS, KNIGHT_ATTACKS, PAWN_ATTACKS, WHITE, bishopAttacks, rookAttacks, squares
+
+# File layout: HEADER, one ENTRY per table, then the tables. A table is a byte per position with white to move,
+# then a byte per position with black to move. A byte is 0 for a draw, or 1 + plies to mate by the strong side
+MAGIC = b'CHTB0001'
+HEADER = struct.Struct('>8sI')
+# Entry: table name like KBNK, offset of its white to move block, positions per side to move
+ENTRY = struct.Struct('>8sQI')
+TABLES = ('KQK', 'KRK', 'KPK', 'KBNK')
+# Order of the strong side's pieces in a table name and index
+ORDER = 'QRBNP'
+# Pieces a pawn is promoted to while generating, each needs its table built first
+PROMOTIONS = 'QR'
+
+
+def _transform(flipX, flipY, swap):
+    """Square mapping of a board symmetry
+    :param flipX: bool, mirror files
+    :param flipY: bool, mirror ranks
+    :param swap: bool, mirror along the a1-h8 diagonal
+    :return: tuple[int]"""
+    table = []
+    for sq in range(64):
+        x = sq % 8
+        y = sq // 8
+        if swap:
+            x, y = y, x
+        table.append((7 - x if flipX else x) + 8 * (7 - y if flipY else y))
+    return tuple(table)
+
+
+# The 8 symmetries of a board without pawns, identity first. Pawns only allow mirroring files
+SYMMETRIES = [_transform(flipX, flipY, swap) for swap in (False, True) for flipY in (False, True)
+              for flipX in (False, True)]
+DIAGONAL = _transform(False, False, True)
+
+
+class Layout:
+    """Position numbering of a table. The white king is moved to the a1-d1-d4 triangle, or files a-d
+    if there are pawns, so symmetric positions share one entry"""
+
+    def __init__(self, pieces):
+        """:param pieces: str, pieces of the strong side besides its king, in ORDER"""
+        self.pieces = pieces
+        self.pawns = 'P' in pieces
+        # Squares as (white king, black king, pieces...)
+        self.count = 2 + len(pieces)
+        self.kinds = ('K', None) + tuple(pieces)
+        if self.pawns:
+            self.slots = [sq for sq in range(64) if sq % 8 <= 3]
+            symmetries = SYMMETRIES[:2]
+        else:
+            self.slots = [sq for sq in range(64) if sq % 8 <= 3 and sq // 8 <= sq % 8]
+            symmetries = SYMMETRIES
+        self.slotOf = {sq: slot for slot, sq in enumerate(self.slots)}
+        self.kingTransforms = [next(table for table in symmetries if table[sq] in self.slotOf) for sq in range(64)]
+        self.size = len(self.slots) * 64 ** (self.count - 1)
+
+    def index(self, squares):
+        """Entry of a position, the same for all its symmetric copies
+        :param squares: tuple of int, (white king, black king, pieces...)
+        :return: int"""
+        table = self.kingTransforms[squares[0]]
+        mapped = [table[sq] for sq in squares]
+        if not self.pawns and mapped[0] % 9 == 0:
+            # The king on the diagonal, the mirrored position lands in the triangle as well
+            mirrored = [DIAGONAL[sq] for sq in mapped]
+            if mirrored < mapped:
+                mapped = mirrored
+        index = self.slotOf[mapped[0]]
+        for sq in mapped[1:]:
+            index = index * 64 + sq
+        return index
+
+    def squares(self, index):
+        """Position of an entry
+        :param index: int
+        :return: tuple of int, see index"""
+        rest = []
+        for _ in range(self.count - 1):
+            index, sq = divmod(index, 64)
+            rest.append(sq)
+        rest.append(self.slots[index])
+        return tuple(reversed(rest))
+
+
+def attacks(kind, sq, occupied):
+    """Squares a white piece attacks
+    :param kind: str
+    :param sq: int
+    :param occupied: int
+    :return: int"""
+    if kind == 'K':
+        return KING_ATTACKS[sq]
+    if kind == 'N':
+        return KNIGHT_ATTACKS[sq]
+    if kind == 'P':
+        return PAWN_ATTACKS[WHITE][sq]
+    bb = 0
+    if kind in 'QB':
+        bb |= bishopAttacks(sq, occupied)
+    if kind in 'QR':
+        bb |= rookAttacks(sq, occupied)
+    return bb
+
+
+def whiteAttacks(kinds, position, occupied):
+    """Squares the strong side attacks, including its own defended pieces
+    :param kinds: tuple, see Layout.kinds
+    :param position: tuple of int, see Layout.index
+    :param occupied: int, the black king left out so it does not hide squares behind it
+    :return: int"""
+    bb = 0
+    for i, sq in enumerate(position):
+        if i != 1:
+            bb |= attacks(kinds[i], sq, occupied)
+    return bb
+
+
+def _legal(layout, position):
+    """Whether pieces stand on different squares, the kings apart and pawns off the first and last rows
+    :param layout: Layout
+    :param position: tuple of int
+    :return: bool"""
+    if len(set(position)) != layout.count or KING_ATTACKS[position[0]] >> position[1] & 1:
+        return False
+    return not any(kind == 'P' and not 8 <= sq < 56 for kind, sq in zip(layout.kinds, position))
+
+
+def generate(pieces, tables, out=print):
+    """Retrograde analysis of the strong side with a king and pieces against a lone king.
+    Mates are found first, then positions won in n + 1 plies are those with a move into a position lost in n,
+    and positions lost in n + 2 are those where every move leads to a position won in n + 1.
+    The defending king taking a piece always draws, for these material sets
+    :param pieces: str, in ORDER
+    :param tables: dict[str, (Layout, bytearray, bytearray)] tables built before, for promotions
+    :param out: function used for output
+    :return: (Layout, bytearray, bytearray) layout, white to move and black to move tables"""
+    start = time.perf_counter()
+    layout = Layout(pieces)
+    kinds = layout.kinds
+    wtm = bytearray(layout.size)
+    btm = bytearray(layout.size)
+    # Black moves not yet known to lose, for each black to move position
+    counts = bytearray(layout.size)
+    frontier = []
+    # Promotions into won positions, by plies to mate   {plies: [index]}
+    exits = {}
+
+    index = 0
+    for wk in layout.slots:
+        for rest in product(range(64), repeat=layout.count - 1):
+            position = (wk,) + rest
+            current = index
+            index += 1
+            if not layout.pawns and wk % 9 == 0 and [DIAGONAL[sq] for sq in position] < list(position):
+                continue
+            if not _legal(layout, position):
+                continue
+            bk = position[1]
+            occupied = 0
+            for sq in position:
+                occupied |= 1 << sq
+            white = occupied ^ (1 << bk)
+            attacked = whiteAttacks(kinds, position, white)
+            check = attacked >> bk & 1
+
+            # Black to move
+            targets = KING_ATTACKS[bk] & ~attacked
+            # A piece that is not defended can be taken
+            if not targets & white:
+                moves = targets & ~white
+                if wk % 9 == 0 and not layout.pawns:
+                    # Moves can lead to mirror images of each other, count them once
+                    count = len({layout.index(position[:1] + (sq,) + position[2:]) for sq in squares(moves)})
+                else:
+                    count = bin(moves).count('1')
+                if count:
+                    counts[current] = count
+                elif check:
+                    btm[current] = 1
+                    frontier.append(current)
+
+            # White to move, only legal when the black king is not in check. Pawns may promote
+            if check or not layout.pawns:
+                continue
+            best = 0
+            for i, sq in enumerate(position):
+                if kinds[i] == 'P' and sq >= 48 and not occupied >> (sq + 8) & 1:
+                    for promotion in PROMOTIONS:
+                        others = [(kinds[j], position[j]) for j in range(2, layout.count) if j != i]
+                        others.append((promotion, sq + 8))
+                        others.sort(key=lambda other: ORDER.index(other[0]))
+                        sub, _, subBtm = tables[''.join(kind for kind, _ in others)]
+                        value = subBtm[sub.index(position[:2] + tuple(square for _, square in others))]
+                        if value and (not best or value < best):
+                            best = value
+            if best:
+                exits.setdefault(best, []).append(current)
+
+    out('K' + pieces + 'K: ' + str(layout.size) + ' positions per side, ' + str(len(frontier)) + ' mates  '
+        + format(time.perf_counter() - start, '.1f') + 's')
+
+    plies = 0
+    while frontier or any(value > plies for value in exits):
+        # frontier: black to move, lost in plies
+        won = []
+        for current in frontier:
+            position = layout.squares(current)
+            for previous in _whiteUnmoves(layout, position):
+                entry = layout.index(previous)
+                if not wtm[entry]:
+                    wtm[entry] = plies + 2
+                    won.append(entry)
+        for entry in exits.pop(plies + 1, ()):
+            if not wtm[entry]:
+                wtm[entry] = plies + 2
+                won.append(entry)
+        # won: white to move, mates in plies + 1
+        frontier = []
+        for current in won:
+            position = layout.squares(current)
+            seen = set()
+            for previous in _blackUnmoves(position):
+                entry = layout.index(previous)
+                if entry in seen:
+                    continue
+                seen.add(entry)
+                if counts[entry]:
+                    counts[entry] -= 1
+                    if not counts[entry]:
+                        btm[entry] = plies + 3
+                        frontier.append(entry)
+        plies += 2
+    out('K' + pieces + 'K: longest mate ' + str(max(max(wtm), max(btm)) - 1) + ' plies  '
+        + format(time.perf_counter() - start, '.1f') + 's')
+    return layout, wtm, btm
+
+
+def _whiteUnmoves(layout, position):
+    """Positions with white to move that lead to a position by one move of the strong side,
+    leaving out those with the black king in check
+    :param layout: Layout
+    :param position: tuple of int, black to move
+    :return: generator of tuple of int"""
+    kinds = layout.kinds
+    bk = position[1]
+    occupied = 0
+    for sq in position:
+        occupied |= 1 << sq
+    for i, sq in enumerate(position):
+        kind = kinds[i]
+        if kind is None:
+            continue
+        if kind == 'P':
+            origins = 0
+            if sq >= 16 and not occupied >> (sq - 8) & 1:
+                origins = 1 << (sq - 8)
+                if 24 <= sq < 32 and not occupied >> (sq - 16) & 1:
+                    origins |= 1 << (sq - 16)
+        else:
+            # Pieces move back the way they came
+            origins = attacks(kind, sq, occupied) & ~occupied
+            if kind == 'K':
+                origins &= ~KING_ATTACKS[bk]
+        for origin in squares(origins):
+            previous = position[:i] + (origin,) + position[i + 1:]
+            white = (occupied ^ (1 << sq) | 1 << origin) ^ (1 << bk)
+            if not whiteAttacks(kinds, previous, white) >> bk & 1:
+                yield previous
+
+
+def _blackUnmoves(position):
+    """Positions with black to move that lead to a position by a black king move
+    :param position: tuple of int, white to move
+    :return: generator of tuple of int"""
+    occupied = 0
+    for sq in position:
+        occupied |= 1 << sq
+    for origin in squares(KING_ATTACKS[position[1]] & ~occupied & ~KING_ATTACKS[position[0]]):
+        yield position[:1] + (origin,) + position[2:]
+
+
+def build(path, names=TABLES, out=print):
+    """Generates tables and writes them to one file
+    :param path: str
+    :param names: tuple of str, table names, promotions need KQK and KRK
+    :param out: function used for output
+    :return: int bytes written"""
+    tables = {}
+    for name in names:
+        pieces = name[1:-1]
+        if 'P' in pieces:
+            for promotion in PROMOTIONS:
+                sub = ''.join(sorted(pieces.replace('P', promotion, 1), key=ORDER.index))
+                if sub not in tables:
+                    tables[sub] = generate(sub, tables, out)
+        if pieces not in tables:
+            tables[pieces] = generate(pieces, tables, out)
+
+    written = [name[1:-1] for name in names]
+    offset = HEADER.size + ENTRY.size * len(written)
+    with open(path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, len(written)))
+        for pieces in written:
+            layout = tables[pieces][0]
+            file.write(ENTRY.pack(('K' + pieces + 'K').encode(), offset, layout.size))
+            offset += 2 * layout.size
+        for pieces in written:
+            _, wtm, btm = tables[pieces]
+            file.write(wtm)
+            file.write(btm)
+    out('Tables: ' + ' '.join(names) + '  Bytes: ' + str(offset))
+    return offset
+
+
+class Tablebase:
+    """Tables written by build, read through mmap. Probing a position is one index computation and one byte read"""
+
+    def __init__(self, path):
+        """:param path: str"""
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('Not a tablebase: ' + path)
+        # {name: (Layout, offset)}
+        self.tables = {}
+        for i in range(count):
+            name, offset, size = ENTRY.unpack_from(self.data, HEADER.size + i * ENTRY.size)
+            name = name.rstrip(b'\0').decode()
+            self.tables[name] = (Layout(name[1:-1]), offset)
+        self.maxPieces = max((len(name) for name in self.tables), default=0)
+
+    def probe(self, game: Game):
+        """Result of a game position with perfect play, if its material has a table.
+        Castling rights and en passant are not looked at, they never matter with this little material
+        :param game: Game
+        :return: (str, int) winner ('white', 'black' or 'draw') and plies to mate, or None"""
+        pieces = [piece for piece in game.squares if piece is not None]
+        if len(pieces) > self.maxPieces:
+            return None
+        white = [piece for piece in pieces if piece.color == 'white']
+        black = [piece for piece in pieces if piece.color == 'black']
+        if len(black) == 1:
+            strong, weak, color = white, black, 'white'
+        elif len(white) == 1:
+            strong, weak, color = black, white, 'black'
+        else:
+            return None
+        others = sorted((piece for piece in strong if piece.piece[0] != 'K'), key=lambda p: ORDER.index(p.piece[0]))
+        table = self.tables.get('K' + ''.join(piece.piece[0] for piece in others) + 'K')
+        if table is None:
+            return None
+        layout, offset = table
+        king = next(piece for piece in strong if piece.piece[0] == 'K')
+        position = (king.square, weak[0].square) + tuple(piece.square for piece in others)
+        if color == 'black':
+            # Tables have white as the strong side, mirror the ranks
+            position = tuple(sq ^ 56 for sq in position)
+        if game.turn != color:
+            offset += layout.size
+        value = self.data[offset + layout.index(position)]
+        return (color, value - 1) if value else ('draw', 0)
+
+    def close(self):
+        """Unmaps and closes the file"""
+        self.data.close()
+        self.file.close()
+
+
+def main(argv=None):
+    """Command line entry: python -m Tablebase build [--tables NAME...] | probe --fen FEN, both with --file FILE"""
+    parser = argparse.ArgumentParser(description='Build or probe endgame tablebases')
+    commands = parser.add_subparsers(dest='command', required=True)
+    buildParser = commands.add_parser('build', help='generate tables by retrograde analysis')
+    buildParser.add_argument('--file', default='tablebase.bin')
+    buildParser.add_argument('--tables', nargs='+', choices=TABLES, default=list(TABLES))
+    probeParser = commands.add_parser('probe', help='distance to mate of a position')
+    probeParser.add_argument('--file', default='tablebase.bin')
+    probeParser.add_argument('--fen', required=True)
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        build(args.file, tuple(args.tables))
+        return 0
+    tablebase = Tablebase(args.file)
+    result = tablebase.probe(Game.from_fen(args.fen, lazy=True))
+    tablebase.close()
+    if result is None:
+        print('Not in the tablebase')
+        return 1
+    print('draw' if result[0] == 'draw' else result[0] + ' mates in ' + str(result[1]) + ' plies')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())